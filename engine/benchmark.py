@@ -0,0 +1,653 @@
+#!.venv/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the engine on a synthetic index, so they run without crawling first.
+Run `python benchmark.py --help` to see the available benchmarks.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+# Highest growth of the median top-k latency that the scaling benchmark accepts while the index grows eightfold
+SCALING_FACTOR = 2.0
+# Pages per pipe of the pipe benchmark, the batch size of the offline pipeline, see main.TOKENIZER_BATCH_SIZE
+PIPE_BENCHMARK_BATCH = 32
+
+
+def create_synthetic_index(
+    dbcon: duckdb.DuckDBPyConnection,
+    num_docs: int = 10_000,
+    vocab_size: int = 20_000,
+    doc_length: int = 200,
+    seed: int = 42,
+):
+    """
+    Fills a fresh database with random documents. The words of the documents follow a Zipf distribution like
+    natural language, so there are a few very common terms with long posting lists and many rare terms.
+    The term with id i is called "term{i}", the most common term is "term1".
+    Args:
+        dbcon: Database connection
+        num_docs: Number of documents
+        vocab_size: Number of distinct words
+        doc_length: Number of tokens per document
+        seed: Random seed
+
+    Returns: None
+    """
+    from index import compute_statistics
+    from tokenizer import FIELDS
+
+    print(f"Creating synthetic index with {num_docs} documents...")
+    with open("setup.sql", "r") as statements:
+        for statement in statements.read().split(";"):
+            if statement.strip():
+                dbcon.execute(statement)
+
+    rng = np.random.default_rng(seed)
+    probabilities = 1 / np.arange(1, vocab_size + 1)
+    probabilities /= probabilities.sum()
+    tokens = rng.choice(vocab_size, size=num_docs * doc_length, p=probabilities) + 1
+    docs = np.repeat(np.arange(1, num_docs + 1), doc_length)
+
+    # Count each (document, word) pair
+    keys, tfs = np.unique(docs * (vocab_size + 1) + tokens, return_counts=True)
+    body = FIELDS.index("body")
+    df_words = pd.DataFrame(
+        {
+            "word": [f"term{i}" for i in range(1, vocab_size + 1)],
+            "id": np.arange(1, vocab_size + 1),
+        }
+    )
+    df_documents = pd.DataFrame(
+        {
+            "id": np.arange(1, num_docs + 1),
+            "link": [f"https://example.com/{i}" for i in range(1, num_docs + 1)],
+        }
+    )
+    df_tfs = pd.DataFrame(
+        {
+            "word": keys % (vocab_size + 1),
+            "doc": keys // (vocab_size + 1),
+            "tf": tfs,
+        }
+    )
+    df_lengths = pd.DataFrame(
+        {"doc": np.arange(1, num_docs + 1), "length": doc_length}
+    )
+
+    dbcon.execute("INSERT INTO words(word, id) SELECT word, id FROM df_words")
+    dbcon.execute(
+        """
+        INSERT INTO documents(id, link, title, description)
+        SELECT id, link, 'Title ' || id, 'Description ' || id FROM df_documents
+    """
+    )
+    field_tfs = ", ".join("tf" if i == body else "0" for i in range(len(FIELDS)))
+    dbcon.execute(
+        f"INSERT INTO TFs(word, doc, tf, field_tfs) SELECT word, doc, tf, [{field_tfs}] FROM df_tfs"
+    )
+    field_lengths = ", ".join(
+        "length" if i == body else "0" for i in range(len(FIELDS))
+    )
+    dbcon.execute(
+        f"INSERT INTO doc_lengths(doc, length, field_lengths) SELECT doc, length, [{field_lengths}] FROM df_lengths"
+    )
+    compute_statistics(dbcon)
+    print(f"Created synthetic index with {len(df_tfs)} postings")
+
+
+def synthetic_queries(
+    num_queries: int, vocab_size: int = 20_000, seed: int = 7
+) -> list[list[str]]:
+    """
+    Random queries of one to three terms. Like real queries they mix very common terms (think "tübingen") with
+    rarer ones.
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(num_queries):
+        num_terms = rng.integers(1, 4)
+        # Log-uniform ranks: as many queries hit the 10 most common terms as the terms ranked 1000 to 10000
+        ranks = np.exp(rng.uniform(0, np.log(vocab_size), size=num_terms)).astype(int)
+        queries.append([f"term{rank}" for rank in ranks])
+    return queries
+
+
+def report(name: str, latencies: list[float]):
+    """
+    Prints the mean and percentiles of latencies given in seconds.
+    """
+    latencies = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(
+        f"{name:<24} mean {latencies.mean():9.3f} ms   p50 {p50:9.3f} ms   p95 {p95:9.3f} ms   p99 {p99:9.3f} ms"
+    )
+
+
+def benchmark_index(args):
+    """
+    Compares the query latency of the inverted index file with the SQL path.
+    """
+    from inverted_index import InvertedIndex, write_index
+    from rank import fetch_postings, fetch_ranking, score_bm25
+
+    with tempfile.TemporaryDirectory() as directory:
+        con = duckdb.connect(os.path.join(directory, "benchmark.db"))
+        create_synthetic_index(con, num_docs=args.docs, vocab_size=args.vocab)
+        write_index(con, os.path.join(directory, "benchmark.idx"))
+        index = InvertedIndex(os.path.join(directory, "benchmark.idx"))
+
+        queries = synthetic_queries(args.queries, vocab_size=args.vocab)
+        for name, source in [("sql", None), ("index", index)]:
+            fetch_latencies, total_latencies = [], []
+            for terms in queries:
+                start = time.perf_counter()
+                df_tf, df_idf, L = fetch_postings(con, set(terms), index=source)
+                fetched = time.perf_counter()
+                scores = score_bm25(
+                    terms, {term: [] for term in terms}, [], df_tf, df_idf, L
+                )
+                fetch_ranking(con, scores)
+                fetch_latencies.append(fetched - start)
+                total_latencies.append(time.perf_counter() - start)
+            report(f"{name} postings fetch", fetch_latencies)
+            report(f"{name} query", total_latencies)
+
+        index.close()
+        con.close()
+
+
+def loop_bm25(query, expanded_query, sim_weight_list, df_tf, df_idf, L, k1=1.5, b=0.75) -> list[tuple]:
+    """
+    The scoring before rank.score_bm25, one document at a time.
+    """
+    df_tf = df_tf.sort_index()
+    scores = []
+    sim_count = len(sim_weight_list)
+    for doc_id in df_tf.index.get_level_values("doc").unique().tolist():
+        doc_tf = df_tf.loc[doc_id]
+        words = set(doc_tf.index.get_level_values("word").tolist())
+        L_d = len(words)
+
+        score = 0
+        for word in set(query).intersection(words):
+            weight = 4 if not expanded_query.get(word) else 1
+            score += weight * df_idf[word] * (doc_tf[word] * (k1 + 1)) / (doc_tf[word] + k1 * (1 - b + b * L_d / L))
+        for synonym, weight in filter(lambda x: x[0] in words, sim_weight_list):
+            tf_val = doc_tf[synonym]
+            score += weight / sim_count * (df_idf[synonym] * (tf_val * (k1 + 1)) / (tf_val + k1 * (1 - b + b * L_d / L)))
+        scores.append((doc_id, score))
+    return scores
+
+
+def benchmark_scoring(args):
+    """
+    Compares the latency of the vectorized BM25 scoring with scoring one document at a time, on the postings of the
+    index file. Run it with --docs 100000.
+    """
+    from inverted_index import InvertedIndex, write_index
+    from rank import fetch_postings, score_bm25
+
+    with tempfile.TemporaryDirectory() as directory:
+        con = duckdb.connect(os.path.join(directory, "benchmark.db"))
+        create_synthetic_index(con, num_docs=args.docs, vocab_size=args.vocab)
+        write_index(con, os.path.join(directory, "benchmark.idx"))
+        index = InvertedIndex(os.path.join(directory, "benchmark.idx"))
+
+        queries = synthetic_queries(args.queries, vocab_size=args.vocab)
+        postings = [fetch_postings(con, set(terms), index=index) for terms in queries]
+        results = {}
+        for name, score in [("loop", loop_bm25), ("vectorized", score_bm25)]:
+            latencies, results[name] = [], []
+            for terms, (df_tf, df_idf, L) in zip(queries, postings):
+                start = time.perf_counter()
+                results[name].append(score(terms, {term: [] for term in terms}, [], df_tf, df_idf, L))
+                latencies.append(time.perf_counter() - start)
+            report(f"{name} scoring", latencies)
+
+        # Same documents and scores, up to the rounding of the sums
+        for loop_scores, vectorized_scores in zip(results["loop"], results["vectorized"]):
+            assert [doc for doc, _ in loop_scores] == [doc for doc, _ in vectorized_scores]
+            assert np.allclose(
+                [score for _, score in loop_scores], [score for _, score in vectorized_scores], rtol=1e-12
+            )
+
+        index.close()
+        con.close()
+
+
+def benchmark_topk(args):
+    """
+    Compares the latency of scoring all documents with the top-k pruning, for growing indexes. With pruning, the
+    latency of the queries with common terms grows much slower.
+    """
+    from inverted_index import InvertedIndex, write_index
+    from rank import score_query_bm25, score_query_bm25f
+
+    queries = synthetic_queries(args.queries, vocab_size=args.vocab)
+    # Queries as prepared by rank.prepare_query, without similar words
+    prepared = [([], terms, {term: [] for term in terms}, [], set(terms)) for terms in queries]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for num_docs in (args.docs // 4, args.docs // 2, args.docs):
+            con = duckdb.connect(os.path.join(directory, f"benchmark_{num_docs}.db"))
+            create_synthetic_index(con, num_docs=num_docs, vocab_size=args.vocab)
+            write_index(con, os.path.join(directory, f"benchmark_{num_docs}.idx"))
+            index = InvertedIndex(os.path.join(directory, f"benchmark_{num_docs}.idx"))
+
+            for ranking, score in [("bm25", score_query_bm25), ("bm25f", score_query_bm25f)]:
+                results = {}
+                for name, k in [("all", None), (f"top {args.k}", args.k)]:
+                    latencies, results[name] = [], []
+                    for query in prepared:
+                        start = time.perf_counter()
+                        scores = score(None, query, index=index, proximity_weight=0, k=k)
+                        if k is None:
+                            scores = sorted(scores, key=lambda pair: pair[1], reverse=True)[: args.k]
+                        latencies.append(time.perf_counter() - start)
+                        results[name].append([score for _, score in scores])
+                    report(f"{num_docs} docs {ranking} {name}", latencies)
+
+                # Same top scores, up to the rounding of the sums
+                for all_scores, top_scores in zip(*results.values()):
+                    assert np.allclose(all_scores, top_scores, rtol=1e-12)
+
+            index.close()
+            con.close()
+
+
+def benchmark_scaling(args):
+    """
+    Measures how the latency of top-k queries on the inverted index grows with the number of documents, for indexes
+    of an eighth, a quarter, half and all of the documents. Only the blocks of the postings that can hold documents of
+    the top k are decoded, so the median latency has to stay roughly flat, see SCALING_FACTOR. Queries of only very
+    common terms still decode most of their blocks, as BM25 saturates and their blocks have similar bounds, so the
+    tail still grows with the index. Run it with --docs 80000.
+    """
+    from inverted_index import InvertedIndex, write_index
+    from rank import score_query_bm25, score_query_bm25f
+
+    queries = synthetic_queries(args.queries, vocab_size=args.vocab)
+    # Queries as prepared by rank.prepare_query, without similar words
+    prepared = [([], terms, {term: [] for term in terms}, [], set(terms)) for terms in queries]
+    sizes = [args.docs // 8, args.docs // 4, args.docs // 2, args.docs]
+    medians = {"bm25": [], "bm25f": []}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for num_docs in sizes:
+            con = duckdb.connect(os.path.join(directory, f"benchmark_{num_docs}.db"))
+            create_synthetic_index(con, num_docs=num_docs, vocab_size=args.vocab)
+            write_index(con, os.path.join(directory, f"benchmark_{num_docs}.idx"))
+            index = InvertedIndex(os.path.join(directory, f"benchmark_{num_docs}.idx"))
+
+            for ranking, score in [("bm25", score_query_bm25), ("bm25f", score_query_bm25f)]:
+                # The first pass maps the pages of the index
+                for query in prepared:
+                    score(None, query, index=index, proximity_weight=0, k=args.k)
+                latencies = []
+                for query in prepared:
+                    start = time.perf_counter()
+                    score(None, query, index=index, proximity_weight=0, k=args.k)
+                    latencies.append(time.perf_counter() - start)
+                report(f"{num_docs} docs {ranking} top {args.k}", latencies)
+                medians[ranking].append(np.median(latencies))
+
+            index.close()
+            con.close()
+
+    for ranking, latencies in medians.items():
+        growth = latencies[-1] / latencies[0]
+        print(f"{ranking}: median latency grew {growth:.2f}x for {sizes[-1] / sizes[0]:.0f}x the documents")
+        assert growth <= SCALING_FACTOR, f"The median latency of {ranking} grows with the number of documents"
+
+
+def benchmark_dense(args):
+    """
+    Measures the dense stage of the hybrid ranking on random word vectors: embedding the documents, scoring all of
+    them by one matrix-vector product, and fusing the result with the lexical ranking. Run it with --docs 100000.
+    """
+    from dense import DocumentEmbeddings, build_document_embeddings, embed_query
+    from inverted_index import InvertedIndex, write_index
+    from rank import HYBRID_CANDIDATES, fuse_rankings, score_query_bm25
+    from similarity import EmbeddingStore, save_matrix
+
+    queries = synthetic_queries(args.queries, vocab_size=args.vocab)
+    # Queries as prepared by rank.prepare_query, without similar words
+    prepared = [([], terms, {term: [] for term in terms}, [], set(terms)) for terms in queries]
+
+    with tempfile.TemporaryDirectory() as directory:
+        con = duckdb.connect(os.path.join(directory, "benchmark.db"))
+        create_synthetic_index(con, num_docs=args.docs, vocab_size=args.vocab)
+        write_index(con, os.path.join(directory, "benchmark.idx"))
+        index = InvertedIndex(os.path.join(directory, "benchmark.idx"))
+
+        # Random normalized vectors of the words, with the dimension of GloVe
+        words = [word for word, in con.execute("SELECT word FROM words ORDER BY id").fetchall()]
+        vectors = np.random.default_rng(0).normal(size=(len(words), 100))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        save_matrix(os.path.join(directory, "embeddings.npy"), vectors.astype(np.float16), words)
+        store = EmbeddingStore(os.path.join(directory, "embeddings.npy"))
+
+        start = time.perf_counter()
+        build_document_embeddings(
+            con, store=store, path=os.path.join(directory, "document_embeddings.npy")
+        )
+        print(f"Embedding the documents took {time.perf_counter() - start:.1f} s")
+        document_embeddings = DocumentEmbeddings(os.path.join(directory, "document_embeddings.npy"))
+
+        lexical_latencies, dense_latencies, hybrid_latencies = [], [], []
+        for query in prepared:
+            start = time.perf_counter()
+            scores = score_query_bm25(None, query, index=index, proximity_weight=0, k=HYBRID_CANDIDATES)
+            lexical = time.perf_counter()
+            dense = document_embeddings.search(embed_query(query[1], store), HYBRID_CANDIDATES)
+            dense_end = time.perf_counter()
+            fuse_rankings([scores, dense], args.k)
+            lexical_latencies.append(lexical - start)
+            dense_latencies.append(dense_end - lexical)
+            hybrid_latencies.append(time.perf_counter() - start)
+        report("lexical", lexical_latencies)
+        report("dense", dense_latencies)
+        report("hybrid", hybrid_latencies)
+
+        index.close()
+        con.close()
+
+
+def benchmark_shards(args):
+    """
+    Measures the latency of single queries and the throughput of concurrent queries with an increasing number of
+    shard worker processes.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from shards import ShardPool, export_shards
+
+    queries = synthetic_queries(args.queries, vocab_size=args.vocab)
+    # Queries as prepared by rank.prepare_query, without similar words
+    prepared = [([], terms, {term: [] for term in terms}, [], set(terms)) for terms in queries]
+
+    with tempfile.TemporaryDirectory() as directory:
+        con = duckdb.connect(os.path.join(directory, "benchmark.db"))
+        create_synthetic_index(con, num_docs=args.docs, vocab_size=args.vocab)
+
+        for num_shards in args.shards:
+            shard_directory = os.path.join(directory, f"shards_{num_shards}")
+            export_shards(con, num_shards, directory=shard_directory)
+            pool = ShardPool(shard_directory)
+            # Start the workers
+            pool.search("bm25", prepared[0], k=args.k)
+
+            latencies = []
+            for query in prepared:
+                start = time.perf_counter()
+                pool.search("bm25", query, k=args.k)
+                latencies.append(time.perf_counter() - start)
+            report(f"{num_shards} shards", latencies)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as clients:
+                list(clients.map(lambda query: pool.search("bm25", query, k=args.k), prepared))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{num_shards} shards, {args.clients} clients: {len(prepared) / elapsed:.1f} queries/s"
+            )
+            pool.close()
+
+        con.close()
+
+
+def benchmark_normalizer(args):
+    """
+    Compares tokenizer.preprocess_text with applying the remove_* steps one after the other, on pages of about
+    200,000 characters built from the test sentences.
+    """
+    import tokenizer
+
+    steps = [
+        tokenizer.remove_unicode,
+        tokenizer.remove_url,
+        tokenizer.remove_html,
+        tokenizer.remove_emails,
+        tokenizer.remove_degrees,
+        tokenizer.remove_times,
+        tokenizer.remove_phone_number,
+        tokenizer.remove_dates,
+        tokenizer.remove_emoji,
+        tokenizer.remove_prices,
+        tokenizer.remove_percentages,
+        tokenizer.remove_special_characters,
+        tokenizer.remove_single_character_tokens,
+    ]
+
+    def sequential(text: str) -> str:
+        for step in steps:
+            text = step(text)
+        return text
+
+    # The output has to be the same, sentence by sentence
+    for sentence in tokenizer.test_sentences:
+        assert tokenizer.preprocess_text(sentence) == sequential(sentence), sentence
+
+    rng = np.random.default_rng(42)
+    pages = []
+    for _ in range(args.queries):
+        sentences = rng.choice(tokenizer.test_sentences, size=5_000)
+        pages.append(" ".join(sentences)[:200_000])
+    num_characters = sum(len(page) for page in pages)
+
+    for name, normalize in [
+        ("sequential", lambda texts: [sequential(text) for text in texts]),
+        ("preprocess_text", lambda texts: [tokenizer.preprocess_text(text) for text in texts]),
+        ("preprocess_texts", tokenizer.preprocess_texts),
+    ]:
+        latencies = []
+        for page in pages:
+            start = time.perf_counter()
+            normalize([page])
+            latencies.append(time.perf_counter() - start)
+        report(name, latencies)
+        print(f"{name:<24} {num_characters / sum(latencies) / 1e6:.2f} M characters/s")
+
+    assert [sequential(page) for page in pages] == tokenizer.preprocess_texts(pages)
+
+
+def benchmark_lexicon(args):
+    """
+    Compares the tokens per second of spaCy with the lexicon, and how well they agree. The lexicon is built from
+    one half of random pages of test sentences and evaluated on the other half.
+    """
+    import tokenizer
+
+    rng = np.random.default_rng(42)
+    texts = [
+        " ".join(rng.choice(tokenizer.test_sentences, size=100))
+        for _ in range(2 * args.queries)
+    ]
+    train, test = texts[: args.queries], texts[args.queries :]
+
+    start = time.perf_counter()
+    lexicon = tokenizer.Lexicon.build(train)
+    print(f"Built lexicon of {len(lexicon.table)} words in {time.perf_counter() - start:.2f} s")
+
+    for name, source in [("spacy", None), ("lexicon", lexicon)]:
+        latencies, num_tokens = [], 0
+        for text in test:
+            start = time.perf_counter()
+            num_tokens += len(tokenizer.process_text(text, lexicon=source))
+            latencies.append(time.perf_counter() - start)
+        report(name, latencies)
+        print(f"{name:<24} {num_tokens / sum(latencies):,.0f} tokens/s")
+
+    agreement = lexicon.agreement(test)
+    print(
+        f"Agreement on {agreement['texts']} texts: {agreement['identical']:.1%} identical, "
+        f"precision {agreement['precision']:.1%}, recall {agreement['recall']:.1%}, cache {agreement['cache']}"
+    )
+
+
+def benchmark_pipe(args):
+    """
+    Compares the tokens per second of tokenizer.process_text on each text with tokenizer.process_texts, which runs
+    spaCy on batches of texts, on random pages of test sentences. With several processes, one pipe over all texts, like
+    the Tokenizer runs, is compared with a pipe per batch of pages, which starts the processes for every batch.
+    """
+    import tokenizer
+
+    rng = np.random.default_rng(42)
+    texts = [
+        " ".join(rng.choice(tokenizer.test_sentences, size=100))
+        for _ in range(args.queries)
+    ]
+    # Load the model before measuring
+    tokenizer.get_nlp()
+
+    start = time.perf_counter()
+    expected = [tokenizer.process_text(text) for text in texts]
+    elapsed = time.perf_counter() - start
+    num_tokens = sum(len(tokens) for tokens in expected)
+    print(f"{'process_text':<32} {num_tokens / elapsed:,.0f} tokens/s")
+
+    for n_process in args.processes:
+        start = time.perf_counter()
+        tokens = list(tokenizer.process_texts(texts, n_process=n_process))
+        elapsed = time.perf_counter() - start
+        assert tokens == expected
+        name = f"process_texts, {n_process} processes"
+        print(f"{name:<32} {num_tokens / elapsed:,.0f} tokens/s")
+        if n_process == 1:
+            continue
+
+        start = time.perf_counter()
+        tokens = [
+            tokens
+            for i in range(0, len(texts), PIPE_BENCHMARK_BATCH)
+            for tokens in tokenizer.process_texts(texts[i : i + PIPE_BENCHMARK_BATCH], n_process=n_process)
+        ]
+        elapsed = time.perf_counter() - start
+        assert tokens == expected
+        name = f"  a pipe per {PIPE_BENCHMARK_BATCH} texts"
+        print(f"{name:<32} {num_tokens / elapsed:,.0f} tokens/s")
+
+
+def find_all_text(main_content) -> dict[str, list[str]]:
+    """
+    The extraction before tokenizer.extract_text: the text of every matching tag, including the text of all its
+    nested tags.
+    """
+    import tokenizer
+
+    tags_to_extract = [
+        "title", "h1", "h2", "h3", "h4", "h5", "h6", "p", "span", "div", "li", "td", "th", "a", "b", "strong", "i",
+        "em", "mark", "small", "del", "ins", "sub", "sup", "q", "blockquote", "code", "pre",
+    ]
+    fields = {field: [] for field in tokenizer.FIELDS}
+    for tag in main_content.find_all(tags_to_extract):
+        cleaned_text = tokenizer.clean_text(tag.get_text(strip=True))
+        if cleaned_text:
+            fields[tokenizer.TAG_FIELDS.get(tag.name, "body")].append(cleaned_text)
+    return fields
+
+
+def benchmark_extraction(args):
+    """
+    Compares the text extracted by tokenizer.extract_text with the previous find_all extraction, on pages of nested
+    divs built from the test sentences, with navigation and scripts.
+    """
+    import html
+
+    from bs4 import BeautifulSoup
+
+    import tokenizer
+
+    rng = np.random.default_rng(42)
+
+    def block(depth: int) -> str:
+        if depth == 0:
+            sentences = [html.escape(sentence) for sentence in rng.choice(tokenizer.test_sentences, size=3)]
+            return f"<p>{sentences[0]} <a href='#'>{sentences[1]}</a> <span><b>{sentences[2]}</b></span></p>"
+        children = "".join(block(depth - 1) for _ in range(2))
+        return f"<div><h3>Section {depth}</h3>{children}</div>"
+
+    pages = [
+        BeautifulSoup(
+            "<html><head><script>var tracking = 1;</script><style>p { color: red; }</style></head><body>"
+            "<nav><ul><li><a href='/'>Home</a></li><li><a href='/news'>News</a></li></ul></nav>"
+            f"{block(int(rng.integers(1, 7)))}</body></html>",
+            "lxml",
+        ).body
+        for _ in range(args.queries)
+    ]
+
+    characters = {}
+    for name, extract in [("find_all", find_all_text), ("extract_text", tokenizer.extract_text)]:
+        latencies, num_characters = [], 0
+        for page in pages:
+            start = time.perf_counter()
+            fields = extract(page)
+            latencies.append(time.perf_counter() - start)
+            num_characters += sum(len(text) for texts in fields.values() for text in texts)
+        report(name, latencies)
+        characters[name] = num_characters
+        print(f"{name:<24} {num_characters:,} characters")
+
+    print(f"extract_text produces {1 - characters['extract_text'] / characters['find_all']:.1%} less text")
+
+
+BENCHMARKS = {
+    "index": benchmark_index,
+    "scoring": benchmark_scoring,
+    "topk": benchmark_topk,
+    "scaling": benchmark_scaling,
+    "dense": benchmark_dense,
+    "shards": benchmark_shards,
+    "normalizer": benchmark_normalizer,
+    "lexicon": benchmark_lexicon,
+    "pipe": benchmark_pipe,
+    "extraction": benchmark_extraction,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks on a synthetic index")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys(), help="Benchmark to run")
+    parser.add_argument(
+        "--docs", help="Number of documents", default=10_000, type=int
+    )
+    parser.add_argument(
+        "--vocab", help="Number of distinct words", default=20_000, type=int
+    )
+    parser.add_argument(
+        "--queries", help="Number of queries", default=50, type=int
+    )
+    parser.add_argument(
+        "--shards",
+        help="Numbers of shards to compare",
+        default=[1, 2, 4],
+        type=int,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--clients", help="Number of concurrent clients", default=8, type=int
+    )
+    parser.add_argument(
+        "-k", help="Number of documents per query", default=100, type=int
+    )
+    parser.add_argument(
+        "--processes",
+        help="Numbers of spaCy processes to compare",
+        default=[1, 2],
+        type=int,
+        nargs="+",
+    )
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
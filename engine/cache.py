@@ -0,0 +1,123 @@
+"""
+Bounded in-memory caches of the query path.
+
+The caches are least recently used caches with an optional time to live and memory cap. They are shared by the
+threads of the server, so every access takes a lock. A cache can be tied to a generation, e.g. the version of the
+index, and is emptied when the generation changes.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def deep_sizeof(value) -> int:
+    """
+    Approximate memory use of a value in bytes, including the values it contains. Shared values are counted each
+    time they occur.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(key) + deep_sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item) for item in value)
+    return size
+
+
+class LRUCache:
+    """
+    Least recently used cache, bounded by the number of entries and optionally by their memory use. Entries older
+    than the time to live are not returned.
+    """
+
+    def __init__(
+        self, max_entries: int, ttl: float = None, max_bytes: int = None, sizeof=deep_sizeof
+    ):
+        """
+        Args:
+            max_entries: Maximum number of entries
+            ttl: Seconds after which an entry expires, never if None
+            max_bytes: Maximum memory use of the entries as measured by sizeof, unbounded if None
+            sizeof: Function returning the memory use of an entry
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        # Key -> (value, size, insertion time), least recently used first
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        Get the value of a key and mark it as recently used. Returns default if the key is missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Add or replace the value of a key, evicting the least recently used entries if the cache is full. Values
+        larger than the memory cap are not cached.
+        """
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, time.monotonic())
+            self.num_bytes += size
+            while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and self.num_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.num_bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def check_generation(self, generation):
+        """
+        Empty the cache if the generation changed since the last check, so no entry of a previous generation is
+        returned.
+        """
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.num_bytes = 0
+                self.generation = generation
+
+    def stats(self) -> dict:
+        """
+        Returns: Number of hits, misses and entries, and the memory use of the entries
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.num_bytes,
+            }
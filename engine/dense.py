@@ -0,0 +1,134 @@
+"""
+Dense retrieval over document embeddings.
+
+Every document is embedded as the tf-idf weighted mean of the vectors of its words in the embedding store, see
+similarity.EmbeddingStore. A query is embedded as the mean of the vectors of its terms, so one matrix-vector product
+scores all documents, including documents that contain none of the query terms but similar words.
+"""
+import duckdb
+import numpy as np
+import pandas as pd
+
+from similarity import EmbeddingStore, file_version, get_embeddings, load_matrix, save_matrix
+
+# Normalized float32 embeddings of the documents, see similarity.save_matrix. float32 keeps the matrix-vector
+# product on the BLAS routines, which float16 is not.
+DOCUMENT_EMBEDDING_FILE = "document_embeddings.npy"
+# Number of postings whose word vectors are summed at once
+EMBEDDING_CHUNK_SIZE = 100_000
+
+document_embeddings = None  # Global accessor for the memory-mapped document embeddings
+
+
+class DocumentEmbeddings:
+    """
+    Read-only, memory-mapped embeddings of the documents.
+    """
+
+    def __init__(self, path: str = DOCUMENT_EMBEDDING_FILE):
+        self.vectors, doc_ids, self.version = load_matrix(path)
+        self.doc_ids = np.array(doc_ids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def search(self, query_vector: np.ndarray, n: int) -> list[tuple]:
+        """
+        Score all documents by the cosine similarity of their embedding with the query embedding.
+        Args:
+            query_vector: Normalized query embedding
+            n: Number of documents
+
+        Returns: Pairs of document and similarity of the n most similar documents, best first
+        """
+        n = min(n, len(self.doc_ids))
+        if n <= 0:
+            return []
+        scores = self.vectors @ query_vector.astype(np.float32)
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return list(zip(self.doc_ids[top].tolist(), scores[top].tolist()))
+
+
+def get_document_embeddings() -> DocumentEmbeddings | None:
+    """
+    Get the document embeddings, mapping them on first use and again when they were rebuilt. Returns None if they
+    were not built yet.
+    """
+    global document_embeddings
+    version = file_version(DOCUMENT_EMBEDDING_FILE)
+    if version is None:
+        return None
+    if document_embeddings is None or document_embeddings.version != version:
+        document_embeddings = DocumentEmbeddings()
+    return document_embeddings
+
+
+def embed_query(terms: list[str], store: EmbeddingStore) -> np.ndarray | None:
+    """
+    Embed a query as the normalized mean of the vectors of its terms. The terms are lowercased like the words of the
+    store.
+    Args:
+        terms: Query terms
+        store: Word vectors
+
+    Returns: Query embedding, None if no term has a vector
+    """
+    vectors = [vector for vector in map(store.vector, map(str.lower, terms)) if vector is not None]
+    if not vectors:
+        return None
+    vector = np.mean(vectors, axis=0)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+def build_document_embeddings(
+    dbcon: duckdb.DuckDBPyConnection,
+    store: EmbeddingStore = None,
+    path: str = DOCUMENT_EMBEDDING_FILE,
+):
+    """
+    Embed every live document as the tf-idf weighted mean of the vectors of its words and write the embeddings.
+    Skipped if there is no embedding store yet, see main.py --synonyms.
+    Args:
+        dbcon: Database connection
+        store: Word vectors, the embedding store if None
+        path: File of the document embeddings
+
+    Returns: None
+    """
+    store = store if store is not None else get_embeddings()
+    if store is None:
+        print("No embedding store, skipping the document embeddings")
+        return
+
+    # Postings of the words with a vector, by document
+    df_store = pd.DataFrame({"word": store.words, "row": np.arange(len(store.words))})
+    df_postings = dbcon.execute(
+        """
+        SELECT t.doc, s.row, t.tf * GREATEST(i.idf, 0) AS weight
+        FROM   tfs AS t, words AS w, idfs AS i, df_store AS s
+        WHERE  w.id = t.word AND i.word = t.word AND s.word = w.word
+               AND t.doc NOT IN (SELECT doc FROM tombstones)
+        ORDER BY t.doc
+    """
+    ).df()
+    docs = df_postings["doc"].to_numpy(dtype=np.int64)
+    rows = df_postings["row"].to_numpy(dtype=np.int64)
+    weights = df_postings["weight"].fillna(0).to_numpy(dtype=np.float32)
+
+    doc_ids, doc_rows = np.unique(docs, return_inverse=True)
+    embeddings = np.zeros((len(doc_ids), store.vectors.shape[1]), dtype=np.float32)
+    for start in range(0, len(docs), EMBEDDING_CHUNK_SIZE):
+        end = start + EMBEDDING_CHUNK_SIZE
+        chunk_docs = doc_rows[start:end]
+        # The postings are sorted by document, so each document is one run of the chunk
+        runs = np.flatnonzero(np.diff(chunk_docs, prepend=-1))
+        weighted = store.vectors[rows[start:end]].astype(np.float32) * weights[start:end, None]
+        embeddings[chunk_docs[runs]] += np.add.reduceat(weighted, runs, axis=0)
+
+    # Normalized, so the matrix-vector product gives the cosine similarity
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings /= np.where(norms > 0, norms, 1)
+    save_matrix(path, embeddings, doc_ids.tolist())
+    print(f"Embedded {len(doc_ids)} documents into {path}")
@@ -1,10 +1,21 @@
+import hashlib
 import lzma
 import pickle
 
 import duckdb
+import pandas as pd
 from bs4 import BeautifulSoup
 
+from index import delete_documents
 from pipeline import PipelineElement
+from tokenizer import content_hash, extract_fields
+
+
+def blob_hash(blob: bytes) -> str:
+    """
+    Returns: Hash of a crawled page as stored, which is much cheaper than decompressing and parsing it
+    """
+    return hashlib.sha256(blob).hexdigest()
 
 
 class Downloader(PipelineElement):
@@ -23,21 +34,32 @@ class Downloader(PipelineElement):
             print(f"Failed to process {link}. Invalid or empty data.")
             return
 
+        # A re-crawled page replaces the stored one
         self.cursor.execute(
-            """INSERT INTO crawled(link, content) VALUES (?, ?)""",
+            """INSERT OR REPLACE INTO crawled(link, content) VALUES (?, ?)""",
             [link, lzma.compress(pickle.dumps(data))],
         )
 
 
 class Loader(PipelineElement):
-    def __init__(self, dbcon: duckdb.DuckDBPyConnection):
+    def __init__(
+        self, dbcon: duckdb.DuckDBPyConnection, segments=None, version: str = None
+    ):
         super().__init__("Loader")
+        self.dbcon = dbcon
         self.cursor = dbcon.cursor()
 
-        self.cursor.execute("TRUNCATE TFs")
-        self.cursor.execute("TRUNCATE IDFs")
-        self.cursor.execute("TRUNCATE words")
-        self.cursor.execute("TRUNCATE documents")
+        # Index segments, the rebuilt segments replace the live ones once all pages are loaded
+        self.segments = segments
+        # Documents up to this id belong to the previous index
+        self.rebuild_from = None
+        # Tokenizer version when reindexing: only the pages whose content or tokenizer version changed are loaded,
+        # instead of rebuilding the whole index
+        self.version = version
+        # Blob hash of each loaded page, recorded with its new document by finish, and the highest document id
+        # before the pages were loaded
+        self.loaded = {}
+        self.loaded_after = None
 
         # Get pages from the database
         self.cursor.execute(
@@ -55,14 +77,146 @@ class Loader(PipelineElement):
     async def process(self):
         """
         Loads the BeautifulSoup object from a file, one at a time.
+        The previous index keeps serving queries until the rebuild is finished.
         """
+        if self.version is not None:
+            await self.reindex()
+            return
+
+        cursor = self.dbcon.cursor()
+        self.rebuild_from = cursor.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM documents"
+        ).fetchone()[0]
+        cursor.close()
+        self.loaded_after = self.rebuild_from
+        if self.segments is not None:
+            self.segments.begin_rebuild()
 
         # Add the pages to the task queue
         while self.pages:
             link, blob = self.pages.pop()
+            self.loaded[link] = blob_hash(blob)
 
             soup = pickle.loads(lzma.decompress(blob))
             if soup is not None:
                 await self.propagate_to_next(soup, link)
 
             print(f"Loaded {link}: {soup.title.string if soup.title else 'No title'}")
+
+    async def reindex(self):
+        """
+        Loads the pages whose live document was produced from other content or by another tokenizer version. The
+        new documents replace the previous ones like re-crawled pages, the other documents are left untouched.
+        A page whose blob is the one its document was produced from is skipped without decompressing it.
+        """
+        cursor = self.dbcon.cursor()
+        self.loaded_after = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM documents").fetchone()[0]
+        versions = {
+            link: (document_hash, version, document_blob_hash)
+            for link, document_hash, version, document_blob_hash in cursor.execute(
+                """
+                SELECT d.link, v.content_hash, v.tokenizer_version, v.blob_hash
+                FROM   documents AS d, document_versions AS v
+                WHERE  v.doc = d.id AND d.id NOT IN (SELECT doc FROM tombstones)
+            """
+            ).fetchall()
+        }
+        cursor.close()
+
+        num_unchanged = 0
+        unchanged = {}
+        while self.pages:
+            link, blob = self.pages.pop()
+            document_hash, version, document_blob_hash = versions.get(link, (None, None, None))
+            page_hash = blob_hash(blob)
+            if version == self.version and document_blob_hash == page_hash:
+                num_unchanged += 1
+                continue
+
+            soup = pickle.loads(lzma.decompress(blob))
+            if soup is None:
+                continue
+            if version == self.version and document_hash == content_hash(extract_fields(soup)):
+                # E.g. crawled again without changes, the blob hash is recorded so it is skipped cheaply next time
+                unchanged[link] = page_hash
+                num_unchanged += 1
+                continue
+            self.loaded[link] = page_hash
+
+            await self.propagate_to_next(soup, link)
+            print(f"Loaded {link}: {soup.title.string if soup.title else 'No title'}")
+
+        self.record_blob_hashes(unchanged)
+        print(f"Reindexing done, {num_unchanged} pages were unchanged")
+
+    def finish(self):
+        """
+        Replaces the previous index by the rebuilt one, deleting the previous documents. They are only tombstoned
+        after the rebuilt segments were committed, as the previous segments serve them until then. If not all pages
+        were loaded, the rebuilt documents are deleted instead and the previous index is kept. The deleted documents
+        are removed by index.compact.
+        """
+        if self.rebuild_from is None:
+            self.record_blob_hashes(self.loaded, self.loaded_after)
+            return
+
+        cursor = self.dbcon.cursor()
+        if self.pages:
+            print(f"Rebuild incomplete ({len(self.pages)} pages left), keeping the previous index")
+            if self.segments is not None:
+                self.segments.abort_rebuild()
+
+            # The previous versions of the reindexed pages are live again, without segments they were deleted
+            # right away
+            cursor.execute(
+                """
+                DELETE FROM tombstones
+                WHERE  doc IN (SELECT old.id
+                               FROM   documents AS old, documents AS new
+                               WHERE  old.id <= ? AND new.id > ? AND old.link = new.link)
+            """,
+                [self.rebuild_from, self.rebuild_from],
+            )
+            condition = "> ?"
+        else:
+            # Switch the queries to the new segments before deleting the old documents
+            if self.segments is not None:
+                self.segments.commit_rebuild()
+            condition = "<= ?"
+
+        deleted = cursor.execute(
+            f"SELECT id FROM documents WHERE id {condition}", [self.rebuild_from]
+        ).fetchall()
+        delete_documents(cursor, [doc_id for doc_id, in deleted])
+        cursor.close()
+        self.rebuild_from = None
+        # The documents of an incomplete rebuild were deleted, so only the ones of a complete rebuild are recorded
+        self.record_blob_hashes(self.loaded, self.loaded_after)
+
+    def record_blob_hashes(self, hashes: dict[str, str], after: int = 0):
+        """
+        Records the blob hash of pages with the live document of their link, so --reindex skips them without
+        decompressing them while their blob stays the same.
+        Args:
+            hashes: Blob hash of each link
+            after: Only record it with the documents with higher ids, e.g. the ones produced from the loaded pages.
+                The previous document of a page that failed to be tokenized was produced from another blob.
+
+        Returns: None
+        """
+        if not hashes:
+            return
+        # DataFrame to directly query in DuckDB
+        df_hashes = pd.DataFrame({"link": list(hashes), "blob_hash": list(hashes.values())})
+        cursor = self.dbcon.cursor()
+        cursor.execute(
+            """
+            UPDATE document_versions AS v
+            SET    blob_hash = h.blob_hash
+            FROM   documents AS d, df_hashes AS h
+            WHERE  v.doc = d.id AND d.link = h.link AND d.id > ? AND d.id NOT IN (SELECT doc FROM tombstones)
+        """,
+            [after or 0],
+        )
+        cursor.close()
+        hashes.clear()
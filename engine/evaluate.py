@@ -0,0 +1,341 @@
+#!.venv/bin/python
+# -*- coding: utf-8 -*-
+"""
+Latency and relevance regression test of the ranking.
+
+The queries of a query file are ranked against a fixed test index, i.e. a directory with a crawlies.db and its index/,
+and the latency of every phase of the ranking is measured: the expansion of the query, fetching the postings, scoring
+and fetching the documents. With relevance judgements (qrels), the rankings are scored by nDCG and MRR as well. The
+results are compared with a stored baseline, and the test fails if a phase got slower or the ranking got worse.
+
+With --fixture, the test index is the synthetic index of benchmark.py, which is the same on every machine, with the
+hand-written documents of FIXTURE_DOCUMENTS and the similar words of FIXTURE_SYNONYMS added. The synthetic queries of
+FIXTURE_QUERIES load the index, its hand-written queries are judged by hand in FIXTURE_QRELS.
+Run `python evaluate.py --help` to see the options.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+# Phases of the ranking of a query, in order
+PHASES = ["expansion", "postings", "scoring", "documents"]
+PERCENTILES = [50, 95, 99]
+
+# Number of documents ranked per query and judged by nDCG
+EVALUATION_DEPTH = 10
+
+# A phase regresses if its p50 or p95 latency grows by more than this fraction and by more than the slack, so the
+# noise of fast phases doesn't fail the test
+LATENCY_TOLERANCE = 0.25
+LATENCY_SLACK = 0.5  # Milliseconds
+# The ranking regresses if the nDCG or MRR drops by more than this
+QUALITY_TOLERANCE = 0.01
+
+BASELINE_FILE = "evaluation_baseline.json"
+
+# Synthetic test index of --fixture, see benchmark.create_synthetic_index
+FIXTURE_DOCS = 5_000
+FIXTURE_VOCAB = 10_000
+# Files of the fixture, next to this file. The documents have a link, a title and a body of lemmatized words per line,
+# the synonyms a word, a similar word and their similarity, all separated by tabs.
+FIXTURE_DOCUMENTS = "evaluation_documents.tsv"
+FIXTURE_SYNONYMS = "evaluation_synonyms.tsv"
+FIXTURE_QUERIES = "evaluation_queries.txt"
+FIXTURE_QRELS = "evaluation_qrels.txt"
+
+
+def read_qrels(filepath: str) -> dict[str, dict[str, int]]:
+    """
+    Read relevance judgements in the TREC format, a judgement per line: query number, iteration (ignored), URL of the
+    document and its relevance, e.g. `3 0 https://www.tuebingen.de/ 2`. URLs are used instead of document ids, as
+    those change when pages are crawled again.
+
+    Returns: Relevance of the judged documents of each query, by query number
+    """
+    qrels = {}
+    with open(filepath, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            number, _, url, relevance = line.split()
+            qrels.setdefault(number, {})[url] = int(relevance)
+    return qrels
+
+
+def read_numbered_queries(filepath: str) -> list[tuple[str, str]]:
+    """
+    Read the queries of a file with a numbered query per line, see rank.read_queries.
+
+    Returns: Pairs of query number and query
+    """
+    queries = []
+    with open(filepath, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                number, query = line.strip().split(maxsplit=1)
+                queries.append((number, query))
+    return queries
+
+
+def ndcg(urls: list[str], relevance: dict[str, int], depth: int = EVALUATION_DEPTH) -> float:
+    """
+    Normalized discounted cumulative gain of a ranking at the given depth, with the gain 2^relevance - 1.
+    """
+    def dcg(relevances):
+        relevances = np.asarray(relevances[:depth], dtype=np.float64)
+        return float(((2**relevances - 1) / np.log2(np.arange(2, len(relevances) + 2))).sum())
+
+    ideal = dcg(sorted(relevance.values(), reverse=True))
+    return dcg([relevance.get(url, 0) for url in urls]) / ideal if ideal > 0 else 0.0
+
+
+def reciprocal_rank(urls: list[str], relevance: dict[str, int]) -> float:
+    """
+    Reciprocal rank of the first relevant document of a ranking, 0 if there is none.
+    """
+    for position, url in enumerate(urls, start=1):
+        if relevance.get(url, 0) > 0:
+            return 1 / position
+    return 0.0
+
+
+def rank_phases(query: str, ranking: str, k: int) -> tuple[list[str], dict[str, float]]:
+    """
+    Rank a query like rank.rank without the result cache and the shards, timing each phase. The query caches are
+    emptied first, so the expansion is measured and not a cache lookup.
+
+    Returns: URLs of the ranked documents and the seconds spent in each phase
+    """
+    import rank
+
+    rank.analysis_cache.clear()
+    rank.expansion_cache.clear()
+    timings = {}
+
+    with rank.borrow_cursor() as con:
+        start = time.perf_counter()
+        prepared = rank.prepare_query(rank.normalize_query(query))
+        timings["expansion"] = time.perf_counter() - start
+
+        scores = rank.SCORING_FUNCTIONS[ranking](con, prepared, index=rank.get_index(), k=k, timings=timings)
+
+        start = time.perf_counter()
+        documents = rank.fetch_ranking(con, scores)
+        timings["documents"] = time.perf_counter() - start
+    return [document["url"] for document in documents], timings
+
+
+def evaluate(queries: list[tuple[str, str]], qrels: dict, ranking: str, k: int, repeat: int) -> dict:
+    """
+    Rank every query repeat times, after a run to load the models and warm the index.
+
+    Returns: Latency percentiles of each phase in milliseconds and, with qrels, the mean nDCG and MRR
+    """
+    from tokenizer import get_nlp
+
+    get_nlp()
+    for _, query in queries:
+        rank_phases(query, ranking, k)
+
+    latencies = {phase: [] for phase in PHASES + ["total"]}
+    rankings = {}
+    for _ in range(repeat):
+        for number, query in queries:
+            rankings[number], timings = rank_phases(query, ranking, k)
+            for phase in PHASES:
+                latencies[phase].append(timings[phase])
+            latencies["total"].append(sum(timings.values()))
+
+    result = {
+        "ranking": ranking,
+        "queries": len(queries),
+        "latency": {
+            phase: dict(zip(map(str, PERCENTILES), np.percentile(np.array(values) * 1000, PERCENTILES).tolist()))
+            for phase, values in latencies.items()
+        },
+    }
+
+    judged = [number for number, _ in queries if number in qrels]
+    if judged:
+        result["judged"] = len(judged)
+        result["ndcg"] = float(np.mean([ndcg(rankings[number], qrels[number]) for number in judged]))
+        result["mrr"] = float(np.mean([reciprocal_rank(rankings[number], qrels[number]) for number in judged]))
+    return result
+
+
+def compare(result: dict, baseline: dict) -> list[str]:
+    """
+    Compare a result with the baseline.
+
+    Returns: Description of every regression, empty if there is none
+    """
+    regressions = []
+    for phase, percentiles in result["latency"].items():
+        for percentile in ("50", "95"):
+            before = baseline["latency"].get(phase, {}).get(percentile)
+            after = percentiles[percentile]
+            if before is not None and after > before * (1 + LATENCY_TOLERANCE) and after - before > LATENCY_SLACK:
+                regressions.append(f"{phase} p{percentile} latency {before:.2f} ms -> {after:.2f} ms")
+    for metric in ("ndcg", "mrr"):
+        if metric in baseline and metric in result and result[metric] < baseline[metric] - QUALITY_TOLERANCE:
+            regressions.append(f"{metric} {baseline[metric]:.4f} -> {result[metric]:.4f}")
+    return regressions
+
+
+def report(result: dict, baseline: dict = None):
+    """
+    Print the latency percentiles and relevance of a result, next to the baseline if given.
+    """
+    print(f"{result['queries']} queries ranked by {result['ranking']}")
+    for phase, percentiles in result["latency"].items():
+        line = f"{phase:<12}" + "".join(f"   p{percentile} {value:8.3f} ms" for percentile, value in percentiles.items())
+        if baseline is not None and phase in baseline["latency"]:
+            line += (
+                "   (baseline"
+                + "".join(f" p{percentile} {value:.3f}" for percentile, value in baseline["latency"][phase].items())
+                + ")"
+            )
+        print(line)
+    for metric in ("ndcg", "mrr"):
+        if metric in result:
+            line = f"{metric:<12}   {result[metric]:.4f}"
+            if baseline is not None and metric in baseline:
+                line += f"   (baseline {baseline[metric]:.4f})"
+            print(line)
+
+
+def add_fixture_documents(dbcon: duckdb.DuckDBPyConnection, documents_path: str, synonyms_path: str):
+    """
+    Add the hand-written documents of the fixture to the synthetic index, after its documents and words, and fill
+    the synonyms table with the similar words of the fixture, so the query expansion neither loads nor downloads the
+    word vectors. The words of the documents are already lemmatized, so they are not run through spaCy.
+    """
+    from index import compute_statistics
+    from tokenizer import FIELDS
+
+    df_documents = pd.read_csv(documents_path, sep="\t", names=["link", "title", "body"], keep_default_na=False)
+    first_doc, first_word = dbcon.execute(
+        "SELECT (SELECT MAX(id) FROM documents) + 1, (SELECT MAX(id) FROM words) + 1"
+    ).fetchone()
+    df_documents["id"] = np.arange(first_doc, first_doc + len(df_documents))
+
+    # Term frequency of each word in each field of each document
+    counts = {}
+    lengths = []
+    for doc, title, body in zip(df_documents["id"], df_documents["title"], df_documents["body"]):
+        field_lengths = [0] * len(FIELDS)
+        for field, text in (("title", title), ("body", body)):
+            words = text.split()
+            field_lengths[FIELDS.index(field)] = len(words)
+            for word in words:
+                counts.setdefault((word, int(doc)), [0] * len(FIELDS))[FIELDS.index(field)] += 1
+        lengths.append((int(doc), sum(field_lengths), field_lengths))
+
+    words = sorted({word for word, _ in counts})
+    df_words = pd.DataFrame({"word": words, "id": np.arange(first_word, first_word + len(words))})
+    word_ids = dict(zip(df_words["word"], df_words["id"]))
+    df_tfs = pd.DataFrame(
+        [(word_ids[word], doc, sum(field_tfs), field_tfs) for (word, doc), field_tfs in counts.items()],
+        columns=["word", "doc", "tf", "field_tfs"],
+    )
+    df_lengths = pd.DataFrame(lengths, columns=["doc", "length", "field_lengths"])
+    df_synonyms = pd.read_csv(synonyms_path, sep="\t", names=["word", "synonym", "similarity"])
+
+    dbcon.execute("INSERT INTO words(word, id) SELECT word, id FROM df_words")
+    dbcon.execute(
+        "INSERT INTO documents(id, link, title, description) SELECT id, link, title, body FROM df_documents"
+    )
+    dbcon.execute("INSERT INTO TFs(word, doc, tf, field_tfs) SELECT word, doc, tf, field_tfs FROM df_tfs")
+    dbcon.execute("INSERT INTO doc_lengths(doc, length, field_lengths) SELECT * FROM df_lengths")
+    dbcon.execute("INSERT INTO synonyms SELECT word, synonym, similarity FROM df_synonyms")
+    compute_statistics(dbcon)
+    print(f"Added {len(df_documents)} fixture documents and {len(df_synonyms)} synonyms")
+
+
+def build_fixture(directory: str, documents_path: str, synonyms_path: str):
+    """
+    Build the test index of --fixture into a directory: its crawlies.db, with the synthetic documents and the
+    hand-written ones, and an index segment exported from it. The index is the same for the same fixture files,
+    FIXTURE_DOCS and FIXTURE_VOCAB, so the judgements of FIXTURE_QRELS stay valid.
+    """
+    from benchmark import create_synthetic_index
+    from segments import INDEX_DIRECTORY, SegmentManager
+
+    os.makedirs(directory, exist_ok=True)
+    con = duckdb.connect(os.path.join(directory, "crawlies.db"))
+    create_synthetic_index(con, num_docs=FIXTURE_DOCS, vocab_size=FIXTURE_VOCAB)
+    add_fixture_documents(con, documents_path, synonyms_path)
+    segments = SegmentManager(con, directory=os.path.join(directory, INDEX_DIRECTORY))
+    segments.export(con)
+    segments.close()
+    con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and relevance regression test of the ranking")
+    parser.add_argument(
+        "--index", help="Directory of the test index, with crawlies.db and index/", required=True, type=str
+    )
+    parser.add_argument(
+        "--fixture",
+        help="Evaluate on the synthetic test index, which is built into --index first if it has no database yet, "
+        f"with the queries of {FIXTURE_QUERIES} and the judgements of {FIXTURE_QRELS}",
+        action="store_true",
+    )
+    parser.add_argument("--queries", help="Queries file, queries.txt by default", default=None, type=str)
+    parser.add_argument("--qrels", help="Relevance judgements in the TREC format", default=None, type=str)
+    parser.add_argument("--baseline", help="Baseline file", default=BASELINE_FILE, type=str)
+    parser.add_argument("--save-baseline", help="Store the result as the new baseline", action="store_true")
+    parser.add_argument("--ranking", help="Ranking function", default="bm25", choices=["bm25", "bm25f"])
+    parser.add_argument("-k", help="Number of documents per query", default=EVALUATION_DEPTH, type=int)
+    parser.add_argument("--repeat", help="Number of runs over the queries", default=5, type=int)
+    args = parser.parse_args()
+
+    if args.fixture:
+        # The fixture files are next to this file, the index is built from setup.sql of the working directory
+        here = os.path.dirname(os.path.abspath(__file__))
+        args.queries = args.queries or os.path.join(here, FIXTURE_QUERIES)
+        args.qrels = args.qrels or os.path.join(here, FIXTURE_QRELS)
+        if not os.path.exists(os.path.join(args.index, "crawlies.db")):
+            build_fixture(args.index, os.path.join(here, FIXTURE_DOCUMENTS), os.path.join(here, FIXTURE_SYNONYMS))
+
+    queries = read_numbered_queries(args.queries or "queries.txt")
+    qrels = read_qrels(args.qrels) if args.qrels else {}
+    baseline_path = os.path.abspath(args.baseline)
+    # The ranking opens the database and the index relative to the working directory
+    os.chdir(args.index)
+
+    result = evaluate(queries, qrels, args.ranking, args.k, args.repeat)
+
+    if args.save_baseline:
+        report(result)
+        with open(baseline_path, "w") as file:
+            json.dump(result, file, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+        return
+
+    if not os.path.exists(baseline_path):
+        report(result)
+        print(f"No baseline at {baseline_path}, store one with --save-baseline")
+        return
+
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+    report(result, baseline)
+    regressions = compare(result, baseline)
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
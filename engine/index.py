@@ -1,6 +1,27 @@
 import duckdb
+import pandas as pd
 
 from pipeline import PipelineElement
+from tokenizer import FIELDS
+
+# BM25F weight of each field
+FIELD_WEIGHTS = {
+    "title": 3.0,
+    "description": 2.0,
+    "headings": 2.0,
+    "body": 1.0,
+    "alt": 0.5,
+}
+# BM25F length normalization of each field
+FIELD_B = {
+    "title": 0.5,
+    "description": 0.5,
+    "headings": 0.75,
+    "body": 0.75,
+    "alt": 0.5,
+}
+# Share of deleted documents from which on compact removes them from the database
+COMPACTION_THRESHOLD = 0.1
 
 
 class Indexer(PipelineElement):
@@ -8,11 +29,14 @@ class Indexer(PipelineElement):
     Adds the data to the index.
     """
 
-    def __init__(self, dbcon: duckdb.DuckDBPyConnection):
+    def __init__(self, dbcon: duckdb.DuckDBPyConnection, segments=None):
         super().__init__("Indexer")
 
         self.cursor = dbcon.cursor()
 
+        # Index segments, they hide the previous versions of a page
+        self.segments = segments
+
     def __del__(self):
         self.cursor.close()
 
@@ -37,24 +61,213 @@ class Indexer(PipelineElement):
             description.get("content") if description is not None else ""
         )
 
-        self.cursor.execute(
+        # Upsert by link: the new version replaces the live versions of the page
+        previous = find_documents(self.cursor, link)
+        doc_id = self.cursor.execute(
             """
             INSERT INTO documents(link, title, description)
             VALUES (?, ?, ?)
+            RETURNING id
         """,
             [link, title_content, description_content],
-        )
-
-        doc_id = self.cursor.execute(
-            """
-            SELECT id FROM documents WHERE link = ?
-        """,
-            [link],
         ).fetchone()[0]
 
+        # During a rebuild the previous segments keep serving the previous versions, the Loader deletes them with
+        # all documents of the previous index once the rebuild is committed
+        if previous and not (self.segments is not None and self.segments.rebuilding):
+            delete_documents(self.cursor, previous)
+            if self.segments is not None:
+                # Hidden with the next flushed segment, which normally holds the new version
+                self.segments.delete_documents(previous, immediately=False)
+
         print(
             f"Indexed {link} as document {doc_id} ({self.task_queue.qsize()} tasks left)"
         )
 
         if not self.is_shutdown():
             await self.propagate_to_next(soup, doc_id, link)
+
+
+def find_documents(dbcon: duckdb.DuckDBPyConnection, link: str) -> list[int]:
+    """
+    Finds the live (not deleted) documents of a link.
+    Args:
+        dbcon: Database connection
+        link: Link of the page
+
+    Returns: Ids of the documents
+    """
+    return [
+        doc_id
+        for doc_id, in dbcon.execute(
+            """
+            SELECT id FROM documents
+            WHERE  link = ? AND id NOT IN (SELECT doc FROM tombstones)
+        """,
+            [link],
+        ).fetchall()
+    ]
+
+
+def delete_documents(dbcon: duckdb.DuckDBPyConnection, doc_ids: list[int]):
+    """
+    Deletes documents by adding tombstones, which the ranking filters until compact removes the documents.
+    The document frequencies are updated right away.
+    Args:
+        dbcon: Database connection
+        doc_ids: Ids of the documents
+
+    Returns: None
+    """
+    # DataFrame to directly query in DuckDB
+    df_deleted = pd.DataFrame({"doc": doc_ids}).drop_duplicates()
+    df_deleted = dbcon.execute(
+        "SELECT doc FROM df_deleted WHERE doc NOT IN (SELECT doc FROM tombstones)"
+    ).df()
+    if df_deleted.empty:
+        return
+
+    dbcon.execute(
+        """
+        UPDATE IDFs AS i
+        SET    df = i.df - d.df
+        FROM   (SELECT word, COUNT(*) AS df
+                FROM   TFs
+                WHERE  doc IN (SELECT doc FROM df_deleted)
+                GROUP BY word) AS d
+        WHERE  i.word = d.word
+    """
+    )
+    dbcon.execute("INSERT INTO tombstones(doc) SELECT doc FROM df_deleted")
+
+
+def compact(dbcon: duckdb.DuckDBPyConnection, threshold: float = COMPACTION_THRESHOLD):
+    """
+    Removes the deleted documents from the database, once they make up a share of the documents that is worth
+    scanning the whole tables for. Until then the queries filter them by their tombstones.
+    Args:
+        dbcon: Database connection
+        threshold: Share of deleted documents from which on they are removed, 0 removes them in any case
+
+    Returns: None
+    """
+    num_deleted, num_documents = dbcon.execute(
+        "SELECT (SELECT COUNT(*) FROM tombstones), (SELECT COUNT(*) FROM documents)"
+    ).fetchone()
+    if not num_deleted or num_deleted < threshold * num_documents:
+        return
+
+    for table, column in [
+        ("TFs", "doc"),
+        ("doc_lengths", "doc"),
+        ("document_versions", "doc"),
+        ("documents", "id"),
+    ]:
+        dbcon.execute(
+            f"DELETE FROM {table} WHERE {column} IN (SELECT doc FROM tombstones)"
+        )
+    dbcon.execute("DELETE FROM IDFs WHERE df <= 0")
+    dbcon.execute("TRUNCATE tombstones")
+    print(f"Compacted {num_deleted} deleted documents")
+
+
+def field_averages(dbcon: duckdb.DuckDBPyConnection) -> tuple:
+    """
+    Average number of tokens of each field, used for the BM25F length normalization.
+    Args:
+        dbcon: Database connection
+
+    Returns: Average length per field, in the order of FIELDS (None if there are no documents)
+    """
+    return dbcon.execute(
+        "SELECT "
+        + ", ".join(f"AVG(field_lengths[{i + 1}])" for i in range(len(FIELDS)))
+        + " FROM doc_lengths WHERE doc NOT IN (SELECT doc FROM tombstones)"
+    ).fetchone()
+
+
+def compute_statistics(
+    dbcon: duckdb.DuckDBPyConnection,
+    field_weights: dict[str, float] = None,
+    field_b: dict[str, float] = None,
+    incremental: bool = False,
+):
+    """
+    Computes the collection statistics used for ranking once the documents are tokenized:
+    the IDF of each word, the BM25F weighted term frequency of each posting and the upper bounds
+    of the (weighted) term frequencies of each word, which prune top-k queries.
+    The field weights are applied here, so they add no cost at query time.
+    Args:
+        dbcon: Database connection
+        field_weights: BM25F weight of each field
+        field_b: BM25F length normalization of each field
+        incremental: Use the maintained document frequencies and only weight the new postings, instead of
+            recounting the whole index
+
+    Returns: None
+    """
+    field_weights = field_weights or FIELD_WEIGHTS
+    field_b = field_b or FIELD_B
+
+    # Count the document frequencies
+    if not incremental:
+        dbcon.execute("TRUNCATE IDFs")
+        dbcon.execute(
+            """
+            INSERT INTO IDFs(word, df)
+            SELECT word, COUNT(*)
+            FROM   TFs
+            WHERE  doc NOT IN (SELECT doc FROM tombstones)
+            GROUP BY word
+        """
+        )
+
+    # Compute IDFs over the live documents
+    dbcon.execute(
+        """
+        UPDATE IDFs
+        SET    idf = LOG(N::double / df)
+        FROM   (SELECT COUNT(*) FROM documents WHERE id NOT IN (SELECT doc FROM tombstones)) AS _(N)
+        WHERE  df > 0
+    """
+    )
+
+    averages = field_averages(dbcon)
+
+    # Weighted sum of the length-normalized field frequencies, fields that never occur are skipped
+    wtf = " + ".join(
+        f"{field_weights[field]} * t.field_tfs[{i + 1}]"
+        f" / (1 - {field_b[field]} + {field_b[field]} * l.field_lengths[{i + 1}] / {average})"
+        for i, (field, average) in enumerate(zip(FIELDS, averages))
+        if average
+    )
+    # Words whose bounds change, the ones with new postings. Postings of new documents have no weighted term
+    # frequency yet.
+    new_postings = "AND t.wtf IS NULL" if incremental else ""
+    changed = ""
+    if incremental:
+        df_changed = dbcon.execute(
+            "SELECT DISTINCT word FROM TFs WHERE wtf IS NULL"
+        ).df()
+        changed = "WHERE word IN (SELECT word FROM df_changed)"
+
+    if wtf:
+        dbcon.execute(
+            f"""
+            UPDATE TFs AS t
+            SET    wtf = {wtf}
+            FROM   doc_lengths AS l
+            WHERE  l.doc = t.doc {new_postings}
+        """
+        )
+
+    # Upper bounds of the postings of each word, deleted documents are not excluded
+    dbcon.execute(
+        f"""
+        UPDATE IDFs AS i
+        SET    max_tf = b.max_tf, max_wtf = b.max_wtf
+        FROM   (SELECT word, MAX(tf), MAX(COALESCE(wtf, tf)) FROM TFs {changed} GROUP BY word)
+               AS b(word, max_tf, max_wtf)
+        WHERE  i.word = b.word
+    """
+    )
@@ -0,0 +1,641 @@
+import mmap
+import os
+import struct
+from typing import Callable
+
+import duckdb
+import numpy as np
+
+"""
+Immutable, compressed inverted index file for serving queries.
+
+Layout of the file (little-endian):
+- header: magic, version, number of terms and documents, offsets of the sections
+- documents: sorted document ids and the length of each document (int32 arrays)
+- term dictionary: one fixed-size entry per term, sorted by term, see TERM_DTYPE
+- term strings: the UTF-8 encoded terms, in the same order as the dictionary
+- postings: per term the delta- and varint-encoded document ids, the varint-encoded term frequencies and the
+  varint-encoded (already delta-encoded) token positions
+- weighted term frequencies: BM25F term frequency of every posting (float32)
+- blocks: skip data of every BLOCK_SIZE postings of a term, see BLOCK_DTYPE
+
+The file is memory-mapped, so all processes serving queries share its pages, and the postings of a term are decoded
+straight into NumPy arrays. Top-k queries only decode the blocks that can hold documents of the top k, see
+rank.block_max_score.
+"""
+
+MAGIC = b"TUER"
+VERSION = 3
+
+# Magic, version, number of terms, number of documents, and offsets of the documents, term dictionary, term strings,
+# postings, weighted term frequencies and blocks sections
+HEADER = struct.Struct("<4sIQQQQQQQQ")
+
+# Number of postings of a block, the last block of a term may have fewer
+BLOCK_SIZE = 128
+
+TERM_DTYPE = np.dtype(
+    [
+        ("term_offset", "<u8"),  # Offset of the term in the term strings
+        ("term_length", "<u4"),
+        ("df", "<u4"),  # Number of documents containing the term
+        ("max_tf", "<u4"),  # Upper bounds of the (weighted) term frequencies, for pruning top-k queries
+        ("max_wtf", "<f4"),
+        ("idf", "<f8"),
+        ("postings_offset", "<u8"),  # Offset of the document ids in the postings
+        ("docs_length", "<u4"),  # Number of bytes of the document ids
+        ("tfs_length", "<u4"),  # Number of bytes of the term frequencies, directly after the document ids
+        ("positions_length", "<u8"),  # Number of bytes of the positions, directly after the term frequencies
+        ("wtfs_offset", "<u8"),  # Index of the first weighted term frequency of the term
+        ("blocks_offset", "<u8"),  # Index of the first block of the term
+    ]
+)
+
+BLOCK_DTYPE = np.dtype(
+    [
+        ("last_doc", "<i4"),  # Document id of the last posting, the ids of the next block are delta-encoded from it
+        ("docs_offset", "<u4"),  # Offset of the document ids of the block in those of the term
+        ("tfs_offset", "<u4"),  # Offset of the term frequencies of the block in those of the term
+        ("max_tf", "<u4"),  # Upper bounds of the (weighted) term frequencies of the block (block-max)
+        ("max_wtf", "<f4"),
+    ]
+)
+
+
+def varint_lengths(values: np.ndarray) -> np.ndarray:
+    """
+    Number of bytes each value needs as varint.
+    Args:
+        values: Non-negative integers
+
+    Returns: Number of bytes per value
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    values = values >> np.uint64(7)
+    while values.any():
+        lengths += values > 0
+        values = values >> np.uint64(7)
+    return lengths
+
+
+def varint_encode(values: np.ndarray) -> np.ndarray:
+    """
+    Encodes non-negative integers as varints (7 bits per byte, the high bit marks that another byte follows).
+    Args:
+        values: Non-negative integers
+
+    Returns: The encoded bytes
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = varint_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    encoded = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for i in range(int(lengths.max()) if len(lengths) else 0):
+        has_byte = lengths > i
+        byte = (values[has_byte] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        more = lengths[has_byte] > i + 1
+        encoded[starts[has_byte] + i] = byte | (more.astype(np.uint64) << np.uint64(7))
+    return encoded
+
+
+def varint_decode(encoded: np.ndarray) -> np.ndarray:
+    """
+    Decodes varints, see varint_encode.
+    Args:
+        encoded: The encoded bytes
+
+    Returns: The decoded integers
+    """
+    encoded = np.asarray(encoded, dtype=np.uint8)
+    if len(encoded) == 0:
+        return np.array([], dtype=np.int64)
+    # The last byte of each value has the high bit unset
+    ends = np.flatnonzero(encoded < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = (np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1)) * 7
+    payload = (encoded & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(payload, starts).astype(np.int64)
+
+
+def write_index(
+    dbcon: duckdb.DuckDBPyConnection, path: str, shard: int = 0, num_shards: int = 1
+):
+    """
+    Exports the live documents of the database into an inverted index file. For a shard, only the documents with
+    doc % num_shards == shard are exported, but the IDFs and the number of documents stay global.
+    Args:
+        dbcon: Database connection
+        path: Path of the index file
+        shard: Shard to export
+        num_shards: Number of shards
+
+    Returns: None
+    """
+    print(f"Exporting index to {path}...")
+
+    postings = dbcon.execute(
+        """
+        SELECT w.word, t.doc, t.tf, COALESCE(t.wtf, t.tf) AS wtf, COALESCE(i.idf, 0) AS idf, t.positions
+        FROM   TFs AS t
+        JOIN   words AS w ON w.id = t.word
+        LEFT JOIN IDFs AS i ON i.word = t.word
+        WHERE  t.doc % ? = ? AND t.doc NOT IN (SELECT doc FROM tombstones)
+        ORDER BY w.word, t.doc
+    """,
+        [num_shards, shard],
+    ).fetchnumpy()
+    documents = dbcon.execute(
+        """
+        SELECT doc, length FROM doc_lengths
+        WHERE  doc % ? = ? AND doc NOT IN (SELECT doc FROM tombstones)
+        ORDER BY doc
+    """,
+        [num_shards, shard],
+    ).fetchnumpy()
+    num_docs = dbcon.execute(
+        "SELECT COUNT(*) FROM documents WHERE id NOT IN (SELECT doc FROM tombstones)"
+    ).fetchone()[0]
+
+    positions = postings["positions"]
+    write_postings(
+        path,
+        words=postings["word"],
+        docs=postings["doc"],
+        tfs=postings["tf"],
+        wtfs=postings["wtf"],
+        idfs=postings["idf"],
+        positions=(
+            None
+            if np.ma.getmaskarray(positions).any()
+            else list(np.ma.getdata(positions))
+        ),
+        doc_ids=documents["doc"],
+        doc_lengths=documents["length"],
+        num_docs=num_docs,
+    )
+
+    print(
+        f"Exported {len(postings['word'])} postings of {len(documents['doc'])} documents to {path}"
+    )
+
+
+def write_postings(
+    path: str,
+    words,
+    docs,
+    tfs,
+    wtfs,
+    idfs,
+    positions,
+    doc_ids,
+    doc_lengths,
+    num_docs: int,
+):
+    """
+    Writes postings into an inverted index file. The file is written next to the target and then renamed, so
+    readers never see a partially written index.
+    Args:
+        path: Path of the index file
+        words: Word of each posting, the postings have to be sorted by word and document
+        docs: Document id of each posting
+        tfs: Term frequency of each posting
+        wtfs: BM25F weighted term frequency of each posting
+        idfs: IDF of the word of each posting
+        positions: Delta-encoded token positions of each posting, or None to store no positions
+        doc_ids: Sorted ids of the documents
+        doc_lengths: Number of tokens of each document
+        num_docs: Number of documents
+
+    Returns: None
+    """
+    words = np.asarray(words, dtype=object)
+    docs = np.asarray(docs, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+
+    # First posting of each term
+    is_start = np.ones(len(words), dtype=bool)
+    is_start[1:] = words[1:] != words[:-1]
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(words))
+    terms = words[starts]
+
+    # Delta-encode the document ids of each term, the first document id of a term is stored as is
+    doc_deltas = np.diff(docs, prepend=0)
+    doc_deltas[starts] = docs[starts]
+
+    # Number of bytes of each posting, summed up per term
+    def bytes_per_term(lengths: np.ndarray) -> np.ndarray:
+        totals = np.concatenate(([0], np.cumsum(lengths)))
+        return totals[ends] - totals[starts]
+
+    doc_delta_lengths = varint_lengths(doc_deltas)
+    tf_lengths = varint_lengths(tfs)
+    docs_lengths = bytes_per_term(doc_delta_lengths)
+    tfs_lengths = bytes_per_term(tf_lengths)
+
+    # Every BLOCK_SIZE postings of a term start a block, the first posting of a term always does. A block ends where
+    # the next one starts.
+    term_of_posting = np.cumsum(is_start) - 1
+    posting_in_term = np.arange(len(words)) - starts[term_of_posting]
+    block_starts = np.flatnonzero(posting_in_term % BLOCK_SIZE == 0)
+    block_ends = np.append(block_starts[1:], len(words))
+    block_terms = term_of_posting[block_starts]
+    doc_totals = np.concatenate(([0], np.cumsum(doc_delta_lengths)))
+    tf_totals = np.concatenate(([0], np.cumsum(tf_lengths)))
+    blocks = np.zeros(len(block_starts), dtype=BLOCK_DTYPE)
+    blocks["last_doc"] = docs[block_ends - 1]
+    blocks["docs_offset"] = doc_totals[block_starts] - doc_totals[starts[block_terms]]
+    blocks["tfs_offset"] = tf_totals[block_starts] - tf_totals[starts[block_terms]]
+    blocks["max_tf"] = np.maximum.reduceat(tfs, block_starts) if len(tfs) else []
+    blocks["max_wtf"] = (
+        np.maximum.reduceat(np.asarray(wtfs, dtype=np.float32), block_starts)
+        if len(tfs)
+        else []
+    )
+
+    # Positions are only exported if they were stored for every posting. Each posting has as many positions as its
+    # term frequency.
+    has_positions = positions is not None and len(words) > 0
+    if has_positions:
+        flat_positions = np.concatenate(positions).astype(np.int64)
+        position_totals = np.concatenate(([0], np.cumsum(varint_lengths(flat_positions))))
+        posting_bounds = np.concatenate(([0], np.cumsum(tfs)))
+        positions_lengths = (
+            position_totals[posting_bounds[ends]] - position_totals[posting_bounds[starts]]
+        )
+        encoded_positions = varint_encode(flat_positions)
+    else:
+        positions_lengths = np.zeros(len(terms), dtype=np.int64)
+
+    # Interleave the sections of each term: document ids, term frequencies, positions
+    encoded_docs = varint_encode(doc_deltas)
+    encoded_tfs = varint_encode(tfs)
+    docs_offsets = np.concatenate(([0], np.cumsum(docs_lengths)))
+    tfs_offsets = np.concatenate(([0], np.cumsum(tfs_lengths)))
+    positions_offsets = np.concatenate(([0], np.cumsum(positions_lengths)))
+    chunks = []
+    for i in range(len(terms)):
+        chunks.append(encoded_docs[docs_offsets[i] : docs_offsets[i + 1]])
+        chunks.append(encoded_tfs[tfs_offsets[i] : tfs_offsets[i + 1]])
+        if has_positions:
+            chunks.append(encoded_positions[positions_offsets[i] : positions_offsets[i + 1]])
+    postings_blob = np.concatenate(chunks).tobytes() if chunks else b""
+
+    encoded_terms = [term.encode("utf-8") for term in terms]
+    term_lengths = np.array([len(term) for term in encoded_terms], dtype=np.int64)
+
+    entries = np.zeros(len(terms), dtype=TERM_DTYPE)
+    entries["term_offset"] = np.cumsum(term_lengths) - term_lengths
+    entries["term_length"] = term_lengths
+    entries["df"] = ends - starts
+    entries["max_tf"] = np.maximum.reduceat(tfs, starts) if len(tfs) else []
+    entries["max_wtf"] = (
+        np.maximum.reduceat(np.asarray(wtfs, dtype=np.float32), starts) if len(tfs) else []
+    )
+    entries["idf"] = np.asarray(idfs, dtype=np.float64)[starts]
+    entry_lengths = docs_lengths + tfs_lengths + positions_lengths
+    entries["postings_offset"] = np.cumsum(entry_lengths) - entry_lengths
+    entries["docs_length"] = docs_lengths
+    entries["tfs_length"] = tfs_lengths
+    entries["positions_length"] = positions_lengths
+    entries["wtfs_offset"] = starts
+    entries["blocks_offset"] = np.searchsorted(block_starts, starts)
+
+    sections = [
+        np.asarray(doc_ids, dtype=np.int32).tobytes()
+        + np.asarray(doc_lengths, dtype=np.int32).tobytes(),
+        entries.tobytes(),
+        b"".join(encoded_terms),
+        postings_blob,
+        np.asarray(wtfs, dtype=np.float32).tobytes(),
+        blocks.tobytes(),
+    ]
+
+    # Offsets of the sections, aligned to 8 bytes so the arrays can be mapped directly
+    offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offset += -offset % 8
+        offsets.append(offset)
+        offset += len(section)
+
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                len(terms),
+                num_docs,
+                *offsets,
+            )
+        )
+        for section_offset, section in zip(offsets, sections):
+            file.write(b"\0" * (section_offset - file.tell()))
+            file.write(section)
+    os.replace(temporary_path, path)
+
+
+def _gather(array: np.ndarray, begins: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Concatenated slices array[begin:end] of each range.
+    """
+    if len(begins) == 1:
+        return array[int(begins[0]) : int(ends[0])]
+    return np.concatenate(
+        [array[begin:end] for begin, end in zip(begins.tolist(), ends.tolist())]
+    )
+
+
+class InvertedIndex:
+    """
+    Memory-mapped, read-only view on an inverted index file written by write_index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            num_terms,
+            self.num_docs,
+            docs_offset,
+            terms_offset,
+            strings_offset,
+            postings_offset,
+            wtfs_offset,
+            blocks_offset,
+        ) = HEADER.unpack_from(self._buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not an index file of version {VERSION}")
+
+        num_lengths = (terms_offset - docs_offset) // 8
+        self.doc_ids = np.frombuffer(
+            self._buffer, dtype=np.int32, count=num_lengths, offset=docs_offset
+        )
+        self.doc_lengths = np.frombuffer(
+            self._buffer,
+            dtype=np.int32,
+            count=num_lengths,
+            offset=docs_offset + 4 * num_lengths,
+        )
+        self.terms = np.frombuffer(
+            self._buffer, dtype=TERM_DTYPE, count=num_terms, offset=terms_offset
+        )
+        self._strings_offset = strings_offset
+        self._postings = np.frombuffer(
+            self._buffer,
+            dtype=np.uint8,
+            count=wtfs_offset - postings_offset,
+            offset=postings_offset,
+        )
+        num_postings = int(self.terms["df"].sum())
+        self._wtfs = np.frombuffer(
+            self._buffer, dtype=np.float32, count=num_postings, offset=wtfs_offset
+        )
+        self._blocks = np.frombuffer(
+            self._buffer, dtype=BLOCK_DTYPE, offset=blocks_offset
+        )
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        # The arrays are views on the memory map and have to be released first
+        self.doc_ids = self.doc_lengths = self.terms = None
+        self._postings = self._wtfs = self._blocks = None
+        if getattr(self, "_buffer", None) is not None:
+            self._buffer.close()
+            self._file.close()
+            self._buffer = None
+
+    def term(self, i: int) -> str:
+        """
+        Returns the i-th term of the sorted term dictionary.
+        """
+        return self._term_bytes(i).decode("utf-8")
+
+    def _term_bytes(self, i: int) -> bytes:
+        offset = self._strings_offset + int(self.terms[i]["term_offset"])
+        return self._buffer[offset : offset + int(self.terms[i]["term_length"])]
+
+    def find(self, term: str) -> int:
+        """
+        Binary search for the term in the term dictionary.
+        Returns: Index of the term, or -1 if the index does not contain it
+        """
+        key = term.encode("utf-8")
+        low, high = 0, len(self.terms)
+        while low < high:
+            middle = (low + high) // 2
+            if self._term_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.terms) and self._term_bytes(low) == key:
+            return low
+        return -1
+
+    def __contains__(self, term: str) -> bool:
+        return self.find(term) >= 0
+
+    def _entry(self, term: str):
+        i = self.find(term)
+        return self.terms[i] if i >= 0 else None
+
+    def idf(self, term: str) -> float | None:
+        entry = self._entry(term)
+        return float(entry["idf"]) if entry is not None else None
+
+    def df(self, term: str) -> int:
+        entry = self._entry(term)
+        return int(entry["df"]) if entry is not None else 0
+
+    def max_tf(self, term: str) -> int:
+        entry = self._entry(term)
+        return int(entry["max_tf"]) if entry is not None else 0
+
+    def max_wtf(self, term: str) -> float:
+        entry = self._entry(term)
+        return float(entry["max_wtf"]) if entry is not None else 0.0
+
+    def parts(self) -> list[tuple["InvertedIndex", Callable]]:
+        """
+        Returns: The index as its only part, without deleted documents, see SegmentSet.parts
+        """
+        return [(self, lambda doc_ids: None)]
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Decodes the postings of a term.
+        Returns: Sorted document ids and the term frequency in each document
+        """
+        entry = self._entry(term)
+        if entry is None:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return self._decode(entry)
+
+    def _decode(self, entry) -> tuple[np.ndarray, np.ndarray]:
+        start = int(entry["postings_offset"])
+        docs_end = start + int(entry["docs_length"])
+        tfs_end = docs_end + int(entry["tfs_length"])
+        doc_ids = np.cumsum(varint_decode(self._postings[start:docs_end]))
+        tfs = varint_decode(self._postings[docs_end:tfs_end])
+        return doc_ids, tfs
+
+    def blocks(self, term: str) -> np.ndarray:
+        """
+        Returns: The skip data of the blocks of a term, see BLOCK_DTYPE
+        """
+        entry = self._entry(term)
+        if entry is None:
+            return np.zeros(0, dtype=BLOCK_DTYPE)
+        return self._term_blocks(entry)
+
+    def _term_blocks(self, entry) -> np.ndarray:
+        start = int(entry["blocks_offset"])
+        return self._blocks[start : start - (-int(entry["df"]) // BLOCK_SIZE)]
+
+    def decode_blocks(
+        self, term: str, blocks: np.ndarray, weighted: bool = False
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Decodes the postings of some blocks of a term, without decoding the other blocks.
+        Args:
+            term: The term
+            blocks: Sorted indices of the blocks, see blocks
+            weighted: Whether to return the BM25F weighted term frequencies instead of the term frequencies
+
+        Returns: Sorted document ids and the (weighted) term frequency in each document
+        """
+        entry = self._entry(term)
+        blocks = np.asarray(blocks, dtype=np.int64)
+        if entry is None or len(blocks) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        term_blocks = self._term_blocks(entry)
+        df = int(entry["df"])
+        # Consecutive blocks are read as one run
+        breaks = np.flatnonzero(np.diff(blocks) != 1) + 1
+        firsts = blocks[np.concatenate(([0], breaks))]
+        lasts = blocks[np.append(breaks - 1, len(blocks) - 1)]
+
+        if weighted:
+            start = int(entry["wtfs_offset"])
+            values = _gather(
+                self._wtfs,
+                start + firsts * BLOCK_SIZE,
+                start + np.minimum((lasts + 1) * BLOCK_SIZE, df),
+            )
+        else:
+            values = varint_decode(
+                self._section(entry, term_blocks, firsts, lasts, "tfs_offset", "tfs_length")
+            )
+
+        # The first document id of a block is delta-encoded from the last one of the previous block. It is re-based on
+        # the last document id of the previous run, so a single cumsum decodes all runs.
+        deltas = varint_decode(
+            self._section(entry, term_blocks, firsts, lasts, "docs_offset", "docs_length")
+        )
+        last_docs = term_blocks["last_doc"].astype(np.int64)
+        previous = np.where(firsts > 0, last_docs[firsts - 1], 0)
+        previous_run = np.concatenate(([0], last_docs[lasts[:-1]]))
+        counts = np.minimum((lasts + 1) * BLOCK_SIZE, df) - firsts * BLOCK_SIZE
+        deltas[np.cumsum(counts) - counts] += previous - previous_run
+        return np.cumsum(deltas), values
+
+    def _section(
+        self,
+        entry,
+        term_blocks: np.ndarray,
+        firsts: np.ndarray,
+        lasts: np.ndarray,
+        offset: str,
+        length: str,
+    ) -> np.ndarray:
+        # Bytes of the document ids or term frequencies of runs of blocks of a term
+        offsets = np.append(term_blocks[offset].astype(np.int64), int(entry[length]))
+        start = int(entry["postings_offset"])
+        if offset == "tfs_offset":
+            start += int(entry["docs_length"])
+        return _gather(self._postings, start + offsets[firsts], start + offsets[lasts + 1])
+
+    def _decode_positions(self, entry) -> np.ndarray:
+        start = (
+            int(entry["postings_offset"])
+            + int(entry["docs_length"])
+            + int(entry["tfs_length"])
+        )
+        return varint_decode(
+            self._postings[start : start + int(entry["positions_length"])]
+        )
+
+    def read_postings(self) -> dict:
+        """
+        Decodes all postings of the index, e.g. to merge it with other indexes.
+        Returns: Word, document, term frequency, BM25F weighted term frequency and delta-encoded positions of each
+            posting, sorted by word and document. The positions are None if the index stores no positions.
+        """
+        has_positions = len(self.terms) > 0 and bool(
+            np.all(self.terms["positions_length"] > 0)
+        )
+        words, docs, tfs, positions = [], [], [], []
+        for i, entry in enumerate(self.terms):
+            doc_ids, term_tfs = self._decode(entry)
+            words.append(np.full(len(doc_ids), self.term(i), dtype=object))
+            docs.append(doc_ids)
+            tfs.append(term_tfs)
+            if has_positions:
+                # Each posting has as many positions as its term frequency
+                positions += np.split(
+                    self._decode_positions(entry), np.cumsum(term_tfs)[:-1]
+                )
+
+        num_postings = int(self.terms["df"].sum())
+        return {
+            "words": np.concatenate(words) if words else np.array([], dtype=object),
+            "docs": np.concatenate(docs) if docs else np.array([], dtype=np.int64),
+            "tfs": np.concatenate(tfs) if tfs else np.array([], dtype=np.int64),
+            "wtfs": np.array(self._wtfs[:num_postings]),
+            "positions": positions if has_positions else None,
+        }
+
+    def weighted_tfs(self, term: str) -> np.ndarray:
+        """
+        Returns: The BM25F weighted term frequencies of the postings of a term
+        """
+        entry = self._entry(term)
+        if entry is None:
+            return np.array([], dtype=np.float32)
+        start = int(entry["wtfs_offset"])
+        return self._wtfs[start : start + int(entry["df"])]
+
+    def positions(self, term: str, docs: list[int]) -> dict[int, np.ndarray]:
+        """
+        Decodes the token positions of a term in the given documents.
+        Returns: Positions of the term per document, documents without the term or without stored positions are
+            missing
+        """
+        entry = self._entry(term)
+        if entry is None or entry["positions_length"] == 0:
+            return {}
+
+        doc_ids, tfs = self._decode(entry)
+        deltas = self._decode_positions(entry)
+
+        # Each posting has as many positions as its term frequency
+        bounds = np.concatenate(([0], np.cumsum(tfs)))
+        indices = np.searchsorted(doc_ids, docs)
+        found = indices < len(doc_ids)
+        indices = indices[found][doc_ids[indices[found]] == np.asarray(docs)[found]]
+        return {
+            int(doc_ids[i]): np.cumsum(deltas[bounds[i] : bounds[i + 1]])
+            for i in indices
+        }
@@ -1,6 +1,9 @@
 #!.venv/bin/python
 # -*- coding: utf-8 -*-
+import lzma
 import os
+import pickle
+import random
 import sys
 
 # Parse the command line arguments
@@ -18,17 +21,25 @@ import duckdb
 # Pipeline
 from crawl import Crawler
 from download import Downloader, Loader
-from tokenizer import Tokenizer
-from index import Indexer
+from tokenizer import LEXICON_FILE, Lexicon, Tokenizer, tokenizer_version
+from index import Indexer, compact, compute_statistics, delete_documents, find_documents
+from segments import SegmentManager
+from shards import export_shards, shard_paths
 
 # Server
 from server import start_server
 
 # Rank
 from rank import rank_from_file
+from similarity import build_embeddings, build_synonyms
+from dense import build_document_embeddings
+from spelling import build_spelling
 
 # Threading
 MAX_THREADS = 10
+# The offline pipeline tokenizes the pages in batches, with several spaCy processes
+TOKENIZER_BATCH_SIZE = 32
+TOKENIZER_PROCESSES = 1
 ENGINE_NAME = "TüR"
 
 # Patch asyncio to allow nested event loops
@@ -58,9 +69,47 @@ async def shutdown_pipeline(stages):
     print("Pipeline shutdown complete.")
 
 
-async def pipeline(online: bool = True):
+def build_lexicon(sample_size: int = 100):
+    """
+    Distill the lexicon of the fast tokenization from spaCy over the crawled pages, and report how well it agrees
+    with spaCy on a sample of held-out pages, which the evaluated lexicon was built without, like
+    `benchmark.py lexicon`. The saved lexicon is built from all pages.
+    Args:
+        sample_size: Number of pages to compare, at most half of the pages
+
+    Returns: None
+    """
+    print("Building lexicon...")
+    texts = [
+        pickle.loads(lzma.decompress(blob)).get_text(" ")
+        for blob, in con.execute("SELECT content FROM crawled").fetchall()
+    ]
+    held_out = set(random.sample(range(len(texts)), min(sample_size, len(texts) // 2)))
+    train = [text for i, text in enumerate(texts) if i not in held_out]
+    test = [texts[i] for i in sorted(held_out)]
+
+    analyses = Lexicon.count_analyses(train)
+    agreement = Lexicon.from_analyses(analyses).agreement(test)
+    print(
+        f"Agreement with spaCy on {agreement['texts']} held-out pages: {agreement['identical']:.1%} identical, "
+        f"precision {agreement['precision']:.1%}, recall {agreement['recall']:.1%}"
+    )
+
+    # Only the held-out pages are analyzed again
+    lexicon = Lexicon.from_analyses(Lexicon.count_analyses(test, analyses=analyses))
+    lexicon.save(LEXICON_FILE)
+    print(f"Saved {len(lexicon.table)} words to {LEXICON_FILE}")
+
+
+async def pipeline(online: bool = True, fast: bool = False, reindex: bool = False):
     """
     Start the crawling, tokenizing, and indexing pipeline
+    Args:
+        online: Crawl the web instead of loading the crawled pages
+        fast: Tokenize with the lexicon instead of running spaCy on every document
+        reindex: Only load the crawled pages whose content or tokenizer version changed, instead of rebuilding the
+            whole index
+
     Returns: None
 
     """
@@ -70,10 +119,24 @@ async def pipeline(online: bool = True):
     crawler.max_size = 10000
     crawler.max_retries = 1
     crawler.max_concurrent = 5
-    indexer = Indexer(con)
-    tokenizer = Tokenizer(con)
+    # New documents are flushed into index segments, so they can be found while the pipeline runs
+    segments = SegmentManager(con)
+    indexer = Indexer(con, segments=segments)
+    lexicon = Lexicon.load(LEXICON_FILE) if fast else None
+    tokenizer = Tokenizer(
+        con,
+        segments=segments,
+        lexicon=lexicon,
+        # New pages are tokenized right away when crawling, so they can be found quickly
+        batch_size=1 if online else TOKENIZER_BATCH_SIZE,
+        n_process=TOKENIZER_PROCESSES,
+    )
     downloader = Downloader(con)
-    loader = Loader(con)
+    loader = Loader(
+        con,
+        segments=segments,
+        version=tokenizer_version(lexicon) if reindex else None,
+    )
 
     # Define the pipeline stages
     stages = [crawler, indexer, tokenizer, downloader, loader]
@@ -117,16 +180,30 @@ async def pipeline(online: bool = True):
             # Shutdown all elements
             await shutdown_pipeline(stages)
 
-    # Compute TF-IDF matrix
-    con.execute("TRUNCATE IDFs")
-    con.execute(
-        """
-        INSERT INTO IDFs(word, idf)
-        SELECT word, LOG(N::double / COUNT(DISTINCT doc))
-        FROM   TFs, (SELECT COUNT(*) FROM documents) AS _(N)
-        GROUP BY word, N
-    """
-    )
+    # Replace the previous index by the rebuilt one
+    if not online:
+        loader.finish()
+
+    # Remove the deleted and replaced documents, once there are enough of them
+    compact(con)
+
+    if online or reindex:
+        # Only update the statistics of the new documents, the segments already serve them
+        compute_statistics(con, incremental=True)
+    else:
+        # Compute IDFs and BM25F term frequencies
+        compute_statistics(con)
+
+        # Export the whole index into one segment, with up-to-date statistics
+        segments.export(con)
+        build_document_embeddings(con)
+        build_spelling(con)
+    segments.close()
+
+    # Keep the shards up to date
+    num_shards = len(shard_paths())
+    if num_shards:
+        export_shards(con, num_shards)
     con.close()
 
 
@@ -146,7 +223,62 @@ def main():
         required=False,
     )
     parser.add_argument(
-        "-s", "--server", help="Run the server", action="store_true", required=False
+        "--reindex",
+        help="Run pipeline from the disk, only for the pages whose content or tokenizer version changed",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--fast",
+        help="Tokenize with the lexicon instead of running spaCy on every document",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--lexicon",
+        help="Build the lexicon of the fast tokenization from the crawled pages",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--synonyms",
+        help="Store the word vectors of the index and precompute their most similar words for the query expansion",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-e",
+        "--export",
+        help="Export the inverted index segment for serving queries",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--shards",
+        help="Number of index shards to export with --export, each one is served by its own process",
+        default=0,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--delete",
+        help="Delete the documents of these links from the index",
+        nargs="+",
+        metavar="LINK",
+        required=False,
+    )
+    parser.add_argument(
+        "--compact",
+        help="Remove all deleted documents from the database",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-s",
+        "--server",
+        help="Run the server, next to the pipeline with --online, --offline or --reindex",
+        action="store_true",
+        required=False,
     )
     parser.add_argument(
         "-f",
@@ -162,19 +294,60 @@ def main():
 
     try:
         args = parser.parse_args()
+        if args.shards and not args.export:
+            # The server and the pipeline serve the exported shards, whatever their number
+            parser.error("--shards needs --export")
+
+        if args.server and (args.online or args.offline or args.reindex):
+            # Search while the pipeline runs. DuckDB locks crawlies.db for one process, so the server shares the
+            # connection of the pipeline and finds the new documents in the index segments right away
+            start_server(debug=args.debug, con=con, background=True)
 
         # Start the pipeline
         if args.online:
             # Crawl the websites and start the pipeline
-            asyncio.run(pipeline(online=True))
+            asyncio.run(pipeline(online=True, fast=args.fast))
         elif args.offline:
             # Load the pages from the disk and start the pipeline
-            asyncio.run(pipeline(online=False))
+            asyncio.run(pipeline(online=False, fast=args.fast))
+        elif args.reindex:
+            # Load the changed pages from the disk and start the pipeline
+            asyncio.run(pipeline(online=False, fast=args.fast, reindex=True))
+        elif args.lexicon:
+            # Distill the lexicon of the fast tokenization
+            build_lexicon()
+        elif args.synonyms:
+            # Store the word vectors of the index and precompute the query expansion
+            build_embeddings(con)
+            build_synonyms(con)
+            build_document_embeddings(con)
+        elif args.export:
+            # Export the inverted index from the database
+            segments = SegmentManager(con)
+            segments.export(con)
+            segments.close()
+            build_document_embeddings(con)
+            build_spelling(con)
+            if args.shards:
+                export_shards(con, args.shards)
+        elif args.delete:
+            # Delete documents, they are removed from the database by a later compaction
+            segments = SegmentManager(con)
+            for link in args.delete:
+                doc_ids = find_documents(con, link)
+                delete_documents(con, doc_ids)
+                segments.delete_documents(doc_ids)
+                print(f"Deleted {len(doc_ids)} documents of {link}")
+            segments.close()
+        elif args.compact:
+            # Remove the deleted documents regardless of their share
+            compact(con, threshold=0)
         elif args.server:
             # Start the server
             start_server(debug=args.debug, con=con)
         elif args.file:
-            # Rank the queries from the file
+            # Rank the queries from the file, the workers open the database themselves
+            con.close()
             rank_from_file(args.file)
         else:
             parser.print_help()
@@ -1,17 +1,283 @@
+import heapq
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from operator import itemgetter
+
 import duckdb
+import numpy as np
 import pandas as pd
-from similarity import most_similar
+from similarity import (
+    EMBEDDING_FILE,
+    file_version,
+    get_embeddings,
+    most_similar_batch,
+)
+from spelling import get_spelling
 import math
-from tokenizer import preprocess_text
+from cache import LRUCache
+from dense import embed_query, get_document_embeddings
+from inverted_index import BLOCK_SIZE, InvertedIndex
+from segments import INDEX_DIRECTORY, SegmentSet, manifest_version
+from shards import SHARD_DIRECTORY, ShardPool, merge_scores, shards_version
+from tokenizer import get_nlp, preprocess_text, lower
+from utils import delta_decode
 from nltk.stem import WordNetLemmatizer
 import nltk
-import spacy
 
 # Download the NLTK data
 print("Downloading NLTK data...")
 nltk.download("wordnet")
 
-nlp = spacy.load("en_core_web_sm", disable=["tok2vec", "parser", "senter"])
+# Quoted parts of a query are phrases, e.g. "Hölderlin tower"
+PHRASE_PATTERN = re.compile(r'"([^"]+)"')
+# Words of a query, without digits and punctuation
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+inverted_index = None  # Global accessor for the memory-mapped index segments
+shard_pool = None  # Global accessor for the worker processes of the index shards
+
+DATABASE = "crawlies.db"
+
+# Statements of the ranking, the DataFrames df_* are local variables of the functions running them
+POSITIONS_SQL = """
+    SELECT t.doc, w.word, t.positions
+    FROM   tfs AS t, words AS w, df_terms AS _(token), df_docs AS __(doc_id)
+    WHERE  w.word = token AND w.id = t.word AND t.doc = doc_id;
+"""
+RANKING_SQL = """
+    SELECT d.id AS id, d.title AS title, d.link AS url,
+           d.description AS description, d.summary AS summary,
+           s.score AS score
+    FROM   documents AS d, df_scores AS s
+    WHERE  d.id = s.doc AND d.id NOT IN (SELECT doc FROM tombstones)
+    ORDER BY s.score DESC
+"""
+# Statements of the ranking that only take a list, e.g. the search terms, prepared once per cursor, see
+# init_cursor_pool. The other statements read the DataFrames through replacement scans, which are bound when a
+# statement runs, so they are planned again on every query. The scans stay faster for long lists of documents than
+# literals of them.
+TF_SQL = """
+    SELECT t.doc, w.word, t.tf
+    FROM   tfs AS t, words AS w
+    WHERE  w.word IN (SELECT unnest($1::VARCHAR[])) AND w.id = t.word
+           AND t.doc NOT IN (SELECT doc FROM tombstones)
+"""
+IDF_SQL = """
+    SELECT w.word, i.idf
+    FROM   idfs AS i, words AS w
+    WHERE  w.word IN (SELECT unnest($1::VARCHAR[])) AND w.id = i.word
+"""
+WEIGHTED_POSTINGS_SQL = """
+    SELECT t.doc, w.word, t.wtf, i.idf
+    FROM   tfs AS t, words AS w, idfs AS i
+    WHERE  w.word IN (SELECT unnest($1::VARCHAR[])) AND w.id = t.word AND w.id = i.word
+           AND t.doc NOT IN (SELECT doc FROM tombstones)
+"""
+BOUNDS_SQL = """
+    SELECT w.word, i.max_tf, i.max_wtf
+    FROM   idfs AS i, words AS w
+    WHERE  w.word IN (SELECT unnest($1::VARCHAR[])) AND w.id = i.word
+"""
+NUM_DOCS_SQL = (
+    "SELECT COUNT(*) FROM documents WHERE id NOT IN (SELECT doc FROM tombstones)"
+)
+DELETED_SQL = "SELECT doc FROM tombstones WHERE doc IN (SELECT unnest($1::INTEGER[]))"
+PREPARED_STATEMENTS = {
+    "rank_tf": TF_SQL,
+    "rank_idf": IDF_SQL,
+    "rank_weighted_postings": WEIGHTED_POSTINGS_SQL,
+    "rank_bounds": BOUNDS_SQL,
+    "rank_num_docs": NUM_DOCS_SQL,
+    "rank_deleted": DELETED_SQL,
+}
+SYNONYMS_SQL = """
+    SELECT synonym, similarity
+    FROM   synonyms
+    WHERE  word = ?
+    ORDER BY similarity DESC
+    LIMIT ?;
+"""
+HAS_SYNONYMS_SQL = "SELECT EXISTS (SELECT * FROM synonyms)"
+
+connection = None  # Global accessor for the long-lived database connection of the ranking
+connection_lock = threading.Lock()
+# Prepared cursors on the connection, shared by the threads ranking queries, see borrow_cursor
+CURSOR_POOL_SIZE = 8
+cursor_pool = None  # Connection and queue of its cursors
+pool_lock = threading.Lock()
+borrowed = threading.local()  # Cursor the current thread borrowed from the pool
+
+# Ranked documents of recent queries, emptied when the index changes
+RESULT_CACHE_SIZE = 1_000
+RESULT_CACHE_TTL = 600  # Seconds
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
+result_cache = LRUCache(
+    RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_BYTES
+)
+
+# Tokens of recent queries and similar words of recent tokens. The similar words are emptied when the synonyms appear
+# or the embedding store is rebuilt, which main.py --synonyms does together with the synonyms.
+ANALYSIS_CACHE_SIZE = 10_000
+EXPANSION_CACHE_SIZE = 50_000
+EXPANSION_CACHE_BYTES = 64 * 1024 * 1024
+analysis_cache = LRUCache(ANALYSIS_CACHE_SIZE)
+expansion_cache = LRUCache(EXPANSION_CACHE_SIZE, max_bytes=EXPANSION_CACHE_BYTES)
+
+# File with a query per line, analyzed and expanded at startup to fill the caches
+QUERY_LOG = "queries.txt"
+
+# Batch evaluation of rank_from_file: documents written per query, and worker processes
+RESULTS_PER_QUERY = 100
+BATCH_PROCESSES = os.cpu_count()
+
+lemmatizer = WordNetLemmatizer()
+
+# Hybrid ranking: the best lexical and the best dense documents are fused by their ranks
+HYBRID_CANDIDATES = 1_000
+RRF_K = 60  # Damping of the reciprocal rank fusion, higher values flatten the fused scores
+# Seconds the lexical ranking may take before the dense stage, slower queries are answered by it alone
+DENSE_LATENCY_BUDGET = 0.2
+
+synonyms_state = None  # Index generation and whether the database had precomputed synonyms then
+
+
+def set_connection(con: duckdb.DuckDBPyConnection):
+    """
+    Use an open connection for the ranking, e.g. the one of the server, instead of opening the database. DuckDB
+    can't open a database file twice with different configurations in one process.
+    """
+    global connection
+    with connection_lock:
+        connection = con
+
+
+def get_connection() -> duckdb.DuckDBPyConnection:
+    """
+    Get the long-lived connection of the ranking. The database is opened read-only on first use, unless a connection
+    was set, and stays open so its buffers stay warm across queries.
+    """
+    global connection
+    if connection is None:
+        with connection_lock:
+            if connection is None:
+                connection = duckdb.connect(DATABASE, read_only=True)
+    return connection
+
+
+def init_cursor_pool(size: int = CURSOR_POOL_SIZE) -> queue.Queue:
+    """
+    Create the cursors of the ranking on the connection and prepare the statements on each of them, once at startup
+    instead of per request thread. A cursor is a connection of its own to the same database, which can be used by one
+    thread at a time, so at most size queries use the database at once, see borrow_cursor.
+    """
+    global cursor_pool
+    con = get_connection()
+    pool = queue.Queue()
+    prepared = True
+    for _ in range(size):
+        cursor = con.cursor()
+        if prepared:
+            try:
+                prepare_statements(cursor)
+            except duckdb.Error as e:
+                # E.g. the tables were not created yet, execute_prepared prepares them on first use
+                print(f"Could not prepare the ranking statements: {str(e)}")
+                prepared = False
+        pool.put(cursor)
+    cursor_pool = (con, pool)
+    return pool
+
+
+def get_cursor_pool() -> queue.Queue:
+    """
+    Get the pool of prepared cursors on the current connection, created on first use unless init_cursor_pool was
+    called at startup.
+    """
+    con = get_connection()
+    with pool_lock:
+        if cursor_pool is None or cursor_pool[0] is not con:
+            return init_cursor_pool()
+        return cursor_pool[1]
+
+
+@contextmanager
+def borrow_cursor():
+    """
+    Borrow a prepared cursor of the pool for the current thread, waiting while all of them are in use. Nested borrows
+    of a thread get the same cursor, so a query never waits for a second one.
+    """
+    cursor = getattr(borrowed, "cursor", None)
+    if cursor is not None:
+        yield cursor
+        return
+    pool = get_cursor_pool()
+    cursor = pool.get()
+    borrowed.cursor = cursor
+    try:
+        yield cursor
+    finally:
+        borrowed.cursor = None
+        pool.put(cursor)
+
+
+def prepare_statements(con: duckdb.DuckDBPyConnection):
+    """
+    Prepare the statements of PREPARED_STATEMENTS on a cursor, so they are parsed and planned once instead of on
+    every query. Prepared statements belong to the cursor that prepared them.
+    """
+    for name, sql in PREPARED_STATEMENTS.items():
+        # The API prepares statements of its own for execute, which reject the $1 of PREPARE
+        con.sql(f"PREPARE {name} AS {sql}")
+
+
+def execute_prepared(
+    con: duckdb.DuckDBPyConnection, name: str, values=None
+) -> duckdb.DuckDBPyConnection:
+    """
+    Execute a statement of PREPARED_STATEMENTS, preparing the statements first if the cursor did not yet, e.g. a
+    cursor that is not one of the pool.
+    Args:
+        con: Database connection
+        name: Name of the statement
+        values: List the statement takes, e.g. the search terms, if it takes one
+
+    Returns: The connection, to fetch the result from
+    """
+    statement = f"EXECUTE {name}"
+    if values is not None:
+        # EXECUTE takes no bound parameters, so the list is bound to a variable of the cursor and passed on from it.
+        # The statements cast it to the type of its elements.
+        con.execute("SET VARIABLE parameter = ?", [list(values)])
+        statement += "(getvariable('parameter'))"
+    try:
+        return con.execute(statement)
+    except duckdb.BinderException as e:
+        if "does not exist" not in str(e):
+            raise
+        prepare_statements(con)
+        return con.execute(statement)
+
+
+def get_index() -> SegmentSet | None:
+    """
+    Get the current segments of the memory-mapped inverted index. They are reopened when the manifest changes, i.e.
+    when documents were added or segments were merged. Returns None if there are no segments, then queries are
+    answered from the database.
+    """
+    global inverted_index
+    version = manifest_version(INDEX_DIRECTORY)
+    if version is None:
+        return None
+    if inverted_index is None or inverted_index.version != version:
+        inverted_index = SegmentSet(INDEX_DIRECTORY, previous=inverted_index)
+    return inverted_index if len(inverted_index) else None
 
 
 def calc_num_similar_words(
@@ -31,50 +297,397 @@ def calc_num_similar_words(
     return int(num_sim_words)
 
 
-def process_and_expand_query(query: str) -> tuple:
-    """Preprocess the query and expand it with similar words.
+def analyze_query(query: str) -> list[str]:
+    """Preprocess the query and turn it into tokens the same way documents are tokenized.
 
     Args:
         query (str): User query.
 
     Returns:
-        tuple: Preprocessed query and expanded query with similar words and their similarity scores.
+        list[str]: Query tokens.
     """
-    default_num_sim_words = 7
     processed_query = preprocess_text(query)
-    doc = nlp(processed_query)
-    wnl = WordNetLemmatizer()
+    # The tagging depends on the whole query, so whole queries are cached
+    tokens = analysis_cache.get(processed_query)
+    if tokens is not None:
+        return list(tokens)
+
+    # Single texts skip the batching of nlp.pipe
+    doc = get_nlp()(processed_query)
     tokens = []
 
-    proccessed_sim_words = {}
     for token in doc:
         if token.is_stop or token.is_punct or token.is_space:
             continue
         token = token.lemma_ if token.pos_ in ["NOUN", "PROPN"] else token.text
         tokens.append(token)
+    analysis_cache.put(processed_query, tuple(tokens))
+    return tokens
+
+
+def parse_phrases(query: str) -> list[list[str]]:
+    """Extract the quoted phrases of the query, e.g. '"Stocherkahn race" tübingen'.
+
+    Args:
+        query (str): User query.
+
+    Returns:
+        list[list[str]]: Tokens of each phrase, lowercased like the index. Phrases with a single token are skipped
+            because they are ordinary query terms.
+    """
+    phrases = []
+    for phrase in PHRASE_PATTERN.findall(query):
+        tokens = lower(analyze_query(phrase))
+        if len(tokens) > 1:
+            phrases.append(tokens)
+    return phrases
+
+
+def count_phrase(positions: list[np.ndarray]) -> int:
+    """Count how often the terms occur next to each other by intersecting their position lists.
+
+    Args:
+        positions (list[np.ndarray]): Sorted positions of each phrase term in one document.
+
+    Returns:
+        int: Number of phrase occurrences.
+    """
+    matches = positions[0]
+    for offset, term_positions in enumerate(positions[1:], start=1):
+        # A phrase occurrence starting at p has its i-th term at p + i
+        matches = np.intersect1d(matches, term_positions - offset, assume_unique=True)
+        if len(matches) == 0:
+            break
+    return len(matches)
+
+
+def min_distance(first: np.ndarray, second: np.ndarray) -> int:
+    """Smallest distance between any two positions of two sorted position lists.
+
+    Args:
+        first (np.ndarray): Sorted positions of the first term.
+        second (np.ndarray): Sorted positions of the second term.
+
+    Returns:
+        int: Minimal distance between the terms.
+    """
+    indices = np.searchsorted(second, first)
+    after = second[np.minimum(indices, len(second) - 1)]
+    before = second[np.maximum(indices - 1, 0)]
+    return int(np.minimum(np.abs(after - first), np.abs(first - before)).min())
+
+
+def fetch_positions(
+    con: duckdb.DuckDBPyConnection,
+    terms: set[str],
+    docs: list[int],
+    index: SegmentSet = None,
+) -> dict[tuple[int, str], np.ndarray]:
+    """Fetch and decode the token positions of the terms in the given documents.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Database connection.
+        terms (set[str]): Terms to fetch the positions for.
+        docs (list[int]): Documents to fetch the positions for.
+        index (SegmentSet, optional): Index segments to read the positions from instead of the database.
+
+    Returns:
+        dict[tuple[int, str], np.ndarray]: Positions of each (document, term) pair.
+    """
+    if index is not None:
+        docs = sorted(docs)
+        return {
+            (doc, term): positions
+            for term in terms
+            for doc, positions in index.positions(term, docs).items()
+        }
+
+    df_terms = pd.DataFrame(sorted(terms), columns=["terms"])
+    df_docs = pd.DataFrame(sorted(docs), columns=["docs"])
+    rows = con.execute(POSITIONS_SQL).fetchall()
+    return {
+        (doc, word): np.array(delta_decode(positions), dtype=np.int64)
+        for doc, word, positions in rows
+    }
+
+
+def position_candidates(
+    docs: np.ndarray, words: np.ndarray, query: list[str], phrases: list[list[str]]
+) -> list[int]:
+    """Find the documents whose positions are needed: only documents containing all phrase terms can match the
+    phrases, and proximity needs at least two query terms.
+
+    Args:
+        docs (np.ndarray): Document of each posting of the search terms.
+        words (np.ndarray): Word of each posting.
+        query (list[str]): Query terms.
+        phrases (list[list[str]]): Phrases of the query.
+
+    Returns:
+        list[int]: Candidate documents.
+    """
+    if phrases:
+        terms = {term for phrase in phrases for term in phrase}
+        required = len(terms)
+    else:
+        terms = set(query)
+        required = 2
+    # Each document has one posting per word, so counting the postings counts the distinct terms
+    counts = np.bincount(docs[np.isin(words, list(terms))])
+    return np.flatnonzero(counts >= required).tolist()
+
+
+def score_positions(
+    con: duckdb.DuckDBPyConnection,
+    scores: list[tuple],
+    candidates: list[int],
+    query: list[str],
+    phrases: list[list[str]],
+    k1=1.5,
+    phrase_weight=2.0,
+    proximity_weight=1.0,
+    index: SegmentSet = None,
+) -> list[tuple]:
+    """
+    Filter the scored documents by the phrases of the query and boost documents where query terms occur close to
+    each other. Only the position lists are needed, the documents themselves are never touched.
+    """
+    query_terms = list(dict.fromkeys(query))
+    phrase_terms = {term for phrase in phrases for term in phrase}
+
+    # Only the candidates can match the phrases or get a proximity boost, see position_candidates. With top-k
+    # pruning, not all candidates are scored.
+    scored = {doc_id for doc_id, _ in scores}
+    candidates = [doc_id for doc_id in candidates if doc_id in scored]
+    if not candidates:
+        return [] if phrases else scores
+
+    positions = fetch_positions(
+        con, phrase_terms.union(query_terms), candidates, index=index
+    )
+    candidates = set(candidates)
+    no_positions = np.array([], dtype=np.int64)
+
+    rescored = []
+    for doc_id, score in scores:
+        if doc_id not in candidates:
+            if not phrases:
+                rescored.append((doc_id, score))
+            continue
+
+        if phrases:
+            freqs = [
+                count_phrase([positions.get((doc_id, term), no_positions) for term in phrase])
+                for phrase in phrases
+            ]
+            if not all(freqs):
+                continue
+            score += phrase_weight * sum(freq * (k1 + 1) / (freq + k1) for freq in freqs)
+
+        if proximity_weight:
+            # Reward query terms that follow each other closely
+            present = [
+                positions[doc_id, term]
+                for term in query_terms
+                if len(positions.get((doc_id, term), no_positions))
+            ]
+            for first, second in zip(present, present[1:]):
+                score += proximity_weight / min_distance(first, second) ** 2
+
+        rescored.append((doc_id, score))
+    return rescored
+
+
+def proximity_margin(query: list[str], proximity_weight: float) -> float:
+    """Upper bound of the proximity boost of score_positions: neighbouring query terms are at least one position
+    apart.
+
+    Args:
+        query (list[str]): Query terms.
+        proximity_weight (float): Weight of the proximity boost.
+
+    Returns:
+        float: Highest possible boost.
+    """
+    return proximity_weight * max(len(set(query)) - 1, 0)
+
+
+def process_and_expand_query(query: str) -> tuple:
+    """Preprocess the query and expand it with similar words.
+
+    Args:
+        query (str): User query.
+
+    Returns:
+        tuple: Preprocessed query and expanded query with similar words and their similarity scores.
+    """
+    default_num_sim_words = 7
+    tokens = correct_tokens(analyze_query(query))
+
+    proccessed_sim_words = {}
     tokens_length = len(tokens)
     if tokens_length > 7:
         num_sim_words = calc_num_similar_words(tokens_length)
     else:
         num_sim_words = default_num_sim_words
+    synonyms = has_synonyms(index_generation())
+    # New documents don't change the similar words, only the synonyms and the word vectors they are computed from
+    expansion_cache.check_generation((synonyms, file_version(EMBEDDING_FILE)))
+    sim_words = expand_tokens(tokens, num_sim_words, synonyms=synonyms)
     for token in tokens:
-        sim_words = most_similar(token, num_sim_words)
-        proccessed_sim_words[token] = list(
-            map(lambda x: (wnl.lemmatize(x[0].lower()), x[1]), sim_words)
-        )
+        proccessed_sim_words[token] = list(sim_words[token])
     return tokens, proccessed_sim_words
 
 
-def bm25(
-    query: str, dbcon: duckdb.DuckDBPyConnection, k1=1.5, b=0.75, debug: bool = False
-) -> list[dict]:
+def correct_tokens(tokens: list[str]) -> list[str]:
+    """Correct the spelling of the query tokens with the spelling dictionary of the index, so misspelled tokens find
+    postings and similar words. The tokens are only lowercased if the dictionary was not built yet.
+
+    Args:
+        tokens (list[str]): Query tokens.
+
+    Returns:
+        list[str]: Corrected query tokens, lowercased like the words of the index.
     """
-    Rank documents by BM25. Additionally, use similar words aswell for ranking, however with a lower weight/portion.
+    # Lowercased in any case, the index, the synonyms and the word vectors only have lowercase words
+    tokens = lower(tokens)
+    spelling = get_spelling()
+    if spelling is None:
+        return tokens
+    return [spelling.correct(token) for token in tokens]
+
+
+def spellcheck_query(query: str) -> str:
+    """Correct the misspelled words of a query, keeping the other words as they were typed.
+
+    Args:
+        query (str): User query.
+
+    Returns:
+        str: Query with the misspelled words replaced by their correction, the query itself if the spelling
+            dictionary was not built yet.
+    """
+    spelling = get_spelling()
+    if spelling is None:
+        return query
+    vocab = get_nlp().vocab
+
+    def correct_word(match: re.Match) -> str:
+        word = preprocess_text(match.group()).strip().lower()
+        # Stop words are not indexed, so they would be "corrected" to other words
+        if not word or vocab[word].is_stop:
+            return match.group()
+        correction = spelling.correct(word)
+        return correction if correction != word else match.group()
+
+    return WORD_PATTERN.sub(correct_word, query)
+
+
+def has_synonyms(generation: tuple) -> bool:
+    """Check whether the synonyms were precomputed by main.py --synonyms. Checked once per index generation.
+
+    Args:
+        generation (tuple): Current index generation, see index_generation.
+
+    Returns:
+        bool: True if the synonyms table has entries.
+    """
+    global synonyms_state
+    if synonyms_state is None or synonyms_state[0] != generation:
+        try:
+            with borrow_cursor() as cursor:
+                available = cursor.execute(HAS_SYNONYMS_SQL).fetchone()[0]
+        except duckdb.CatalogException:
+            # Database created before the synonyms table
+            available = False
+        synonyms_state = (generation, available)
+    return synonyms_state[1]
+
+
+def expand_tokens(
+    tokens: list[str], num_sim_words: int, synonyms: bool = False
+) -> dict[str, tuple]:
+    """Find the similar words of the query tokens. The results of recent tokens are cached, the other tokens are
+    looked up together.
+
+    Args:
+        tokens (list[str]): Query tokens.
+        num_sim_words (int): Number of similar words per token.
+        synonyms (bool, optional): Look up the precomputed similar words of the index instead of searching the word
+            vectors. Defaults to False.
+
+    Returns:
+        dict[str, tuple]: Pairs of similar word and similarity score of each token.
+    """
+    expansions = {}
+    missing = []
+    for token in dict.fromkeys(tokens):
+        sim_words = expansion_cache.get((token, num_sim_words))
+        if sim_words is None:
+            missing.append(token)
+        else:
+            expansions[token] = sim_words
+    if not missing:
+        return expansions
+
+    if synonyms:
+        with borrow_cursor() as cursor:
+            found = {
+                token: cursor.execute(SYNONYMS_SQL, [token, num_sim_words]).fetchall()
+                for token in missing
+            }
+    else:
+        found = most_similar_batch(missing, num_sim_words)
+        # The full GloVe vocabulary has other word forms than the index, the embedding store only has words of the
+        # index
+        if get_embeddings() is None:
+            found = {
+                token: [(lemmatizer.lemmatize(word.lower()), score) for word, score in sim_words]
+                for token, sim_words in found.items()
+            }
+
+    for token, sim_words in found.items():
+        expansions[token] = tuple((word, score) for word, score in sim_words)
+        expansion_cache.put((token, num_sim_words), expansions[token])
+    return expansions
+
+
+def warm_query_caches(filepath: str = QUERY_LOG):
+    """Analyze and expand the queries of a query log, so their tokens are cached before the first query.
+
+    Args:
+        filepath (str, optional): File with a query per line, see read_queries. Defaults to QUERY_LOG.
+    """
+    if not os.path.isfile(filepath):
+        return
+    queries = read_queries(filepath)
+    for query in queries:
+        process_and_expand_query(query)
+    print(f"Warmed the query caches with {len(queries)} queries")
+
+
+def prepare_query(query: str, debug: bool = False) -> tuple:
+    """Parse the phrases of the query, expand it with similar words and collect the terms to look up.
+
+    Args:
+        query (str): User query.
+        debug (bool, optional): Print the query terms. Defaults to False.
+
+    Returns:
+        tuple: Phrases, query terms, expanded query, similar words with their weights and all search terms.
     """
 
+    # Quoted phrases, matched by intersecting position lists
+    phrases = parse_phrases(query)
+
     # Create the query vector
     query, expanded_query = process_and_expand_query(query)
 
+    # Phrase terms have to be looked up like any other query term
+    query = query + [
+        term for phrase in phrases for term in phrase if term not in query
+    ]
+
     # flatten expanded query terms
     sim_weight_list = [
         (word, score)
@@ -82,7 +695,6 @@ def bm25(
         for word, score in sim_list
         if score > 0.7 and word not in query
     ]
-    sim_count = len(sim_weight_list)
 
     # Search terms to look up tf and idf for
     search_terms = set(query).union(set(map(lambda x: x[0], sim_weight_list)))
@@ -91,128 +703,1125 @@ def bm25(
         print(f"expanded_query: {expanded_query}")
         print(f"db_query: {search_terms}")
         print(f"Query: {query}")
+        print(f"Phrases: {phrases}")
 
-    con = dbcon  # Rename DB connection
+    return phrases, query, expanded_query, sim_weight_list, search_terms
 
-    # DataFrame to directly query in DuckDB
-    df_search = pd.DataFrame(sorted(search_terms), columns=["search_terms"])
 
-    # Query TF and IDf for desired search terms
-    df_tf = (
-        con.execute(
-            """
-        SELECT t.doc, w.word, t.tf
-        FROM   tfs AS t, words AS w, df_search AS _(token)
-        WHERE  w.word = token AND w.id = t.word;
+def fetch_ranking(con: duckdb.DuckDBPyConnection, scores: list[tuple]) -> list[dict]:
+    """Retrieve the information of the scored documents from the database, best documents first.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Database connection.
+        scores (list[tuple]): Pairs of document and score.
+
+    Returns:
+        list[dict]: Ranked documents.
+    """
+    df_scores = pd.DataFrame(scores, columns=["doc", "score"])
+    return (
+        con.execute(RANKING_SQL)
+        .df()
+        .to_dict("records")
+    )
+
+
+def fetch_postings(
+    con: duckdb.DuckDBPyConnection,
+    search_terms: set[str],
+    index: SegmentSet = None,
+) -> tuple[pd.Series, pd.Series, int]:
+    """Fetch the term frequencies and IDFs of the search terms.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Database connection.
+        search_terms (set[str]): Terms to look up.
+        index (SegmentSet, optional): Index segments to decode the postings from instead of joining the tables in
+            the database.
+
+    Returns:
+        tuple[pd.Series, pd.Series, int]: Term frequencies by document and word, IDFs by word and the number of
+            documents.
     """
+    if index is not None:
+        docs, words, tfs, idfs = [], [], [], {}
+        for term in sorted(search_terms):
+            doc_ids, term_tfs = index.postings(term)
+            if len(doc_ids) == 0:
+                continue
+            docs.append(doc_ids)
+            words.append(np.full(len(doc_ids), term, dtype=object))
+            tfs.append(term_tfs)
+            idfs[term] = index.idf(term)
+
+        df_tf = pd.Series(
+            np.concatenate(tfs) if tfs else np.array([], dtype=np.int64),
+            index=pd.MultiIndex.from_arrays(
+                [
+                    np.concatenate(docs) if docs else np.array([], dtype=np.int64),
+                    np.concatenate(words) if words else np.array([], dtype=object),
+                ],
+                names=["doc", "word"],
+            ),
+            name="tf",
         )
+        df_idf = pd.Series(idfs, name="idf", dtype=np.float64)
+        return df_tf, df_idf, index.num_docs
+
+    terms = sorted(search_terms)
+
+    df_tf = (
+        execute_prepared(con, "rank_tf", terms)
         .df()
         .set_index(["doc", "word"])["tf"]
     )
 
     df_idf = (
-        con.execute(
-            """
-        SELECT w.word, i.idf
-        FROM   idfs AS i, words AS w, df_search AS _(token)
-        WHERE  w.word = token AND w.id = i.word;
+        execute_prepared(con, "rank_idf", terms)
+        .df()
+        .set_index(["word"])["idf"]
+    )
+
+    L = execute_prepared(con, "rank_num_docs").fetchall()[0][0]
+
+    return df_tf, df_idf, L
+
+
+def fetch_bounds(
+    con: duckdb.DuckDBPyConnection,
+    search_terms: set[str],
+    index: SegmentSet = None,
+) -> pd.DataFrame:
+    """Fetch the upper bounds of the term frequencies of the search terms, which are computed at index time.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Database connection.
+        search_terms (set[str]): Terms to look up.
+        index (SegmentSet, optional): Index segments to read the bounds from instead of the database.
+
+    Returns:
+        pd.DataFrame: Highest term frequency (max_tf) and BM25F weighted term frequency (max_wtf) by word, NaN if
+            the statistics were not computed yet.
     """
+    if index is not None:
+        terms = sorted(search_terms)
+        return pd.DataFrame(
+            {
+                "max_tf": [index.max_tf(term) for term in terms],
+                "max_wtf": [index.max_wtf(term) for term in terms],
+            },
+            index=pd.Index(terms, name="word"),
+            dtype=np.float64,
         )
+    return (
+        execute_prepared(con, "rank_bounds", sorted(search_terms))
         .df()
-        .set_index(["word"])["idf"]
+        .set_index("word")
+        .astype(np.float64)
     )
 
-    scores = []
 
-    L = con.execute("SELECT COUNT(*) FROM documents").fetchall()[0][0]
+def index_coefficients(index: SegmentSet, prepared: tuple) -> tuple[list[str], np.ndarray]:
+    """Search terms of a prepared query that the index contains, and their weight times IDF.
 
-    # Iterate over documents
-    for doc_id in df_tf.index.get_level_values("doc").unique().tolist():
-        doc_tf = df_tf.loc[doc_id]
+    Args:
+        index (SegmentSet): Index segments.
+        prepared (tuple): Query as returned by prepare_query.
 
-        # Get words found for document
-        words = set(doc_tf.index.get_level_values("word").tolist())
-        L_d = len(words)
+    Returns:
+        tuple[list[str], np.ndarray]: Search terms and the coefficient of each one.
+    """
+    _, query, expanded_query, sim_weight_list, search_terms = prepared
+    weights = term_weights(query, expanded_query, sim_weight_list)
+    idfs = {term: index.idf(term) for term in sorted(search_terms)}
+    terms = [term for term, idf in idfs.items() if idf is not None]
+    return terms, np.array([weights.get(term, 0.0) * idfs[term] for term in terms])
 
-        score = 0
 
-        # Calculate "classic" BM25 for only query terms
-        for word in set(query).intersection(words):
-            weight = (
-                4 if not expanded_query[word] else 1
-            )  # weight synonym-less words higher
+def term_weights(
+    query: list[str], expanded_query: dict, sim_weight_list: list[tuple]
+) -> dict[str, float]:
+    """Weight of each search term. Query terms without similar words are weighted higher, and the similar words
+    share their weight.
 
-            idf_val = df_idf[word]
-            tf_val = doc_tf[word]
+    Args:
+        query (list[str]): Query terms.
+        expanded_query (dict): Similar words of each query term.
+        sim_weight_list (list[tuple]): Similar words and their weights.
 
-            score += (
-                weight
-                * idf_val
-                * (tf_val * (k1 + 1))
-                / (tf_val + k1 * (1 - b + b * L_d / L))
-            )
+    Returns:
+        dict[str, float]: Weight of each search term.
+    """
+    sim_count = len(sim_weight_list)
+    weights = {word: 4 if not expanded_query.get(word) else 1 for word in set(query)}
+    for synonym, weight in sim_weight_list:
+        weights[synonym] = weights.get(synonym, 0) + weight / sim_count
+    return weights
 
-        # Calculate BM25 for expanded query terms with the according weight
-        for synonym, weight in filter(lambda x: x[0] in words, sim_weight_list):
-            idf_val = df_idf[synonym]
-            tf_val = doc_tf[synonym]
-
-            score += (
-                weight
-                / sim_count
-                * (
-                    idf_val
-                    * (tf_val * (k1 + 1))
-                    / (tf_val + k1 * (1 - b + b * L_d / L))
-                )
+
+def accumulate_scores(docs: np.ndarray, contributions: np.ndarray) -> list[tuple]:
+    """Sum the score contributions of the postings by document, by scatter-adding them into an array indexed by
+    document id.
+
+    Args:
+        docs (np.ndarray): Document of each posting.
+        contributions (np.ndarray): Score contribution of each posting.
+
+    Returns:
+        list[tuple]: Pairs of document and score, by document id.
+    """
+    doc_scores = np.bincount(docs, weights=contributions)
+    doc_ids = np.flatnonzero(np.bincount(docs))
+    return list(zip(doc_ids.tolist(), doc_scores[doc_ids].tolist()))
+
+
+def max_score(
+    docs: np.ndarray,
+    word_index: np.ndarray,
+    bounds: np.ndarray,
+    contribute,
+    k: int,
+    margin: float = 0.0,
+) -> list[tuple]:
+    """Score only the documents that can reach the top k, with MaxScore pruning. The terms are scored one after the
+    other, from the highest upper bound down. The k-th best score so far is a lower bound of the final k-th best
+    score, so once the upper bounds of the remaining terms add up to less than it, documents without any of the
+    scored terms can't reach the top k anymore. From then on only the postings of the documents that still can are
+    scored. Terms with a negative IDF lower the scores, so they are scored first and the scores only grow afterwards.
+
+    Args:
+        docs (np.ndarray): Document of each posting.
+        word_index (np.ndarray): Term of each posting, as index into bounds.
+        bounds (np.ndarray): Upper bound of the score contribution of a posting of each term, negative for the
+            terms that lower the scores.
+        contribute (Callable): Computes the score contributions of the postings at the given indices.
+        k (int): Number of documents, at least 1.
+        margin (float, optional): Upper bound of the score that is added to each document afterwards, e.g. by the
+            proximity boost. Defaults to 0.0.
+
+    Returns:
+        list[tuple]: Pairs of document and score of the documents whose score plus margin reaches the k-th best
+            score.
+    """
+    if k < 1:
+        raise ValueError(f"k must be positive, got {k}")
+
+    # Postings of each term
+    term_postings = np.split(
+        np.argsort(word_index, kind="stable"),
+        np.cumsum(np.bincount(word_index, minlength=len(bounds)))[:-1]
+    )
+
+    doc_scores = np.zeros(docs.max() + 1)
+    scored = np.zeros(len(doc_scores), dtype=bool)
+    candidates = None  # Documents that can still reach the top k, once the remaining terms can't add new ones
+    threshold = -np.inf
+    order = np.lexsort((-bounds, bounds >= 0))
+    for i, term in enumerate(order):
+        postings = term_postings[term]
+        # Highest score the remaining terms can add
+        remaining = np.maximum(bounds[order[i + 1 :]], 0).sum()
+        if candidates is not None:
+            postings = postings[candidates[docs[postings]]]
+        doc_scores += np.bincount(
+            docs[postings], weights=contribute(postings), minlength=len(doc_scores)
+        )
+        scored[docs[postings]] = True
+
+        scored_docs = np.flatnonzero(scored)
+        if len(scored_docs) >= k:
+            threshold = np.partition(doc_scores[scored_docs], -k)[-k]
+        if candidates is None and threshold > remaining + margin:
+            candidates = scored.copy()
+        if candidates is not None:
+            candidates &= doc_scores + remaining + margin >= threshold
+
+    result = np.flatnonzero(scored if candidates is None else candidates)
+    result = result[doc_scores[result] + margin >= threshold]
+    return list(zip(result.tolist(), doc_scores[result].tolist()))
+
+
+def kth_best(scores: np.ndarray, k: int) -> float:
+    """The k-th best of the scores, -inf if there are fewer than k.
+
+    Args:
+        scores (np.ndarray): Scores.
+        k (int): Rank of the score.
+
+    Returns:
+        float: The k-th best score.
+    """
+    return np.partition(scores, -k)[-k] if len(scores) >= k else -np.inf
+
+
+def covering_bounds(blocks: np.ndarray, bounds: np.ndarray, docs: np.ndarray) -> np.ndarray:
+    """Upper bound of the score contribution of a term in each document: the bound of the block that would hold it.
+
+    Args:
+        blocks (np.ndarray): Blocks of the term, see InvertedIndex.blocks.
+        bounds (np.ndarray): Upper bound of the score contribution of each block.
+        docs (np.ndarray): Sorted documents.
+
+    Returns:
+        np.ndarray: Upper bound per document, 0 for documents after the last block.
+    """
+    covering = np.searchsorted(blocks["last_doc"], docs)
+    inside = covering < len(blocks)
+    result = np.zeros(len(docs))
+    result[inside] = bounds[covering[inside]]
+    return result
+
+
+def range_bounds(
+    blocks: np.ndarray, bounds: np.ndarray, firsts: np.ndarray, lasts: np.ndarray
+) -> np.ndarray:
+    """Upper bound of the score contribution of a term in each range of documents: the highest bound of the blocks
+    overlapping it.
+
+    Args:
+        blocks (np.ndarray): Blocks of the term, see InvertedIndex.blocks.
+        bounds (np.ndarray): Upper bound of the score contribution of each block.
+        firsts (np.ndarray): First document of each range, ascending.
+        lasts (np.ndarray): Last document of each range, ascending.
+
+    Returns:
+        np.ndarray: Upper bound per range.
+    """
+    if len(blocks) == 0:
+        return np.zeros(len(firsts))
+    starts = np.searchsorted(blocks["last_doc"], firsts)
+    ends = np.minimum(np.searchsorted(blocks["last_doc"], lasts), len(blocks) - 1) + 1
+    # Ranges after the last block start at the appended 0. The odd rows of reduceat are the gaps between the ranges.
+    indices = np.empty(2 * len(firsts), dtype=np.int64)
+    indices[0::2] = starts
+    indices[1::2] = ends
+    return np.maximum.reduceat(np.append(bounds, 0.0), indices)[0::2]
+
+
+def block_max_score(
+    index: SegmentSet,
+    terms: list[str],
+    coefficients: np.ndarray,
+    contribute,
+    k: int,
+    margin: float = 0.0,
+    weighted: bool = False,
+) -> tuple[list[tuple], np.ndarray, np.ndarray]:
+    """Score only the documents that can reach the top k, with block-max MaxScore pruning on the blocks of the
+    inverted index. Unlike max_score, the postings are not decoded upfront: each block of a term stores the highest
+    term frequency of its postings, and only the blocks that can hold documents of the top k are decoded.
+
+    The terms are processed one after the other, from the highest upper bound down. The k-th best lower bound of the
+    candidate scores is a lower bound of the final k-th best score. A block of a term can only add new candidates if
+    its bound plus the bounds of the blocks of the remaining terms over the same documents exceeds it, so the other
+    blocks are skipped, and the blocks with the highest bounds are decoded first to raise it quickly. Of the remaining terms, only the blocks holding the
+    candidates are decoded, and candidates whose upper bound falls below it are dropped. Once all terms are
+    processed, the candidates are scored exactly.
+
+    Args:
+        index (SegmentSet): Index to decode the blocks from, see SegmentSet.parts.
+        terms (list[str]): Search terms.
+        coefficients (np.ndarray): Non-negative coefficient of each term, e.g. weight times IDF.
+        contribute (Callable): Score contributions of (weighted) term frequencies, given the coefficients and the
+            number of search terms in the documents, broadcasting like NumPy. Has to grow with the term frequency
+            and the coefficient and shrink with the number of search terms.
+        k (int): Number of documents, at least 1.
+        margin (float, optional): Upper bound of the score that is added to each document afterwards, e.g. by the
+            proximity boost. Defaults to 0.0.
+        weighted (bool, optional): Whether to score the BM25F weighted term frequencies instead of the term
+            frequencies. Defaults to False.
+
+    Returns:
+        tuple[list[tuple], np.ndarray, np.ndarray]: Pairs of document and score of the documents whose score plus
+            margin reaches the k-th best score, and the document and word of their postings.
+    """
+    if k < 1:
+        raise ValueError(f"k must be positive, got {k}")
+
+    coefficients = np.asarray(coefficients, dtype=np.float64)
+    all_docs, all_scores, postings_docs, postings_words = [], [], [], []
+    for segment, live in index.parts():
+        docs, values, present = prune_blocks(
+            segment,
+            live,
+            terms,
+            coefficients,
+            contribute,
+            k,
+            margin,
+            weighted,
+            np.concatenate(all_scores or [np.array([])]),
+        )
+        # All search terms of the candidates are known now, so their scores are exact
+        scores = contribute(values, coefficients[:, None], present.sum(axis=0)).sum(axis=0)
+        all_docs.append(docs)
+        all_scores.append(scores)
+        words, columns = np.nonzero(present)
+        postings_docs.append(docs[columns])
+        postings_words.append(np.asarray(terms, dtype=object)[words])
+
+    docs = np.concatenate(all_docs)
+    scores = np.concatenate(all_scores)
+    postings_docs = np.concatenate(postings_docs)
+    postings_words = np.concatenate(postings_words)
+    reached = scores + margin >= kth_best(scores, k)
+    in_result = np.isin(postings_docs, docs[reached])
+    return (
+        list(zip(docs[reached].tolist(), scores[reached].tolist())),
+        postings_docs[in_result],
+        postings_words[in_result],
+    )
+
+
+def prune_blocks(
+    segment: InvertedIndex,
+    live,
+    terms: list[str],
+    coefficients: np.ndarray,
+    contribute,
+    k: int,
+    margin: float,
+    weighted: bool,
+    scored: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find the documents of one segment that can reach the top k, see block_max_score.
+
+    Args:
+        segment (InvertedIndex): Segment to decode the blocks from.
+        live (Callable): Mask of the live documents among the given ones, None if all are live.
+        terms, coefficients, contribute, k, margin, weighted: See block_max_score.
+        scored (np.ndarray): Exact scores of the candidates of the segments processed before.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Sorted candidate documents, the (weighted) term frequency of each
+            term in each of them, and whether it contains the term.
+    """
+    num_terms = len(terms)
+    blocks = [segment.blocks(term) for term in terms]
+    field = "max_wtf" if weighted else "max_tf"
+    block_bounds = [
+        contribute(term_blocks[field].astype(np.float64), coefficient, 1)
+        for term_blocks, coefficient in zip(blocks, coefficients)
+    ]
+    term_bounds = np.array([bounds.max(initial=0.0) for bounds in block_bounds])
+    order = np.argsort(-term_bounds, kind="stable")
+
+    # Candidates, with a row per term. The terms processed so far are known for every candidate.
+    docs = np.array([], dtype=np.int64)
+    values = np.zeros((num_terms, 0))
+    present = np.zeros((num_terms, 0), dtype=bool)
+    # Candidates and documents that can't reach the top k by document id, and the blocks of each processed term that
+    # added candidates
+    num_ids = int(segment.doc_ids[-1]) + 1 if len(segment.doc_ids) else 0
+    is_candidate = np.zeros(num_ids, dtype=bool)
+    rejected = np.zeros(num_ids, dtype=bool)
+    opened = [np.zeros(len(term_blocks), dtype=bool) for term_blocks in blocks]
+
+    def threshold() -> float:
+        # A document contains at most all search terms, which gives the lowest contributions
+        lower = contribute(values, coefficients[:, None], num_terms).sum(axis=0)
+        return kth_best(np.concatenate((scored, lower)), k)
+
+    for step, term in enumerate(order):
+        remaining = order[step:]
+
+        # Drop the candidates that can't reach the top k anymore, bounding the remaining terms by their blocks
+        theta = threshold()
+        upper = contribute(values, coefficients[:, None], 1).sum(axis=0)
+        for other in remaining:
+            upper += covering_bounds(blocks[other], block_bounds[other], docs)
+        keep = upper + margin >= theta
+        is_candidate[docs[~keep]] = False
+        rejected[docs[~keep]] = True
+        docs, values, present = docs[keep], values[:, keep], present[:, keep]
+
+        last_docs = blocks[term]["last_doc"]
+        if len(last_docs) == 0:
+            continue
+        # Highest score the terms after this one can add to the documents of each block
+        firsts = np.concatenate(([0], last_docs[:-1] + 1))
+        rest = np.zeros(len(last_docs))
+        for other in remaining[1:]:
+            rest += range_bounds(blocks[other], block_bounds[other], firsts, last_docs)
+        # Blocks holding candidates are always decoded. Blocks that can add new candidates are decoded best first, in
+        # growing batches, skipping the ones that can't anymore as the threshold rises. Documents that can only tie
+        # with the threshold don't change the top k scores.
+        covering = np.unique(np.searchsorted(last_docs, docs))
+        covering = covering[covering < len(last_docs)]
+        bounds = block_bounds[term]
+        pending = np.flatnonzero(bounds + rest + margin > theta)
+        pending = pending[np.argsort(-bounds[pending], kind="stable")]
+        batch_size = -(-k // BLOCK_SIZE) + 1
+        first = True
+        while first or len(pending):
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            selected = np.union1d(batch, covering) if first else np.sort(batch)
+            first = False
+            batch_docs, batch_values = segment.decode_blocks(
+                terms[term], selected, weighted=weighted
             )
+            mask = live(batch_docs)
+            if mask is not None:
+                batch_docs, batch_values = batch_docs[mask], batch_values[mask]
+
+            # Candidates found in the decoded blocks
+            positions = np.searchsorted(batch_docs, docs)
+            found = positions < len(batch_docs)
+            found[found] = batch_docs[positions[found]] == docs[found]
+            values[term, found] = batch_values[positions[found]]
+            present[term, found] = True
+
+            # New candidates come from the blocks of the batch. They don't contain the processed terms, unless they
+            # are in a block of one that was skipped, and then they can't reach the top k.
+            opened[term][batch] = True
+            new = opened[term][np.searchsorted(last_docs, batch_docs)]
+            new &= ~is_candidate[batch_docs] & ~rejected[batch_docs]
+            upper = contribute(batch_values.astype(np.float64), coefficients[term], 1)
+            for other in remaining[1:]:
+                upper += covering_bounds(blocks[other], block_bounds[other], batch_docs)
+            reachable = upper + margin > theta
+            for other in order[:step]:
+                other_blocks = np.searchsorted(blocks[other]["last_doc"], batch_docs)
+                inside = other_blocks < len(blocks[other])
+                reachable[inside] &= opened[other][other_blocks[inside]]
+            rejected[batch_docs[new & ~reachable]] = True
+            new &= reachable
+
+            if new.any():
+                new_values = np.zeros((num_terms, int(new.sum())))
+                new_values[term] = batch_values[new]
+                new_present = np.zeros(new_values.shape, dtype=bool)
+                new_present[term] = True
+                is_candidate[batch_docs[new]] = True
+                docs = np.concatenate((docs, batch_docs[new]))
+                values = np.concatenate((values, new_values), axis=1)
+                present = np.concatenate((present, new_present), axis=1)
+                by_doc = np.argsort(docs, kind="stable")
+                docs, values, present = docs[by_doc], values[:, by_doc], present[:, by_doc]
+
+            theta = threshold()
+            pending = pending[bounds[pending] + rest[pending] + margin > theta]
+            batch_size *= 2
+
+    return docs, values, present
+
 
-        scores.append((doc_id, score))
+def score_bm25(
+    query: list[str],
+    expanded_query: dict,
+    sim_weight_list: list[tuple],
+    df_tf: pd.Series,
+    df_idf: pd.Series,
+    L: int,
+    k1=1.5,
+    b=0.75,
+    k: int = None,
+    margin: float = 0.0,
+    max_tfs: dict[str, int] = None,
+) -> list[tuple]:
+    """Score the documents containing any search term with BM25, as array operations over all postings at once.
+
+    Args:
+        query (list[str]): Query terms.
+        expanded_query (dict): Similar words of each query term.
+        sim_weight_list (list[tuple]): Similar words and their weights.
+        df_tf (pd.Series): Term frequencies by document and word.
+        df_idf (pd.Series): IDFs by word.
+        L (int): Number of documents.
+        k1 (float, optional): BM25 term frequency saturation. Defaults to 1.5.
+        b (float, optional): BM25 length normalization. Defaults to 0.75.
+        k (int, optional): Only score the documents that can reach the top k, see max_score. Defaults to None.
+        margin (float, optional): Upper bound of the score added afterwards, see max_score. Defaults to 0.0.
+        max_tfs (dict[str, float], optional): Highest term frequency of each search term, see fetch_bounds. Computed
+            from the postings if None.
+
+    Returns:
+        list[tuple]: Pairs of document and score.
+    """
+    docs = df_tf.index.get_level_values("doc").to_numpy(dtype=np.int64)
+    if len(docs) == 0:
+        return []
+    words = df_tf.index.get_level_values("word").to_numpy()
+    tfs = df_tf.to_numpy(dtype=np.float64)
+
+    # Weight times IDF of each search term, spread over its postings
+    weights = term_weights(query, expanded_query, sim_weight_list)
+    unique_words, word_index = np.unique(words, return_inverse=True)
+    term_coefficients = np.array(
+        [weights[word] * df_idf[word] if word in weights else 0.0 for word in unique_words]
+    )
+    coefficients = term_coefficients[word_index]
+
+    # The document length is the number of search terms found in the document
+    L_d = np.bincount(docs)[docs]
+
+    def contribute(postings):
+        tf = tfs[postings]
+        return coefficients[postings] * (tf * (k1 + 1)) / (tf + k1 * (1 - b + b * L_d[postings] / L))
+
+    if k is None:
+        return accumulate_scores(docs, contribute(slice(None)))
+
+    # A document contains at least one search term, which gives the highest contribution of a term frequency
+    if max_tfs is None:
+        term_max_tfs = np.zeros(len(unique_words))
+        np.maximum.at(term_max_tfs, word_index, tfs)
+    else:
+        term_max_tfs = np.array(
+            [max_tfs.get(word, np.nan) for word in unique_words], dtype=np.float64
+        )
+    bounds = (
+        term_coefficients
+        * (term_max_tfs * (k1 + 1))
+        / (term_max_tfs + k1 * (1 - b + b / L))
+    )
+    # Without a bound of the term frequency, the contribution still saturates
+    bounds = np.where(np.isnan(term_max_tfs), term_coefficients * (k1 + 1), bounds)
+    return max_score(docs, word_index, bounds, contribute, k, margin=margin)
+
+
+def score_query_bm25(
+    con: duckdb.DuckDBPyConnection,
+    prepared: tuple,
+    index: SegmentSet = None,
+    k1=1.5,
+    b=0.75,
+    phrase_weight=2.0,
+    proximity_weight=1.0,
+    k: int = None,
+    timings: dict = None,
+) -> list[tuple]:
+    """Score the documents for a prepared query with BM25, including phrases and proximity.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Database connection, unused if an index is given.
+        prepared (tuple): Query as returned by prepare_query.
+        index (SegmentSet, optional): Index to decode the postings from instead of the database.
+        k (int, optional): Number of documents to return, all if None.
+        timings (dict, optional): Receives the seconds spent fetching the postings and scoring, see evaluate.py.
+
+    Returns:
+        list[tuple]: Pairs of document and score, best documents first if k is given.
+    """
+    phrases, query, expanded_query, sim_weight_list, search_terms = prepared
+    margin = proximity_margin(query, proximity_weight)
+    # The phrase filter can remove any document, so phrase queries are scored exhaustively
+    top_k = k if not phrases else None
+
+    start = time.perf_counter()
+    if top_k is not None and index is not None:
+        terms, coefficients = index_coefficients(index, prepared)
+    if top_k is not None and index is not None and (coefficients >= 0).all():
+        # Only decode the blocks of the postings that can hold documents of the top k
+        L = index.num_docs
+        fetched = time.perf_counter()
+
+        def contribute(tfs, coefficients, L_d):
+            return coefficients * (tfs * (k1 + 1)) / (tfs + k1 * (1 - b + b * L_d / L))
+
+        scores, docs, words = block_max_score(
+            index, terms, coefficients, contribute, top_k, margin=margin
+        )
+    else:
+        # Query TF and IDF for desired search terms
+        df_tf, df_idf, L = fetch_postings(con, search_terms, index=index)
+        max_tfs = (
+            fetch_bounds(con, search_terms, index=index)["max_tf"].to_dict()
+            if top_k is not None
+            else None
+        )
+        fetched = time.perf_counter()
+
+        scores = score_bm25(
+            query,
+            expanded_query,
+            sim_weight_list,
+            df_tf,
+            df_idf,
+            L,
+            k1=k1,
+            b=b,
+            k=top_k,
+            margin=margin,
+            max_tfs=max_tfs,
+        )
+        docs = df_tf.index.get_level_values("doc").to_numpy(dtype=np.int64)
+        words = df_tf.index.get_level_values("word").to_numpy()
+
+    # Phrase filter and proximity boost from the position lists
+    if phrases or (proximity_weight and len(set(query)) > 1):
+        scores = score_positions(
+            con,
+            scores,
+            position_candidates(docs, words, query, phrases),
+            query,
+            phrases,
+            k1=k1,
+            phrase_weight=phrase_weight,
+            proximity_weight=proximity_weight,
+            index=index,
+        )
+
+    if k is not None:
+        scores = heapq.nlargest(k, scores, key=itemgetter(1))
+    if timings is not None:
+        timings["postings"] = fetched - start
+        timings["scoring"] = time.perf_counter() - fetched
+    return scores
+
+
+def bm25(
+    query: str,
+    dbcon: duckdb.DuckDBPyConnection,
+    k1=1.5,
+    b=0.75,
+    phrase_weight=2.0,
+    proximity_weight=1.0,
+    k: int = None,
+    debug: bool = False,
+) -> list[dict]:
+    """
+    Rank documents by BM25. Additionally, use similar words aswell for ranking, however with a lower weight/portion.
+    Quoted phrases have to occur in a document, and documents with query terms close to each other get a proximity
+    boost.
+    """
+
+    prepared = prepare_query(query, debug=debug)
+
+    con = dbcon  # Rename DB connection
+    scores = score_query_bm25(
+        con,
+        prepared,
+        index=get_index(),
+        k1=k1,
+        b=b,
+        phrase_weight=phrase_weight,
+        proximity_weight=proximity_weight,
+        k=k,
+    )
 
     # Retrieve Document information from DB in ranked fashion
-    df_scores = pd.DataFrame(scores, columns=["doc", "score"])
-    ranking = (
-        con.execute(
-            """
-        SELECT d.id AS id, d.title AS title, d.link AS url,
-               d.description AS description, d.summary AS summary,
-               s.score AS score
-        FROM   documents AS d, df_scores AS s
-        WHERE  d.id = s.doc
-        ORDER BY s.score DESC
+    return fetch_ranking(con, scores)
+
+
+def fetch_weighted_postings(
+    con: duckdb.DuckDBPyConnection,
+    search_terms: set[str],
+    index: SegmentSet = None,
+) -> list[tuple]:
+    """Fetch the BM25F weighted term frequencies and IDFs of the search terms.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): Database connection.
+        search_terms (set[str]): Terms to look up.
+        index (SegmentSet, optional): Index segments to decode the postings from instead of the database.
+
+    Returns:
+        tuple[np.ndarray, ...]: Document, word, weighted term frequency and IDF of each posting.
     """
+    if index is not None:
+        docs, words, wtfs, idfs = [], [], [], []
+        for term in sorted(search_terms):
+            doc_ids, _ = index.postings(term)
+            if len(doc_ids) == 0:
+                continue
+            docs.append(doc_ids)
+            words.append(np.full(len(doc_ids), term, dtype=object))
+            wtfs.append(index.weighted_tfs(term))
+            idfs.append(np.full(len(doc_ids), index.idf(term)))
+        if not docs:
+            return (
+                np.array([], dtype=np.int64),
+                np.array([], dtype=object),
+                np.array([]),
+                np.array([]),
+            )
+        return (
+            np.concatenate(docs).astype(np.int64),
+            np.concatenate(words),
+            np.concatenate(wtfs).astype(np.float64),
+            np.concatenate(idfs),
         )
-        .df()
-        .to_dict("records")
+
+    df_postings = execute_prepared(
+        con, "rank_weighted_postings", sorted(search_terms)
+    ).df()
+    return (
+        df_postings["doc"].to_numpy(dtype=np.int64),
+        df_postings["word"].to_numpy(dtype=object),
+        # Postings without statistics yet count as not found
+        df_postings["wtf"].fillna(0).to_numpy(dtype=np.float64),
+        df_postings["idf"].to_numpy(dtype=np.float64),
     )
 
-    con.close()
 
-    return ranking
+def score_query_bm25f(
+    con: duckdb.DuckDBPyConnection,
+    prepared: tuple,
+    index: SegmentSet = None,
+    k1=1.2,
+    phrase_weight=2.0,
+    proximity_weight=1.0,
+    k: int = None,
+    timings: dict = None,
+) -> list[tuple]:
+    """Score the documents for a prepared query with BM25F, including phrases and proximity.
 
+    Args:
+        con (duckdb.DuckDBPyConnection): Database connection, unused if an index is given.
+        prepared (tuple): Query as returned by prepare_query.
+        index (SegmentSet, optional): Index to decode the postings from instead of the database.
+        k (int, optional): Number of documents to return, all if None.
+        timings (dict, optional): Receives the seconds spent fetching the postings and scoring, see evaluate.py.
 
-def rank(query: str, debug: bool = False) -> list[dict]:
+    Returns:
+        list[tuple]: Pairs of document and score, best documents first if k is given.
     """
-    Rank the documents according to the query.
+    phrases, query, expanded_query, sim_weight_list, search_terms = prepared
+    margin = proximity_margin(query, proximity_weight)
+    # The phrase filter can remove any document, so phrase queries are scored exhaustively
+    top_k = k if not phrases else None
+
+    start = time.perf_counter()
+    if top_k is not None and index is not None:
+        terms, term_coefficients = index_coefficients(index, prepared)
+    if top_k is not None and index is not None and (term_coefficients >= 0).all():
+        # Only decode the blocks of the postings that can hold documents of the top k
+        fetched = time.perf_counter()
+
+        def contribute_blocks(wtfs, coefficients, _):
+            return coefficients * (wtfs * (k1 + 1)) / (wtfs + k1)
+
+        scores, docs, words = block_max_score(
+            index,
+            terms,
+            term_coefficients,
+            contribute_blocks,
+            top_k,
+            margin=margin,
+            weighted=True,
+        )
+    else:
+        # Query the weighted TF and IDF for desired search terms
+        docs, words, wtfs, idfs = fetch_weighted_postings(con, search_terms, index=index)
+        max_wtfs = (
+            fetch_bounds(con, search_terms, index=index)["max_wtf"]
+            if top_k is not None
+            else None
+        )
+        fetched = time.perf_counter()
+        if len(docs) == 0:
+            if timings is not None:
+                timings["postings"], timings["scoring"] = fetched - start, 0.0
+            return []
+
+        # Weight of each search term, spread over its postings
+        weights = term_weights(query, expanded_query, sim_weight_list)
+        unique_words, word_index = np.unique(words, return_inverse=True)
+        term_weights_array = np.array([weights[word] for word in unique_words])
+        coefficients = term_weights_array[word_index] * idfs
+
+        def contribute(postings):
+            wtf = wtfs[postings]
+            return coefficients[postings] * (wtf * (k1 + 1)) / (wtf + k1)
+
+        if top_k is None:
+            scores = accumulate_scores(docs, contribute(slice(None)))
+        else:
+            # Highest contribution of each term, from the highest weighted term frequency
+            term_max_wtfs = max_wtfs.reindex(unique_words).to_numpy()
+            term_idfs = np.zeros(len(unique_words))
+            term_idfs[word_index] = idfs
+            term_coefficients = term_weights_array * term_idfs
+            bounds = term_coefficients * (term_max_wtfs * (k1 + 1)) / (term_max_wtfs + k1)
+            # Without a bound of the weighted term frequency, the contribution still saturates
+            bounds = np.where(
+                np.isnan(term_max_wtfs), term_coefficients * (k1 + 1), bounds
+            )
+            scores = max_score(docs, word_index, bounds, contribute, top_k, margin=margin)
+
+    # Phrase filter and proximity boost from the position lists
+    if phrases or (proximity_weight and len(set(query)) > 1):
+        scores = score_positions(
+            con,
+            scores,
+            position_candidates(docs, words, query, phrases),
+            query,
+            phrases,
+            k1=k1,
+            phrase_weight=phrase_weight,
+            proximity_weight=proximity_weight,
+            index=index,
+        )
+
+    if k is not None:
+        scores = heapq.nlargest(k, scores, key=itemgetter(1))
+    if timings is not None:
+        timings["postings"] = fetched - start
+        timings["scoring"] = time.perf_counter() - fetched
+    return scores
+
+
+def bm25f(
+    query: str,
+    dbcon: duckdb.DuckDBPyConnection,
+    k1=1.2,
+    phrase_weight=2.0,
+    proximity_weight=1.0,
+    k: int = None,
+    debug: bool = False,
+) -> list[dict]:
+    """
+    Rank documents by BM25F, i.e. BM25 over the weighted term frequencies of the document fields (title, headings,
+    body, ...). The field weights and the length normalization of each field are precomputed by
+    index.compute_statistics, so they add no cost per query. Similar words, phrases and proximity are handled like
+    in bm25.
+    """
+
+    prepared = prepare_query(query, debug=debug)
+
+    con = dbcon  # Rename DB connection
+    scores = score_query_bm25f(
+        con,
+        prepared,
+        index=get_index(),
+        k1=k1,
+        phrase_weight=phrase_weight,
+        proximity_weight=proximity_weight,
+        k=k,
+    )
+
+    # Retrieve Document information from DB in ranked fashion
+    return fetch_ranking(con, scores)
+
+
+def fuse_rankings(rankings: list[list[tuple]], k: int | None = None) -> list[tuple]:
+    """Fuse rankings by reciprocal rank fusion: a document scores 1 / (RRF_K + rank) in each ranking it occurs in.
+    The scores of the rankings don't have to be comparable.
+
     Args:
-        query:
-        debug:
+        rankings (list[list[tuple]]): Pairs of document and score of each ranking, best first.
+        k (int, optional): Number of documents to return, all if None.
 
     Returns:
+        list[tuple]: Pairs of document and fused score, best first.
+    """
+    fused = {}
+    for ranking in rankings:
+        for position, (doc_id, _) in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1 / (RRF_K + position)
+    fused = sorted(fused.items(), key=itemgetter(1), reverse=True)
+    return fused if k is None else fused[:k]
+
+
+def add_dense_ranking(
+    con: duckdb.DuckDBPyConnection,
+    prepared: tuple,
+    scores: list[tuple],
+    start: float,
+    k: int | None = None,
+) -> list[tuple]:
+    """Fuse the lexical ranking with the documents closest to the query embedding, see dense.py. The lexical
+    ranking is kept if there are no document embeddings, no query term has a vector, or the lexical ranking already
+    used up the latency budget.
 
+    Args:
+        con (duckdb.DuckDBPyConnection): Database connection.
+        prepared (tuple): Query as returned by prepare_query.
+        scores (list[tuple]): Pairs of document and lexical score, best first.
+        start (float): Start time of the lexical ranking, from time.perf_counter.
+        k (int, optional): Number of documents to return, all if None.
+
+    Returns:
+        list[tuple]: Pairs of document and score, best first.
     """
-    con = duckdb.connect("crawlies.db")
-    return bm25(query, con, debug=debug)
+    lexical = scores if k is None else scores[:k]
+    document_embeddings = get_document_embeddings()
+    store = get_embeddings()
+    if document_embeddings is None or store is None:
+        return lexical
+    if time.perf_counter() - start > DENSE_LATENCY_BUDGET:
+        print("Latency budget used up, skipping the dense ranking")
+        return lexical
+    query_vector = embed_query(prepared[1], store)
+    if query_vector is None:
+        return lexical
 
+    dense = document_embeddings.search(query_vector, HYBRID_CANDIDATES)
+    # The embeddings are only rebuilt with the index, deleted documents are filtered here
+    candidates = [doc_id for doc_id, _ in dense]
+    deleted = {doc_id for doc_id, in execute_prepared(con, "rank_deleted", candidates).fetchall()}
+    dense = [(doc_id, score) for doc_id, score in dense if doc_id not in deleted]
+    return fuse_rankings([scores, dense], k)
 
-def rank_from_file(filepath: str) -> list[list]:
+
+def hybrid(
+    query: str,
+    dbcon: duckdb.DuckDBPyConnection,
+    k: int = None,
+    debug: bool = False,
+) -> list[dict]:
+    """
+    Rank documents by fusing the BM25 ranking with the dense ranking of the document embeddings. Documents can be
+    found by words similar to the query terms, even if they contain none of the query terms.
     """
-    Rank queries from a file.
+    prepared = prepare_query(query, debug=debug)
+    start = time.perf_counter()
+    scores = score_query_bm25(dbcon, prepared, index=get_index(), k=HYBRID_CANDIDATES)
+    scores = add_dense_ranking(dbcon, prepared, scores, start, k=k)
+
+    # Retrieve Document information from DB in ranked fashion
+    return fetch_ranking(dbcon, scores)
+
+
+# Available ranking functions
+RANKING_FUNCTIONS = {"bm25": bm25, "bm25f": bm25f, "hybrid": hybrid}
+# Scoring of a prepared query, run by each shard
+SCORING_FUNCTIONS = {"bm25": score_query_bm25, "bm25f": score_query_bm25f}
+
+
+def get_shards() -> ShardPool | None:
+    """
+    Get the worker processes of the index shards. The workers are restarted when the shards were exported again.
+    Returns None if there are no shards, then queries are answered from the segments or the database.
+    """
+    global shard_pool
+    version = shards_version(SHARD_DIRECTORY)
+    if shard_pool is not None and shard_pool.version != version:
+        shard_pool.close(wait=False)
+        shard_pool = None
+    if shard_pool is None and version:
+        shard_pool = ShardPool(SHARD_DIRECTORY)
+    return shard_pool
+
+
+def sharded_rank(
+    query: str,
+    dbcon: duckdb.DuckDBPyConnection,
+    shards: ShardPool,
+    ranking: str = "bm25",
+    k: int | None = None,
+    debug: bool = False,
+) -> list[dict]:
+    """
+    Rank documents by scatter-gather over the index shards: the query is expanded once, scored by all shards in
+    parallel, and the top documents of the shards are merged, together with the top documents that were added to the
+    index segments after the shards were exported.
+    Args:
+        query: User query
+        dbcon: Database connection
+        shards: Worker processes of the shards
+        ranking: Ranking function, one of SCORING_FUNCTIONS or hybrid
+        k: Number of documents to return, all if None
+        debug: Print debug information
+
+    Returns: Ranked documents
+    """
+    prepared = prepare_query(query, debug=debug)
+    start = time.perf_counter()
+
+    # Documents added after the shards were exported are only in the index segments, and
+    # the documents deleted since are only tombstoned there
+    index = get_index()
+    newer = (
+        index.newer_than(shards.max_doc)
+        if index is not None and index.max_doc > shards.max_doc
+        else None
+    )
+    tombstones = index.tombstones if index is not None else np.array([], dtype=np.int64)
+
+    def search(scoring: str, n: int | None) -> list[tuple]:
+        scores = shards.search(
+            scoring, prepared, k=n + len(tombstones) if n is not None else None
+        )
+        if len(tombstones):
+            deleted = set(tombstones.tolist())
+            scores = [score for score in scores if score[0] not in deleted]
+        new_scores = (
+            SCORING_FUNCTIONS[scoring](dbcon, prepared, index=newer, k=n)
+            if newer is not None
+            else []
+        )
+        return merge_scores([scores, new_scores], k=n)
+
+    if ranking == "hybrid":
+        # The shards rank lexically, the dense ranking is fused afterwards
+        scores = search("bm25", HYBRID_CANDIDATES)
+        scores = add_dense_ranking(dbcon, prepared, scores, start, k=k)
+    else:
+        scores = search(ranking, k)
+    return fetch_ranking(dbcon, scores)
+
+
+def index_generation() -> tuple:
+    """
+    Cheap check whether anything the ranking reads changed: the shards, the segments or the database. The database
+    file and its write-ahead log change whenever documents are added or deleted.
+    """
+    database = []
+    for path in (DATABASE, DATABASE + ".wal"):
+        try:
+            stat = os.stat(path)
+            database.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            database.append(None)
+    return (
+        shards_version(SHARD_DIRECTORY),
+        manifest_version(INDEX_DIRECTORY),
+        tuple(database),
+    )
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize the whitespace of a query. Queries that only differ in whitespace are ranked the same, case is kept
+    because it changes the lemmas of spaCy.
+    """
+    return " ".join(query.split())
+
+
+def rank(
+    query: str, debug: bool = False, ranking: str = "bm25", k: int | None = None
+) -> list[dict]:
+    """
+    Rank the documents according to the query. The rankings of recent queries are cached until the index changes,
+    the returned list is shared by the callers and must not be modified.
     Args:
-        filepath:
+        query: User query
+        debug: Print debug information, neither reads nor fills the cache
+        ranking: Ranking function, one of RANKING_FUNCTIONS
+        k: Number of documents to return, at least 1, all if None
 
     Returns:
 
+    """
+    if k is not None and k < 1:
+        raise ValueError(f"k must be positive, got {k}")
+    key = (normalize_query(query), k, ranking)
+    if not debug:
+        result_cache.check_generation(index_generation())
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached
+
+    shards = get_shards()
+    with borrow_cursor() as con:
+        if shards is not None:
+            result = sharded_rank(query, con, shards, ranking=ranking, k=k, debug=debug)
+        else:
+            result = RANKING_FUNCTIONS[ranking](query, con, k=k, debug=debug)
+    if not debug:
+        result_cache.put(key, result)
+    return result
+
+
+def read_queries(filepath: str) -> list[str]:
+    """
+    Read the queries of a file with a numbered query per line, e.g. queries.txt.
+    Args:
+        filepath: Path of the file
+
+    Returns: Queries in the order of the file
     """
     queries = []
     with open(filepath, "r") as file:
@@ -224,26 +1833,75 @@ def rank_from_file(filepath: str) -> list[list]:
                 continue
             number, item = line.split(maxsplit=1)
             queries.append(item)
+    return queries
 
-    # Return the ranked queries
-    print("Ranking queries ...")
-    rankings = [rank(query) for query in queries]
-
-    # Generate results.txt from rankings
-    print("Generating result.txt ...")
-    with open("result.txt", "w") as file:
-        for i, ranking in enumerate(rankings):
-            query_number = i + 1
-            for doc in ranking:
-                file.write(
-                    f'{query_number}\t{doc["id"]}\t{doc["url"]}\t{doc["score"]}\n'
-                )
-    print("result.txt generated.")
-    return rankings
 
+def _init_batch_worker():
+    """
+    Load the models and the index once per batch worker.
+    """
+    global connection, cursor_pool, borrowed
+    # A forked worker opens its own connection
+    connection = None
+    cursor_pool = None
+    borrowed = threading.local()
+    get_nlp()
+    get_index()
+
+
+def _rank_batch_query(query: str, ranking: str, k: int) -> tuple[list[tuple], float]:
+    # The batch workers already run in parallel, so they rank on the segments instead of the shards
+    start = time.perf_counter()
+    with borrow_cursor() as con:
+        documents = RANKING_FUNCTIONS[ranking](query, con, k=k)
+    latency = time.perf_counter() - start
+    return [(doc["id"], doc["url"], doc["score"]) for doc in documents], latency
+
+
+def rank_from_file(
+    filepath: str,
+    k: int = RESULTS_PER_QUERY,
+    processes: int = BATCH_PROCESSES,
+    ranking: str = "bm25",
+    output: str = "result.txt",
+) -> list[list]:
+    """
+    Rank queries from a file in parallel worker processes, which load the models and the index once. The top
+    documents of each query are written to the output file as soon as the query is ranked. No connection to the
+    database may be open while the workers are forked.
+    Args:
+        filepath: File with a numbered query per line, see read_queries
+        k: Number of documents per query
+        processes: Number of worker processes
+        ranking: Ranking function, one of RANKING_FUNCTIONS
+        output: File of the results
 
-if __name__ == "__main__":
-    res = rank("food an drink", debug=True)
-    print(res[:10])
-    res = rank("Tübingen publications", debug=True)
-    print(res[:10])
+    Returns: Document id, URL and score of the top documents of each query
+    """
+    queries = read_queries(filepath)
+
+    print(f"Ranking {len(queries)} queries with {processes} processes ...")
+    rankings, latencies = [], []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_batch_worker,
+    ) as executor, open(output, "w") as file:
+        results = executor.map(
+            partial(_rank_batch_query, ranking=ranking, k=k), queries
+        )
+        for query_number, (documents, latency) in enumerate(results, start=1):
+            for doc_id, url, score in documents:
+                file.write(f"{query_number}\t{doc_id}\t{url}\t{score}\n")
+            rankings.append(documents)
+            latencies.append(latency)
+    elapsed = time.perf_counter() - start
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99]) if latencies else (0, 0, 0)
+    print(f"{output} generated.")
+    print(
+        f"Ranked {len(queries)} queries in {elapsed:.2f} s ({len(queries) / elapsed:.1f} queries/s), latency "
+        f"p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms"
+    )
+    return rankings
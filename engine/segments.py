@@ -0,0 +1,570 @@
+import copy
+import functools
+import json
+import math
+import os
+import threading
+from typing import Callable
+
+import duckdb
+import numpy as np
+
+from index import FIELD_B, FIELD_WEIGHTS, field_averages
+from inverted_index import InvertedIndex, write_index, write_postings
+from tokenizer import FIELDS
+from utils import delta_encode
+
+"""
+The index for serving queries consists of immutable segments, each one an inverted index file (see
+inverted_index.py). New documents are flushed into a fresh segment, a background thread merges segments of similar
+size, and the manifest lists the live segments and the deleted documents (tombstones). The manifest is replaced
+atomically, so queries always read a consistent set of segments while documents are added, deleted or merged.
+Merges drop the postings of deleted documents.
+"""
+
+# Directory of the index segments, next to crawlies.db
+INDEX_DIRECTORY = "index"
+# List of the live segments
+MANIFEST = "manifest.json"
+# Number of segments of similar size that are merged into one
+MERGE_FACTOR = 8
+# Number of document frequencies without the deleted documents that are cached per index generation
+DF_CACHE_SIZE = 100_000
+
+
+def read_manifest(directory: str) -> dict:
+    """
+    Reads the manifest of the index segments.
+    Args:
+        directory: Directory of the segments
+
+    Returns: Generation of the index, live segments, deleted documents and the number of the next segment
+    """
+    path = os.path.join(directory, MANIFEST)
+    manifest = {"generation": 0, "segments": [], "tombstones": [], "next_segment": 1}
+    if os.path.isfile(path):
+        with open(path, "r") as file:
+            manifest.update(json.load(file))
+    return manifest
+
+
+def manifest_version(directory: str) -> tuple | None:
+    """
+    Cheap check whether the manifest changed, without reading it. Every commit replaces the manifest file, which
+    changes its inode.
+    Args:
+        directory: Directory of the segments
+
+    Returns: Version of the manifest, or None if there is no manifest
+    """
+    try:
+        stat = os.stat(os.path.join(directory, MANIFEST))
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+class SegmentSet:
+    """
+    Read-only view on the segments of one index generation. A query keeps using the same SegmentSet, so it sees a
+    consistent index while segments are added or merged.
+    """
+
+    def __init__(self, directory: str = INDEX_DIRECTORY, previous=None):
+        self.directory = directory
+        # Segments that are already mapped are reused
+        mapped = previous.segments if previous is not None else {}
+
+        for _ in range(3):
+            self.version = manifest_version(directory)
+            manifest = read_manifest(directory)
+            try:
+                self.segments = {
+                    name: mapped.get(name)
+                    or InvertedIndex(os.path.join(directory, name))
+                    for name in manifest["segments"]
+                }
+                break
+            except FileNotFoundError:
+                # A merge removed a segment in the meantime, read the new manifest
+                continue
+        else:
+            raise RuntimeError(f"Could not open the segments in {directory}")
+
+        self.generation = manifest["generation"]
+
+        # Deleted documents, of all segments and of each segment
+        self.tombstones = np.array(sorted(manifest["tombstones"]), dtype=np.int64)
+        self.deleted = {
+            name: np.intersect1d(segment.doc_ids, self.tombstones, assume_unique=True)
+            for name, segment in self.segments.items()
+        }
+        self.num_docs = sum(
+            segment.num_docs - len(self.deleted[name])
+            for name, segment in self.segments.items()
+        )
+        # Live document frequencies of the queried terms, see df
+        self.dfs = {}
+        # Only the documents with higher ids are searched, see newer_than
+        self.min_doc = None
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def max_doc(self) -> int:
+        """
+        Highest document id of the segments, 0 if they are empty.
+        """
+        return max(
+            (
+                int(segment.doc_ids[-1])
+                for segment in self.segments.values()
+                if len(segment.doc_ids)
+            ),
+            default=0,
+        )
+
+    def newer_than(self, doc_id: int) -> "SegmentSet":
+        """
+        View on the documents with higher ids than doc_id, e.g. the ones added after
+        the shards were exported. The statistics (number of documents, IDFs and
+        bounds) stay those of all segments.
+        """
+        view = copy.copy(self)
+        view.min_doc = doc_id
+        return view
+
+    def _searched(self):
+        # Segments holding documents of this view, the doc ids of a segment are sorted
+        return [
+            (name, segment)
+            for name, segment in self.segments.items()
+            if self.min_doc is None
+            or (len(segment.doc_ids) and segment.doc_ids[-1] > self.min_doc)
+        ]
+
+    def parts(self) -> list[tuple[InvertedIndex, Callable]]:
+        """
+        Searched segments, each with a function returning the mask of the live documents of this view among the
+        given document ids of the segment, None if all of them are live. See rank.block_max_score.
+        """
+        return [
+            (segment, functools.partial(self._live, name))
+            for name, segment in self._searched()
+        ]
+
+    def df(self, term: str) -> int:
+        """
+        Number of live documents containing a term over all segments. The deleted documents are not counted, like
+        delete_documents decrements the IDFs table, so the document frequency stays consistent with num_docs.
+        """
+        df = self.dfs.get(term)
+        if df is None:
+            df = 0
+            for name, segment in self.segments.items():
+                segment_df = segment.df(term)
+                deleted = self.deleted[name]
+                if segment_df and len(deleted):
+                    segment_df -= int(np.isin(segment.postings(term)[0], deleted, assume_unique=True).sum())
+                df += segment_df
+            if len(self.dfs) >= DF_CACHE_SIZE:
+                self.dfs.clear()
+            self.dfs[term] = df
+        return df
+
+    def idf(self, term: str) -> float | None:
+        """
+        IDF of a term over all segments, computed like the IDFs table.
+        """
+        df = self.df(term)
+        return math.log10(self.num_docs / df) if df else None
+
+    def max_tf(self, term: str) -> int:
+        """
+        Upper bound of the term frequency of a term, deleted documents are not excluded.
+        """
+        return max((segment.max_tf(term) for segment in self.segments.values()), default=0)
+
+    def max_wtf(self, term: str) -> float:
+        return max((segment.max_wtf(term) for segment in self.segments.values()), default=0.0)
+
+    def _live(self, name: str, doc_ids: np.ndarray) -> np.ndarray | None:
+        # Mask of the postings of live documents of this view, None if all of them are
+        deleted = self.deleted[name]
+        if not len(doc_ids):
+            return None
+        live = ~np.isin(doc_ids, deleted, assume_unique=True) if len(deleted) else None
+        if self.min_doc is not None:
+            newer = doc_ids > self.min_doc
+            live = newer if live is None else live & newer
+        return live
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Decodes the postings of a term from all segments, without deleted documents.
+        Returns: Document ids (sorted within each segment) and the term frequency in each document
+        """
+        postings = []
+        for name, segment in self._searched():
+            doc_ids, tfs = segment.postings(term)
+            live = self._live(name, doc_ids)
+            postings.append((doc_ids, tfs) if live is None else (doc_ids[live], tfs[live]))
+        if not postings:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return (
+            np.concatenate([doc_ids for doc_ids, _ in postings]),
+            np.concatenate([tfs for _, tfs in postings]),
+        )
+
+    def weighted_tfs(self, term: str) -> np.ndarray:
+        """
+        Returns: The BM25F weighted term frequencies, in the same order as the postings
+        """
+        wtfs = []
+        for name, segment in self._searched():
+            segment_wtfs = segment.weighted_tfs(term)
+            live = (
+                self._live(name, segment.postings(term)[0])
+                if len(self.deleted[name]) or self.min_doc is not None
+                else None
+            )
+            wtfs.append(segment_wtfs if live is None else segment_wtfs[live])
+        return np.concatenate(wtfs or [np.array([], dtype=np.float32)])
+
+    def positions(self, term: str, docs: list[int]) -> dict[int, np.ndarray]:
+        positions = {}
+        for _, segment in self._searched():
+            positions.update(segment.positions(term, docs))
+        return positions
+
+
+class SegmentManager:
+    """
+    Writes new segments, merges segments in the background and commits the list of live segments.
+    """
+
+    def __init__(
+        self,
+        dbcon: duckdb.DuckDBPyConnection,
+        directory: str = INDEX_DIRECTORY,
+        merge_factor: int = MERGE_FACTOR,
+    ):
+        self.cursor = dbcon.cursor()
+        self.directory = directory
+        self.merge_factor = merge_factor
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = read_manifest(directory)
+        self._remove_orphans()
+
+        # Segments of a rebuild, they replace all live segments once the rebuild is committed
+        self.rebuild = None
+        # Deleted documents, committed with the next segment
+        self.pending_deletes = []
+
+        # Merge segments in the background
+        self._merge_requested = threading.Event()
+        self._closed = threading.Event()
+        self._merge_thread = threading.Thread(
+            target=self._merge_loop, name="SegmentMerger", daemon=True
+        )
+        self._merge_thread.start()
+
+    def __del__(self):
+        self.cursor.close()
+
+    def close(self):
+        """
+        Stops merging, waiting for a running merge to finish.
+        """
+        self._closed.set()
+        self._merge_requested.set()
+        self._merge_thread.join()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _new_segment(self) -> str:
+        with self.lock:
+            name = f"segment_{self.manifest['next_segment']:06d}.idx"
+            self.manifest["next_segment"] += 1
+        return name
+
+    def _write_manifest(self):
+        # Must hold the lock
+        self.manifest["generation"] += 1
+        temporary_path = self._path(f"{MANIFEST}.tmp")
+        with open(temporary_path, "w") as file:
+            json.dump(self.manifest, file)
+        os.replace(temporary_path, self._path(MANIFEST))
+
+    def _remove(self, names: list[str]):
+        # Processes that still map a removed segment can keep reading it
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def _remove_orphans(self):
+        # Segments of an interrupted flush, merge or rebuild
+        self._remove(
+            [
+                name
+                for name in os.listdir(self.directory)
+                if name.startswith("segment_")
+                and name not in self.manifest["segments"]
+            ]
+        )
+
+    def _commit(self, added: list[str], removed: list[str] = ()) -> bool:
+        """
+        Atomically replaces segments by new ones, together with the pending deletes.
+        Returns: False if a segment to remove is not live anymore, then nothing is committed
+        """
+        with self.lock:
+            segments = self.manifest["segments"]
+            if any(name not in segments for name in removed):
+                return False
+            self.manifest["segments"] = [
+                name for name in segments if name not in removed
+            ] + added
+            tombstones = self.manifest["tombstones"] + self.pending_deletes
+            self.pending_deletes = []
+            if removed:
+                # Tombstones are only needed as long as a segment holds the document
+                live_docs = [np.array([], dtype=np.int32)]
+                for name in self.manifest["segments"]:
+                    segment = InvertedIndex(self._path(name))
+                    live_docs.append(segment.doc_ids.copy())
+                    segment.close()
+                tombstones = np.intersect1d(tombstones, np.concatenate(live_docs)).tolist()
+            self.manifest["tombstones"] = sorted(set(tombstones))
+            self._write_manifest()
+        self._remove(removed)
+        return True
+
+    def _replace_all(self, added: list[str]):
+        # The new segments contain no deleted documents
+        with self.lock:
+            removed = self.manifest["segments"]
+            self.manifest["segments"] = added
+            self.manifest["tombstones"] = []
+            self.pending_deletes = []
+            self._write_manifest()
+        self._remove(removed)
+
+    def delete_documents(self, doc_ids: list[int], immediately: bool = True):
+        """
+        Hides deleted documents from the queries.
+        Args:
+            doc_ids: Ids of the documents
+            immediately: Commit right away instead of with the next segment, e.g. the one with the new version
+                of the documents
+
+        Returns: None
+        """
+        with self.lock:
+            # The segments of a rebuild never contain the deleted documents
+            if self.rebuild is not None:
+                return
+            self.pending_deletes += [int(doc_id) for doc_id in doc_ids]
+        if immediately:
+            self._commit([])
+
+    def add_documents(self, documents: list[tuple], positions: bool = True):
+        """
+        Flushes a batch of tokenized documents into a new segment.
+        Args:
+            documents: Id, terms (frequency per field and positions of each term, see tokenizer.TermCounts) and
+                number of tokens per field of each document
+            positions: Store the token positions
+
+        Returns: None
+        """
+        if not documents:
+            return
+
+        # Length normalized BM25F weight of each field, see index.compute_statistics
+        averages = field_averages(self.cursor)
+
+        postings = {}
+        doc_ids, doc_lengths = [], []
+        for doc_id, terms, field_lengths in documents:
+            field_norms = [
+                (
+                    FIELD_WEIGHTS[field]
+                    / (1 - FIELD_B[field] + FIELD_B[field] * length / average)
+                    if average
+                    else 0.0
+                )
+                for field, length, average in zip(FIELDS, field_lengths, averages)
+            ]
+            for token, (field_tfs, token_positions) in terms.items():
+                # Term frequency, weighted term frequency and positions of each posting
+                postings[(token, doc_id)] = (
+                    sum(field_tfs),
+                    sum(tf * norm for tf, norm in zip(field_tfs, field_norms)),
+                    token_positions,
+                )
+            doc_ids.append(doc_id)
+            doc_lengths.append(sum(field_lengths))
+
+        keys = sorted(postings)
+        doc_order = np.argsort(doc_ids)
+        name = self._new_segment()
+        write_postings(
+            self._path(name),
+            words=[word for word, _ in keys],
+            docs=[doc for _, doc in keys],
+            tfs=[postings[key][0] for key in keys],
+            wtfs=[postings[key][1] for key in keys],
+            idfs=np.zeros(len(keys)),
+            positions=(
+                [np.array(delta_encode(list(postings[key][2]))) for key in keys]
+                if positions
+                else None
+            ),
+            doc_ids=np.array(doc_ids)[doc_order],
+            doc_lengths=np.array(doc_lengths)[doc_order],
+            num_docs=len(documents),
+        )
+
+        with self.lock:
+            if self.rebuild is not None:
+                self.rebuild.append(name)
+                return
+        self._commit([name])
+        self._merge_requested.set()
+
+    def merge(self, names: list[str]) -> str | None:
+        """
+        Merges segments into one new segment.
+        Args:
+            names: Segments to merge
+
+        Returns: The new segment, or None if one of the segments was removed in the meantime
+        """
+        print(f"Merging {len(names)} segments...")
+        with self.lock:
+            tombstones = np.array(self.manifest["tombstones"], dtype=np.int64)
+        segments = [InvertedIndex(self._path(name)) for name in names]
+        parts = [segment.read_postings() for segment in segments]
+        doc_ids = np.concatenate([segment.doc_ids for segment in segments])
+        doc_lengths = np.concatenate([segment.doc_lengths for segment in segments])
+        for segment in segments:
+            segment.close()
+
+        words = np.concatenate([part["words"] for part in parts])
+        docs = np.concatenate([part["docs"] for part in parts])
+
+        # Drop the deleted documents and sort by word, then by document
+        _, word_ranks = np.unique(words, return_inverse=True)
+        order = np.lexsort((docs, word_ranks))
+        order = order[~np.isin(docs[order], tombstones)]
+        has_positions = all(part["positions"] is not None for part in parts)
+        positions = (
+            [p for part in parts for p in part["positions"]] if has_positions else None
+        )
+        live_docs = ~np.isin(doc_ids, tombstones)
+        doc_ids, doc_lengths = doc_ids[live_docs], doc_lengths[live_docs]
+        num_docs = len(doc_ids)
+        doc_order = np.argsort(doc_ids)
+
+        name = self._new_segment()
+        write_postings(
+            self._path(name),
+            words=words[order],
+            docs=docs[order],
+            tfs=np.concatenate([part["tfs"] for part in parts])[order],
+            wtfs=np.concatenate([part["wtfs"] for part in parts])[order],
+            idfs=np.zeros(len(order)),
+            positions=[positions[i] for i in order] if has_positions else None,
+            doc_ids=doc_ids[doc_order],
+            doc_lengths=doc_lengths[doc_order],
+            num_docs=num_docs,
+        )
+
+        if not self._commit([name], removed=names):
+            self._remove([name])
+            return None
+        print(f"Merged {len(names)} segments into {name}")
+        return name
+
+    def _merge_candidates(self) -> list[str]:
+        """
+        Tiered merge policy: segments are grouped into tiers by the logarithm of their size, and as soon as a tier
+        has merge_factor segments, they are merged into one segment of the next tier.
+        """
+        with self.lock:
+            segments = list(self.manifest["segments"])
+
+        tiers = {}
+        for name in segments:
+            size = os.path.getsize(self._path(name))
+            tier = int(math.log(max(size, 1), self.merge_factor))
+            tiers.setdefault(tier, []).append(name)
+
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier][: self.merge_factor]
+        return []
+
+    def _merge_loop(self):
+        while not self._closed.is_set():
+            self._merge_requested.wait(timeout=10.0)
+            self._merge_requested.clear()
+            try:
+                while not self._closed.is_set() and (
+                    candidates := self._merge_candidates()
+                ):
+                    self.merge(candidates)
+            except Exception as e:
+                print(f"Error merging segments: {e}")
+
+    def begin_rebuild(self):
+        """
+        Keeps new segments aside until commit_rebuild, so queries are answered from the current segments while the
+        index is rebuilt.
+        """
+        with self.lock:
+            self.rebuild = []
+
+    @property
+    def rebuilding(self) -> bool:
+        """
+        Whether new segments are kept aside for a rebuild, see begin_rebuild.
+        """
+        return self.rebuild is not None
+
+    def commit_rebuild(self):
+        """
+        Replaces all live segments by the segments of the rebuild.
+        """
+        with self.lock:
+            rebuild, self.rebuild = self.rebuild or [], None
+        self._replace_all(rebuild)
+        self._merge_requested.set()
+
+    def abort_rebuild(self):
+        """
+        Drops the segments of the rebuild and keeps the live segments.
+        """
+        with self.lock:
+            rebuild, self.rebuild = self.rebuild or [], None
+        self._remove(rebuild)
+
+    def export(self, dbcon: duckdb.DuckDBPyConnection):
+        """
+        Writes the whole index of the database into one segment that replaces all live segments. This also brings
+        the IDFs and BM25F term frequencies of the segments up to date.
+        Args:
+            dbcon: Database connection
+
+        Returns: None
+        """
+        name = self._new_segment()
+        write_index(dbcon, self._path(name))
+        self._replace_all([name])
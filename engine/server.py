@@ -1,5 +1,6 @@
 import lzma
 import pickle
+import threading
 
 import duckdb
 import flask
@@ -7,13 +8,29 @@ from flask import Flask, jsonify, request, Response
 from flask_cors import CORS, cross_origin
 
 from preview import load_preview
-from rank import rank
+from rank import (
+    RANKING_FUNCTIONS,
+    analysis_cache,
+    expansion_cache,
+    init_cursor_pool,
+    rank,
+    result_cache,
+    set_connection,
+    spellcheck_query,
+    warm_query_caches,
+)
+from suggest import SUGGESTIONS, get_prefix_index, suggest
 from summarize import get_summary_model
+from tokenizer import get_nlp
 
 # Disable the default flask server banner
 flask.cli.show_server_banner = lambda *args: None
 
 PORT = 8000
+# Number of documents returned by /search, unless the k parameter asks for another number
+SEARCH_RESULTS = 100
+# Ranking of /search, unless the ranking parameter asks for another one of rank.RANKING_FUNCTIONS
+SEARCH_RANKING = "bm25"
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -21,10 +38,41 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 dbcon: duckdb.DuckDBPyConnection = None
 
 
-def start_server(debug=False, con: duckdb.DuckDBPyConnection = None):
+def start_server(
+    debug=False, con: duckdb.DuckDBPyConnection = None, background: bool = False
+) -> threading.Thread | None:
+    """
+    Start the server.
+    Args:
+        debug: Debug mode, reloads the server on changes unless it runs in the background
+        con: Database connection of the process, DuckDB locks the database file for a single process
+        background: Serve from a thread and return it, e.g. next to the pipeline, which needs the main thread for its
+            signal handlers
+
+    Returns: The thread of the server if it runs in the background
+    """
     print("Starting server...")
     global dbcon
     dbcon = con
+    # Search with the connection of the server, instead of opening the database again
+    if con is not None:
+        set_connection(con)
+    # Prepare the statements of the ranking on the cursors once, instead of on every request thread
+    init_cursor_pool()
+    # Load the spaCy model and analyze the known queries before the first query
+    get_nlp()
+    warm_query_caches()
+    # Build the prefix index of the autocompletion before the first keystroke
+    get_prefix_index()
+    if background:
+        thread = threading.Thread(
+            target=app.run,
+            kwargs={"port": PORT, "debug": debug, "use_reloader": False},
+            name="Server",
+            daemon=True,
+        )
+        thread.start()
+        return thread
     app.run(port=PORT, debug=debug, use_reloader=debug)
 
 
@@ -37,10 +85,16 @@ def hello_world():
 @cross_origin()
 def search():
     query = request.args.get("query", "")
+    k = request.args.get("k", SEARCH_RESULTS, type=int)
+    ranking_function = request.args.get("ranking", SEARCH_RANKING)
+    if ranking_function not in RANKING_FUNCTIONS:
+        return Response(f"Unknown ranking {ranking_function}", status=400)
+    if k < 1:
+        return Response("k must be a positive number", status=400)
 
     result = {
         "query": query,
-        "spellchecked_query": query,
+        "spellchecked_query": spellcheck_query(query),
         "results": [],
     }
 
@@ -59,12 +113,20 @@ def search():
     result["results"] = results
 
     # Rank documents according to query
-    ranking = rank(query)
+    ranking = rank(query, ranking=ranking_function, k=k)
     result["results"] = ranking
 
     return jsonify(result)
 
 
+@app.route("/suggest")
+@cross_origin()
+def suggest_query():
+    query = request.args.get("query", "")
+    n = request.args.get("n", SUGGESTIONS, type=int)
+    return jsonify({"query": query, "suggestions": suggest(query, n)})
+
+
 @app.route("/preview")
 async def preview():
     """
@@ -123,6 +185,17 @@ def doc_count():
     return jsonify({"doc_count": doc_count})
 
 
+@app.route("/cache-stats")
+def cache_stats():
+    return jsonify(
+        {
+            "results": result_cache.stats(),
+            "analysis": analysis_cache.stats(),
+            "expansion": expansion_cache.stats(),
+        }
+    )
+
+
 @app.route("/site-map")
 def site_map():
     links = []
@@ -2,8 +2,12 @@
 
 -- DROP EVERYTHING
 DROP TABLE IF EXISTS crawled;
+DROP TABLE IF EXISTS synonyms;
 DROP TABLE IF EXISTS IDFs;
+DROP TABLE IF EXISTS tombstones;
+DROP TABLE IF EXISTS document_versions;
 DROP TABLE IF EXISTS TFs;
+DROP TABLE IF EXISTS doc_lengths;
 DROP TABLE IF EXISTS documents;
 DROP TABLE IF EXISTS words;
 
@@ -26,22 +30,61 @@ CREATE TABLE documents (
     summary     VARCHAR DEFAULT 'no summary'
 );
 
+-- Only one version of a link is live, older versions are tombstoned
+CREATE INDEX documents_link ON documents (link);
+
 CREATE TABLE words (
     word        VARCHAR PRIMARY KEY,
     id          INTEGER DEFAULT nextval('word_ids') UNIQUE,
 );
 
 CREATE TABLE TFs (
-    word INTEGER,
-    doc  INTEGER,
-    tf   INTEGER,
+    word      INTEGER,
+    doc       INTEGER,
+    tf        INTEGER,
+    field_tfs INTEGER[], -- term frequency per field, in the order of tokenizer.FIELDS
+    wtf       DOUBLE,    -- BM25F weighted term frequency, computed by index.compute_statistics
+    positions INTEGER[], -- delta-encoded token positions, NULL if positions are disabled
     PRIMARY KEY (word, doc),
     FOREIGN KEY (word) REFERENCES words (id),
     FOREIGN KEY (doc)  REFERENCES documents (id)
 );
 
+CREATE TABLE doc_lengths (
+    doc           INTEGER PRIMARY KEY,
+    length        INTEGER NOT NULL,
+    field_lengths INTEGER[] NOT NULL, -- number of tokens per field, in the order of tokenizer.FIELDS
+    FOREIGN KEY (doc) REFERENCES documents (id)
+);
+
+-- Content and tokenizer version the postings of each document were produced from, see main.py --reindex
+CREATE TABLE document_versions (
+    doc               INTEGER PRIMARY KEY,
+    content_hash      VARCHAR NOT NULL, -- tokenizer.content_hash of the field texts
+    tokenizer_version VARCHAR NOT NULL, -- tokenizer.tokenizer_version
+    blob_hash         VARCHAR,          -- download.blob_hash of the crawled page, recorded by the Loader
+    FOREIGN KEY (doc) REFERENCES documents (id)
+);
+
 CREATE TABLE IDFs (
-    word INTEGER PRIMARY KEY,
-    idf  DOUBLE NOT NULL,
+    word    INTEGER PRIMARY KEY,
+    df      INTEGER NOT NULL, -- number of live documents containing the word, maintained incrementally
+    idf     DOUBLE,           -- computed by index.compute_statistics
+    max_tf  INTEGER,          -- upper bounds of the (weighted) term frequencies of the word, for pruning
+    max_wtf DOUBLE,           -- top-k queries, computed by index.compute_statistics
     FOREIGN KEY (word) REFERENCES words (id)
-)
+);
+
+-- Deleted documents, filtered by the ranking until index.compact removes them
+CREATE TABLE tombstones (
+    doc INTEGER PRIMARY KEY
+);
+
+-- Most similar words of each word, restricted to the words of the index, built by main.py --synonyms
+CREATE TABLE synonyms (
+    word       VARCHAR NOT NULL,
+    synonym    VARCHAR NOT NULL,
+    similarity FLOAT NOT NULL -- cosine similarity of the GloVe vectors
+);
+
+CREATE INDEX synonyms_word ON synonyms (word);
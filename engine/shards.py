@@ -0,0 +1,168 @@
+import heapq
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from operator import itemgetter
+
+import duckdb
+
+from inverted_index import InvertedIndex, write_index
+
+"""
+The index can be split into shards by document id, each one served by its own worker process. A query is expanded
+once, sent to all shards in parallel (scatter), and the top documents of each shard are merged (gather). The shards
+store the global IDFs and number of documents, so their scores are the same as those of the unsharded index.
+"""
+
+# Directory of the shard files, next to crawlies.db
+SHARD_DIRECTORY = "shards"
+SHARD_PATTERN = re.compile(r"shard_(\d+)\.idx")
+# Start method of the shard workers. The server is threaded and holds database connections, which a forked worker
+# would inherit in whatever state the other threads left them, so the workers are started from a fresh process.
+SHARD_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def shard_paths(directory: str = SHARD_DIRECTORY) -> list[str]:
+    """
+    Returns: Paths of the shard files, in the order of the shards
+    """
+    if not os.path.isdir(directory):
+        return []
+    shards = sorted(
+        (int(match.group(1)), name)
+        for name in os.listdir(directory)
+        if (match := SHARD_PATTERN.fullmatch(name))
+    )
+    return [os.path.join(directory, name) for _, name in shards]
+
+
+def shards_version(directory: str = SHARD_DIRECTORY) -> tuple:
+    """
+    Cheap check whether the shards were exported again. Every export replaces the shard files, which changes their
+    inodes.
+    """
+    return tuple(os.stat(path).st_ino for path in shard_paths(directory))
+
+
+def export_shards(
+    dbcon: duckdb.DuckDBPyConnection,
+    num_shards: int,
+    directory: str = SHARD_DIRECTORY,
+):
+    """
+    Exports the index of the database into shards, assigning document doc to shard doc % num_shards.
+    Args:
+        dbcon: Database connection
+        num_shards: Number of shards
+        directory: Directory of the shard files
+
+    Returns: None
+    """
+    os.makedirs(directory, exist_ok=True)
+    for shard in range(num_shards):
+        write_index(
+            dbcon,
+            os.path.join(directory, f"shard_{shard}.idx"),
+            shard=shard,
+            num_shards=num_shards,
+        )
+
+    # Remove the shards of a previous export with more shards
+    for path in shard_paths(directory)[num_shards:]:
+        os.remove(path)
+
+
+def merge_scores(scores: list[list[tuple]], k: int | None = None) -> list[tuple]:
+    """
+    Merges the scores of disjoint sets of documents, e.g. of the shards.
+    Args:
+        scores: Pairs of document and score of each set, best documents first if k is given
+        k: Number of documents to return, all if None
+
+    Returns: Pairs of document and score, best documents first
+    """
+    if k is None:
+        return sorted(
+            (score for part in scores for score in part),
+            key=itemgetter(1),
+            reverse=True,
+        )
+    # The top documents of each set are sorted, so merging them is enough
+    return list(islice(heapq.merge(*scores, key=itemgetter(1), reverse=True), k))
+
+
+shard_index = None  # Index of the shard served by a worker process
+
+
+def _open_shard(path: str):
+    global shard_index
+    # Load the ranking before the first query, it imports this module
+    import rank
+
+    shard_index = InvertedIndex(path)
+
+
+def _search_shard(ranking: str, prepared: tuple, k: int | None) -> list[tuple]:
+    # Imported here, rank imports this module
+    from rank import SCORING_FUNCTIONS
+
+    # With k, the best documents come first
+    return SCORING_FUNCTIONS[ranking](None, prepared, index=shard_index, k=k)
+
+
+class ShardPool:
+    """
+    Worker processes of the index shards, one per shard.
+    """
+
+    def __init__(self, directory: str = SHARD_DIRECTORY):
+        self.version = shards_version(directory)
+        # Documents with higher ids were added after the export, only the index segments
+        # have them
+        self.max_doc = 0
+        for path in shard_paths(directory):
+            shard = InvertedIndex(path)
+            if len(shard.doc_ids):
+                self.max_doc = max(self.max_doc, int(shard.doc_ids[-1]))
+            shard.close()
+        context = multiprocessing.get_context(SHARD_START_METHOD)
+        if SHARD_START_METHOD == "forkserver":
+            # The workers are forked from a server process that imported the ranking once
+            context.set_forkserver_preload(["rank"])
+        self.executors = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=context,
+                initializer=_open_shard,
+                initargs=(path,),
+            )
+            for path in shard_paths(directory)
+        ]
+        print(f"Started {len(self.executors)} shard workers")
+
+    def __len__(self):
+        return len(self.executors)
+
+    def search(self, ranking: str, prepared: tuple, k: int | None = None) -> list[tuple]:
+        """
+        Scores a prepared query on all shards in parallel and merges their top documents.
+        Args:
+            ranking: Scoring function, one of rank.SCORING_FUNCTIONS
+            prepared: Query as returned by rank.prepare_query
+            k: Number of documents to return, all if None
+
+        Returns: Pairs of document and score, best documents first
+        """
+        futures = [
+            executor.submit(_search_shard, ranking, prepared, k)
+            for executor in self.executors
+        ]
+        return merge_scores([future.result() for future in futures], k=k)
+
+    def close(self, wait: bool = True):
+        for executor in self.executors:
+            executor.shutdown(wait=wait)
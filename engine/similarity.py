@@ -1,15 +1,202 @@
+import json
+import os
+import threading
+
 import gensim.downloader as api
 import gensim
+import duckdb
+import numpy as np
+import pandas as pd
+
+MODEL_NAME = "glove-wiki-gigaword-100"
+MODEL_FILE = "glove-wiki-gigaword-100.model"
+
+model = None  # Global accessor for the full GloVe model, only loaded to build the embedding store
+model_lock = threading.Lock()
+
+# Normalized float16 vectors of the words of the index, built by main.py --synonyms, see save_matrix
+EMBEDDING_FILE = "embeddings.npy"
+# Number of rows of the embedding store compared with the query tokens at once, converted to float32
+EMBEDDING_BLOCK_SIZE = 65_536
+
+embeddings = None  # Global accessor for the memory-mapped embedding store
+
+# Number of similar words stored per word, the query expansion uses at most this many
+SYNONYMS_PER_WORD = 7
+# Number of words whose similarities are computed at once, each one against the whole vocabulary
+SYNONYM_BATCH_SIZE = 128
+
+
+def get_model() -> gensim.models.KeyedVectors:
+    """
+    Get or load the full GloVe model, downloading it if it was not saved yet. It is loaded once per process, on
+    first use.
+    """
+    global model
+    if model is None:
+        with model_lock:
+            if model is None:
+                try:
+                    model = gensim.models.KeyedVectors.load(f"./{MODEL_FILE}")
+                except FileNotFoundError:
+                    print("Model not found, downloading...")
+                    model = api.load(MODEL_NAME)
+                    model.save(MODEL_FILE)
+                    print("Model downloaded and saved")
+    return model
+
+
+def save_matrix(path: str, matrix: np.ndarray, labels: list):
+    """
+    Write a matrix and the labels of its rows, replacing the file atomically. The file is an .npy file followed by
+    the labels in JSON.
+    Args:
+        path: Path of the file
+        matrix: Matrix to write
+        labels: Label of each row, e.g. words
+    """
+    with open(path + ".tmp", "wb") as file:
+        np.save(file, matrix)
+        file.write(json.dumps(labels).encode())
+    os.replace(path + ".tmp", path)
+
+
+def load_matrix(path: str) -> tuple[np.memmap, list, int]:
+    """
+    Memory-map a matrix written by save_matrix. Matrix and labels are read from the same open file, even if the file
+    is replaced meanwhile.
+    Args:
+        path: Path of the file
+
+    Returns: Matrix, labels of its rows and the inode of the file, see file_version
+    """
+    with open(path, "rb") as file:
+        version = os.fstat(file.fileno()).st_ino
+        if np.lib.format.read_magic(file) == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+        matrix = np.memmap(file, dtype=dtype, mode="r", offset=offset, shape=shape)
+        file.seek(offset + matrix.nbytes)
+        labels = json.loads(file.read())
+    return matrix, labels, version
+
+
+def file_version(path: str) -> int | None:
+    """
+    Cheap check whether a file written by save_matrix was written again, which replaces the file and changes its
+    inode. None if the file does not exist.
+    """
+    try:
+        return os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+class EmbeddingStore:
+    """
+    Read-only store of normalized word vectors in float16. The vectors are memory-mapped, so the processes of the
+    server and the pipeline share their pages, and only the pages that are used are read.
+    """
+
+    def __init__(self, path: str = EMBEDDING_FILE):
+        self.vectors, self.words, self.version = load_matrix(path)
+        self.index = {word: row for row, word in enumerate(self.words)}
 
-model = None
+    def __len__(self):
+        return len(self.words)
 
-try:
-    model = gensim.models.KeyedVectors.load("./glove-wiki-gigaword-100.model")
-except FileNotFoundError:
-    print("Model not found, downloading...")
-    model = api.load("glove-wiki-gigaword-100")
-    model.save("glove-wiki-gigaword-100.model")
-    print("Model downloaded and saved")
+    def __contains__(self, word: str):
+        return word in self.index
+
+    def vector(self, word: str) -> np.ndarray | None:
+        """
+        Normalized vector of a word in float32, None if the word is not in the store.
+        """
+        row = self.index.get(word)
+        return self.vectors[row].astype(np.float32) if row is not None else None
+
+    def most_similar(self, words: list[str], topn: int = 7) -> dict[str, list[tuple]]:
+        """
+        Find the most similar words of several words at once, by cosine similarity. The store is scanned once for
+        all words, block by block.
+        Args:
+            words: Words to find similar words to
+            topn: Number of similar words per word
+
+        Returns: Most similar words and their similarity of each word, best first. Words that are not in the store
+            have no similar words.
+        """
+        result = {word: [] for word in words}
+        known = [word for word in dict.fromkeys(words) if word in self.index]
+        if not known or topn <= 0:
+            return result
+
+        rows = np.array([self.index[word] for word in known])
+        queries = self.vectors[rows].astype(np.float32)
+        best_rows = np.empty((len(known), 0), dtype=np.int64)
+        best_scores = np.empty((len(known), 0), dtype=np.float32)
+        for start in range(0, len(self.words), EMBEDDING_BLOCK_SIZE):
+            block = self.vectors[start : start + EMBEDDING_BLOCK_SIZE].astype(np.float32)
+            scores = queries @ block.T
+            # A word is not similar to itself
+            own = (rows >= start) & (rows < start + len(block))
+            scores[own, rows[own] - start] = -np.inf
+
+            # Keep the best topn of the previous blocks and this block
+            block_rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            candidates = np.concatenate([best_rows, block_rows], axis=1)
+            n = min(topn, scores.shape[1])
+            top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_rows = np.take_along_axis(candidates, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        for word, word_rows, word_scores in zip(known, best_rows, best_scores):
+            result[word] = [
+                (self.words[row], float(score))
+                for row, score in zip(word_rows, word_scores)
+                if score > -np.inf
+            ]
+        return result
+
+
+def get_embeddings() -> EmbeddingStore | None:
+    """
+    Get the embedding store, mapping it on first use and again when it was rebuilt. Returns None if the store was
+    not built yet.
+    """
+    global embeddings
+    version = file_version(EMBEDDING_FILE)
+    if version is None:
+        return None
+    if embeddings is None or embeddings.version != version:
+        embeddings = EmbeddingStore()
+    return embeddings
+
+
+def build_embeddings(dbcon: duckdb.DuckDBPyConnection, path: str = EMBEDDING_FILE):
+    """Write the normalized GloVe vectors of the words of the index into the embedding store. The file is replaced
+    atomically, so processes using the previous store are not disturbed.
+
+    Args:
+        dbcon (duckdb.DuckDBPyConnection): Database connection.
+        path (str, optional): File of the store. Defaults to EMBEDDING_FILE.
+    """
+    glove = get_model()
+    words = [
+        word
+        for word, in dbcon.execute("SELECT word FROM words ORDER BY id").fetchall()
+        if word in glove.key_to_index
+    ]
+    vectors = glove.get_normed_vectors()[[glove.key_to_index[word] for word in words]]
+
+    save_matrix(path, vectors.astype(np.float16), words)
+    print(f"Stored the vectors of {len(words)} words in {path}")
 
 
 def most_similar(word: str, topn=7) -> list:
@@ -22,11 +209,74 @@ def most_similar(word: str, topn=7) -> list:
     Returns:
         list: A list of tuples containing the most similar words and their similarity score.
     """
+    return most_similar_batch([word], topn)[word]
 
-    global model
-    try:
-        most_sim = model.most_similar(word, topn=topn)
-        # print(f"Most similar words to {word}: {most_sim}")
-        return most_sim
-    except Exception:
-        return []
+
+def most_similar_batch(words: list[str], topn=7) -> dict[str, list]:
+    """Find the most similar words of several words at once. The embedding store is used if it was built, it only
+    holds the words of the index. Else the full GloVe model is searched, one word at a time.
+
+    Args:
+        words (list[str]): The words to find similar words to.
+        topn (int, optional): Number of similar words per word. Default to 7.
+
+    Returns:
+        dict[str, list]: Tuples of similar word and similarity score of each word.
+    """
+    store = get_embeddings()
+    if store is not None:
+        return store.most_similar(words, topn)
+
+    glove = get_model()
+    result = {}
+    for word in words:
+        try:
+            result[word] = glove.most_similar(word, topn=topn)
+        except Exception:
+            result[word] = []
+    return result
+
+
+def build_synonyms(
+    dbcon: duckdb.DuckDBPyConnection,
+    topn: int = SYNONYMS_PER_WORD,
+    batch_size: int = SYNONYM_BATCH_SIZE,
+):
+    """Precompute the most similar words of every word of the embedding store into the synonyms table. The store
+    only holds the words of the index, so the query expansion only spends its budget on words that can be found.
+
+    Args:
+        dbcon (duckdb.DuckDBPyConnection): Database connection.
+        topn (int, optional): Number of similar words per word. Defaults to SYNONYMS_PER_WORD.
+        batch_size (int, optional): Number of words compared with the vocabulary at once. Defaults to
+            SYNONYM_BATCH_SIZE.
+    """
+    store = get_embeddings()
+    if store is None:
+        print("No embedding store, build it first with build_embeddings")
+        return
+    words = np.array(store.words, dtype=object)
+    vectors = store.vectors.astype(np.float32)
+    topn = min(topn, len(words) - 1)
+    print(f"Computing the {topn} most similar words of {len(words)} words...")
+
+    dbcon.execute("BEGIN TRANSACTION")
+    dbcon.execute("DELETE FROM synonyms")
+    if topn > 0:
+        for start in range(0, len(words), batch_size):
+            # Cosine similarities of the normalized vectors, a word is not similar to itself
+            similarities = vectors[start : start + batch_size] @ vectors.T
+            rows = np.arange(len(similarities))
+            similarities[rows, start + rows] = -np.inf
+            top = np.argpartition(-similarities, topn - 1, axis=1)[:, :topn]
+
+            df_synonyms = pd.DataFrame(
+                {
+                    "word": np.repeat(words[start : start + len(similarities)], topn),
+                    "synonym": words[top.ravel()],
+                    "similarity": np.take_along_axis(similarities, top, axis=1).ravel(),
+                }
+            )
+            dbcon.execute("INSERT INTO synonyms SELECT * FROM df_synonyms")
+    dbcon.execute("COMMIT")
+    print("Synonyms computed")
@@ -0,0 +1,180 @@
+"""
+Spelling correction of query tokens with a symmetric delete dictionary (SymSpell).
+
+Every word of the vocabulary is stored under the strings that remain when up to MAX_EDIT_DISTANCE of its characters
+are deleted. Two words within that edit distance share such a delete, so the candidate corrections of a token are
+found by generating its deletes and looking them up, instead of comparing the token with the whole vocabulary. Only
+the few candidates are compared by their edit distance. The dictionary is built with the index and memory-mapped by
+the ranking, see similarity.save_matrix.
+"""
+import zlib
+
+import duckdb
+import numpy as np
+
+from similarity import file_version, load_matrix, save_matrix
+
+# Hashes of the deletes of the vocabulary and the row of their word, followed by the words, most frequent first
+SPELLING_FILE = "spelling.npy"
+MAX_EDIT_DISTANCE = 2
+# Only the deletes of this many first characters are stored, which bounds the deletes of long words
+PREFIX_LENGTH = 7
+# Shorter tokens are not corrected, and tokens up to SHORT_WORD_LENGTH characters only by one edit
+MIN_WORD_LENGTH = 3
+SHORT_WORD_LENGTH = 4
+# Words in fewer documents are not suggested, as they are often misspelled themselves
+MIN_DOCUMENT_FREQUENCY = 2
+
+spelling_dictionary = None  # Global accessor for the memory-mapped spelling dictionary
+
+
+def deletes(word: str, max_distance: int) -> set[str]:
+    """
+    All strings that remain when up to max_distance characters are deleted from the prefix of a word, including the
+    prefix itself.
+    """
+    result = {word[:PREFIX_LENGTH]}
+    current = result
+    for _ in range(max_distance):
+        current = {
+            string[:i] + string[i + 1 :] for string in current if len(string) > 1 for i in range(len(string))
+        }
+        result |= current
+    return result
+
+
+def delete_hashes(strings) -> np.ndarray:
+    """
+    Stable 32-bit hashes of strings. Colliding deletes only add candidates, which are checked by their edit distance.
+    """
+    return np.fromiter((zlib.crc32(string.encode()) for string in strings), dtype=np.uint64)
+
+
+def edit_distance(first: str, second: str, max_distance: int) -> int:
+    """
+    Damerau-Levenshtein distance of two strings (optimal string alignment), i.e. the number of insertions, deletions,
+    substitutions and transpositions of adjacent characters. Returns max_distance + 1 as soon as it is exceeded.
+    """
+    if abs(len(first) - len(second)) > max_distance:
+        return max_distance + 1
+    # The common prefix and suffix don't change the distance
+    start = 0
+    while start < min(len(first), len(second)) and first[start] == second[start]:
+        start += 1
+    end = 0
+    while end < min(len(first), len(second)) - start and first[-1 - end] == second[-1 - end]:
+        end += 1
+    first, second = first[start : len(first) - end], second[start : len(second) - end]
+
+    previous_row = None
+    row = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        previous_row, before, row = row, previous_row, [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            row[j] = min(row[j - 1] + 1, previous_row[j] + 1, previous_row[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+        if min(row) > max_distance:
+            return max_distance + 1
+    return min(row[-1], max_distance + 1)
+
+
+class SpellingDictionary:
+    """
+    Read-only, memory-mapped symmetric delete dictionary of the vocabulary of the index.
+    """
+
+    def __init__(self, path: str = SPELLING_FILE):
+        # Hash of a delete in the upper 32 bits and the row of its word in the lower ones, sorted
+        self.keys, self.words, self.version = load_matrix(path)
+        self.index = {word: row for row, word in enumerate(self.words)}
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word: str):
+        return word in self.index
+
+    def candidates(self, word: str, max_distance: int) -> np.ndarray:
+        """
+        Rows of the words that share a delete with a word, most frequent first.
+        """
+        hashes = delete_hashes(deletes(word, max_distance)) << np.uint64(32)
+        starts = np.searchsorted(self.keys, hashes)
+        ends = np.searchsorted(self.keys, hashes | np.uint64(0xFFFFFFFF), side="right")
+        if not (ends > starts).any():
+            return np.array([], dtype=np.uint64)
+        keys = np.concatenate([self.keys[start:end] for start, end in zip(starts, ends) if end > start])
+        return np.unique(keys & np.uint64(0xFFFFFFFF))
+
+    def correct(self, token: str) -> str:
+        """
+        Correct the spelling of a token. Returns the word of the vocabulary with the smallest edit distance, the most
+        frequent one of equally close words. Tokens of the vocabulary, short tokens, tokens with digits and tokens
+        without a close word are returned lowercased, like the words of the index.
+        """
+        word = token.lower()
+        if word in self.index or len(word) < MIN_WORD_LENGTH or not word.isalpha():
+            return word
+        max_distance = 1 if len(word) <= SHORT_WORD_LENGTH else MAX_EDIT_DISTANCE
+
+        # Words one edit away share fewer deletes, so the farther words are only looked up if there are none
+        for distance in range(1, max_distance + 1):
+            for row in self.candidates(word, distance).tolist():
+                # The rows are ordered by frequency, so the first close enough word is the most frequent one
+                if edit_distance(word, self.words[row], distance) <= distance:
+                    return self.words[row]
+        return word
+
+
+def get_spelling() -> SpellingDictionary | None:
+    """
+    Get the spelling dictionary, mapping it on first use and again when it was rebuilt. Returns None if it was not
+    built yet.
+    """
+    global spelling_dictionary
+    version = file_version(SPELLING_FILE)
+    if version is None:
+        return None
+    if spelling_dictionary is None or spelling_dictionary.version != version:
+        spelling_dictionary = SpellingDictionary()
+    return spelling_dictionary
+
+
+def build_spelling(dbcon: duckdb.DuckDBPyConnection, path: str = SPELLING_FILE):
+    """
+    Build the spelling dictionary from the words of the index and their document frequencies, and write it.
+    Args:
+        dbcon: Database connection
+        path: File of the dictionary
+
+    Returns: None
+    """
+    vocabulary = dbcon.execute(
+        """
+        SELECT w.word, i.df
+        FROM   words AS w, idfs AS i
+        WHERE  i.word = w.id AND i.df > 0
+        ORDER BY i.df DESC, w.word
+    """
+    ).fetchall()
+    # All words count as correctly spelled, but only the frequent ones are suggested
+    words = [word for word, _ in vocabulary]
+
+    hashes, rows = [], []
+    for row, (word, df) in enumerate(vocabulary):
+        if df < MIN_DOCUMENT_FREQUENCY:
+            break
+        word_hashes = delete_hashes(deletes(word, MAX_EDIT_DISTANCE))
+        hashes.append(word_hashes)
+        rows.append(np.full(len(word_hashes), row, dtype=np.uint64))
+    keys = (
+        np.concatenate(hashes) << np.uint64(32) | np.concatenate(rows)
+        if hashes
+        else np.array([], dtype=np.uint64)
+    )
+    keys.sort()
+
+    save_matrix(path, keys, words)
+    print(f"Stored {len(keys)} deletes of {len(hashes)} of {len(words)} words in {path}")
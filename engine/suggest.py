@@ -0,0 +1,113 @@
+"""
+Query autocompletion from a prefix index of the vocabulary.
+
+The words of the index are kept in a sorted list, so the words starting with a prefix are a range of it that is found
+by binary search. The range is ranked by the popularity of the words, i.e. their document frequency. Short prefixes
+match the most words, so their best completions are precomputed.
+"""
+import bisect
+import itertools
+import threading
+
+import numpy as np
+from unidecode import unidecode
+
+from spelling import get_spelling
+
+# Number of completions returned, unless more are asked for
+SUGGESTIONS = 10
+# The completions of prefixes up to this length are precomputed
+PRECOMPUTED_PREFIX_LENGTH = 2
+# Sorts after every character, so prefix + LAST_CHARACTER bounds the words starting with prefix
+LAST_CHARACTER = chr(0x10FFFF)
+
+prefix_index = None  # Global accessor for the prefix index of the vocabulary
+prefix_index_lock = threading.Lock()
+
+
+class PrefixIndex:
+    """
+    Sorted words and their popularity, with the best completions of the short prefixes.
+    """
+
+    def __init__(self, words: list[str], version=None):
+        """
+        Args:
+            words: Words to complete, most popular first
+            version: Version of the source of the words, see get_prefix_index
+        """
+        order = sorted(range(len(words)), key=words.__getitem__)
+        self.words = [words[i] for i in order]
+        # Popularity rank of each word, lower is more popular
+        self.ranks = np.array(order, dtype=np.int64)
+        self.version = version
+
+        self.top = {}
+        for length in range(1, PRECOMPUTED_PREFIX_LENGTH + 1):
+            start = 0
+            for prefix, group in itertools.groupby(self.words, key=lambda word: word[:length]):
+                end = start + sum(1 for _ in group)
+                if len(prefix) == length:
+                    self.top[prefix] = self.best(start, end, SUGGESTIONS)
+                start = end
+
+    def __len__(self):
+        return len(self.words)
+
+    def best(self, start: int, end: int, n: int) -> list[str]:
+        """
+        Most popular n words of a range of the sorted words, most popular first.
+        """
+        ranks = self.ranks[start:end]
+        top = np.argpartition(ranks, n - 1)[:n] if len(ranks) > n else np.arange(len(ranks))
+        top = top[np.argsort(ranks[top])]
+        return [self.words[start + i] for i in top.tolist()]
+
+    def complete(self, prefix: str, n: int = SUGGESTIONS) -> list[str]:
+        """
+        Most popular n words starting with a prefix, most popular first.
+        """
+        if not prefix or n <= 0:
+            return []
+        if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH and n <= SUGGESTIONS:
+            return self.top.get(prefix, [])[:n]
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(self.words, prefix + LAST_CHARACTER, lo=start)
+        return self.best(start, end, n)
+
+
+def get_prefix_index() -> PrefixIndex | None:
+    """
+    Get the prefix index of the words of the spelling dictionary, which holds the words of the index by document
+    frequency. It is built on first use and again when the dictionary was rebuilt. Returns None if the dictionary was
+    not built yet, see spelling.build_spelling.
+    """
+    global prefix_index
+    spelling = get_spelling()
+    if spelling is None:
+        return None
+    if prefix_index is None or prefix_index.version != spelling.version:
+        with prefix_index_lock:
+            if prefix_index is None or prefix_index.version != spelling.version:
+                prefix_index = PrefixIndex(spelling.words, spelling.version)
+    return prefix_index
+
+
+def suggest(query: str, n: int = SUGGESTIONS) -> list[str]:
+    """
+    Complete the last word of a query with the most popular words of the index.
+    Args:
+        query: Query typed so far
+        n: Number of completions
+
+    Returns: The query with its last word completed, best completion first. Empty if the query ends with a space or
+        there is no prefix index yet.
+    """
+    index = get_prefix_index()
+    if index is None or not query or query[-1].isspace():
+        return []
+    last = query.split()[-1]
+    # The words of the index are ASCII and lowercase, see tokenizer.preprocess_text
+    prefix = unidecode(last, replace_str="").lower()
+    head = query[: len(query) - len(last)]
+    return [head + word for word in index.complete(prefix, n)]
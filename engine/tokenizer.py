@@ -1,12 +1,23 @@
 import asyncio
+import functools
+import hashlib
+import json
+import queue
 import re
+import threading
+from array import array
+from collections import Counter, deque
+from typing import Iterable, Iterator
 
 import duckdb
 import pandas as pd
 import spacy
+from bs4 import BeautifulSoup
+from bs4.element import NavigableString, PreformattedString, Tag
 from unidecode import unidecode
 
 from pipeline import PipelineElement
+from utils import delta_encode
 
 """
 IMPORTANT:
@@ -14,137 +25,170 @@ Make sure you install the spaCy model with:
 python -m spacy download en_core_web_sm
 """
 
-# Load the spaCy model
-print("Loading spaCy model...")
-nlp = spacy.load("en_core_web_sm", disable=["tok2vec", "parser", "senter"])
+# spaCy model and the components the tokenization doesn't need
+SPACY_MODEL = "en_core_web_sm"
+SPACY_DISABLE = ["tok2vec", "parser", "senter"]
+# Number of texts spaCy processes at once in process_texts
+PIPE_BATCH_SIZE = 64
+# Number of chunks waiting for the spaCy pipe of the Tokenizer per process, see Tokenizer.tokenize_stream
+STREAM_QUEUE_SIZE = 4 * PIPE_BATCH_SIZE
+# Number of word ids the Tokenizer reserves at once
+WORD_ID_BLOCK_SIZE = 1_000
+# Maximum number of characters spaCy processes at once, longer texts are tokenized in chunks
+CHUNK_SIZE = 10_000
+
+nlp = None  # Global accessor for the spaCy model, shared by the tokenization and the queries
+nlp_lock = threading.Lock()
+
+# Version of the text extraction, normalization and tokenization. Increase it whenever they change, so
+# main.py --reindex tokenizes all pages again.
+TOKENIZER_VERSION = 1
+
+# Fields of a document. Each field gets its own term frequencies, so BM25F can weight e.g. title matches higher.
+FIELDS = ["title", "description", "headings", "body", "alt"]
+# Fields of the extracted tags, everything else is body text
+TAG_FIELDS = {
+    "title": "title",
+    "h1": "headings",
+    "h2": "headings",
+    "h3": "headings",
+    "h4": "headings",
+    "h5": "headings",
+    "h6": "headings",
+}
+# Boilerplate tags whose text is not indexed
+SKIPPED_TAGS = {"script", "style", "noscript", "template", "nav"}
+# Tags inside running text, e.g. "<p>Visit <b>Tübingen</b></p>". Every other tag separates the text before and after it.
+INLINE_TAGS = {
+    "a", "abbr", "b", "cite", "code", "del", "em", "i", "ins", "mark", "q", "s", "small", "span", "strong", "sub",
+    "sup", "time", "u",
+}
+# Gap between the token positions of two fields, so phrases never match across fields
+FIELD_POSITION_GAP = 100
+# Lookup table of the fast tokenization, see Lexicon
+LEXICON_FILE = "lexicon.json"
+# Number of words outside the lexicon whose analysis is cached
+LEXICON_CACHE_SIZE = 100_000
+
+
+# Define regular expressions for preprocessing, compiled once
+HTML_PATTERN = re.compile(r"<.*?>")
+EMAIL_PATTERN = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+")
+PRICE_PATTERN = re.compile(
+    r"""
+    (?:(?:\$|€|£|¥)(?:\s?))                     # Currency symbols at the start
+    \d{1,3}(?:,\d{3})*(?:\.\d{1,2})?            # Numbers with optional thousands separators and decimal points
+    |
+    \d{1,3}(?:,\d{3})*(?:\.\d{1,2})?            # Numbers with optional thousands separators and decimal points
+    (?:\s?(?:\$|€|£|¥|USD|EUR|GBP|JPY))         # Currency symbols or codes at the end
+""",
+    re.VERBOSE | re.IGNORECASE,
+)
+DEGREE_PATTERN = re.compile(r"\d+\s?°C|\d+\s?°F|\d+\s?°K")
+PERCENTAGE_PATTERN = re.compile(r"\d+%")
+# This pattern matches various phone number formats
+# Thanks to https://stackoverflow.com/a/56450924
+PHONE_PATTERN = re.compile(
+    r"""
+    (?=[-.\s(+]{0,4}\d)                  # Fail fast: a digit follows within the optional prefix
+    ((\+\d{1,2}\s?)?1?\-?\.?\s?\(?\d{3}\)?[\s.-]?)?\d{3}[\s.-]?\d{4}
+""",
+    re.VERBOSE,
+)
+# This pattern matches various date formats
+# Thanks to https://stackoverflow.com/a/8768241
+DATE_PATTERN = re.compile(
+    r"""
+    ^(?:(?:(?:0?[13578]|1[02])(\/|-|\.)31)\1|(?:(?:0?[1,3-9]|1[0-2])(\/|-|\.)(?:29|30)\2))(?:(?:1[6-9]|[2-9]\d)?\d{2})$|^(?:0?2(\/|-|\.)29\3(?:(?:(?:1[6-9]|[2-9]\d)?(?:0[48]|[2468][048]|[13579][26])|(?:(?:16|[2468][048]|[3579][26])00))))$|^(?:(?:0?[1-9])|(?:1[0-2]))(\/|-|\.)(?:0?[1-9]|1\d|2[0-8])\4(?:(?:1[6-9]|[2-9]\d)?\d{2})$
+""",
+    re.VERBOSE,
+)
+# This pattern matches various time formats
+TIME_PATTERN = re.compile(
+    r"""
+    (?=\d)                              # Fail fast: times start with a digit
+    \b                                  # Word boundary
+    (?:
+        (?:1[0-2]|0?[1-9])              # Hours: 1-12 with optional leading zero
+        :                               # Colon separator
+        (?:[0-5][0-9])                  # Minutes: 00-59
+        (?:
+            :(?:[0-5][0-9])             # Optional seconds: 00-59
+            (?:\.[0-9]{1,3})?           # Optional milliseconds
+        )?
+        \s*(?:AM|PM|am|pm|A\.M\.|P\.M\.)? # Optional AM/PM indicator
+    )
+    |
+        (?:(?:2[0-3]|[01]?[0-9])        # Hours: 00-23
+        :                               # Colon separator
+        (?:[0-5][0-9])                  # Minutes: 00-59
+        (?::(?:[0-5][0-9])              # Optional seconds: 00-59
+            (?:\.[0-9]{1,3})?           # Optional milliseconds
+        )?
+    )
+    \b                                  # Word boundary
+""",
+    re.VERBOSE | re.IGNORECASE,
+)
+URL_PATTERN = re.compile(r"https://\S+|www\.\S+")
+EMOJI_PATTERN = re.compile(
+    "["
+    "\U0001F600-\U0001F64F"  # emoticons
+    "\U0001F300-\U0001F5FF"  # symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # transport & map symbols
+    "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    "\U00002702-\U000027B0"
+    "\U000024C2-\U0001F251"
+    "]+",
+    flags=re.UNICODE,
+)
+SPECIAL_CHARACTER_PATTERN = re.compile(r"[^\w\s]")
+SINGLE_CHARACTER_PATTERN = re.compile(r"\b\w\b")
 
 
-# Define regular expressions for preprocessing
 def remove_html(text: str) -> str:
-    html_tag = re.compile(r"<.*?>")
-    text = html_tag.sub(r"", text)
-    return text
+    return HTML_PATTERN.sub(r"", text)
 
 
 def remove_emails(text: str) -> str:
-    email_clean = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+")
-    text = email_clean.sub(r"", text)
-    return text
+    return EMAIL_PATTERN.sub(r"", text)
 
 
 def remove_prices(text: str) -> str:
-    price_pattern = re.compile(
-        r"""
-        (?:(?:\$|€|£|¥)(?:\s?))                     # Currency symbols at the start
-        \d{1,3}(?:,\d{3})*(?:\.\d{1,2})?            # Numbers with optional thousands separators and decimal points
-        |
-        \d{1,3}(?:,\d{3})*(?:\.\d{1,2})?            # Numbers with optional thousands separators and decimal points
-        (?:\s?(?:\$|€|£|¥|USD|EUR|GBP|JPY))         # Currency symbols or codes at the end
-    """,
-        re.VERBOSE | re.IGNORECASE,
-    )
-
-    text = price_pattern.sub("", text)
-    return text
+    return PRICE_PATTERN.sub("", text)
 
 
 def remove_degrees(text: str) -> str:
-    degree_clean = re.compile(r"\d+\s?°C|\d+\s?°F|\d+\s?°K")
-    text = degree_clean.sub(r"", text)
-    return text
+    return DEGREE_PATTERN.sub(r"", text)
 
 
 def remove_percentages(text: str) -> str:
-    percentage_clean = re.compile(r"\d+%")
-    text = percentage_clean.sub(r"", text)
-    return text
+    return PERCENTAGE_PATTERN.sub(r"", text)
 
 
 def remove_phone_number(text: str) -> str:
-    # This pattern matches various phone number formats
-    # Thanks to https://stackoverflow.com/a/56450924
-    phone_pattern = re.compile(
-        r"""
-        ((\+\d{1,2}\s?)?1?\-?\.?\s?\(?\d{3}\)?[\s.-]?)?\d{3}[\s.-]?\d{4}
-    """,
-        re.VERBOSE,
-    )
-
     # Replace matched phone numbers with an empty string
-    text = phone_pattern.sub("", text)
-    return text
+    return PHONE_PATTERN.sub("", text)
 
 
 def remove_dates(text: str) -> str:
-    # This pattern matches various date formats
-    # Thanks to https://stackoverflow.com/a/8768241
-    date_pattern = re.compile(
-        r"""
-        ^(?:(?:(?:0?[13578]|1[02])(\/|-|\.)31)\1|(?:(?:0?[1,3-9]|1[0-2])(\/|-|\.)(?:29|30)\2))(?:(?:1[6-9]|[2-9]\d)?\d{2})$|^(?:0?2(\/|-|\.)29\3(?:(?:(?:1[6-9]|[2-9]\d)?(?:0[48]|[2468][048]|[13579][26])|(?:(?:16|[2468][048]|[3579][26])00))))$|^(?:(?:0?[1-9])|(?:1[0-2]))(\/|-|\.)(?:0?[1-9]|1\d|2[0-8])\4(?:(?:1[6-9]|[2-9]\d)?\d{2})$
-    """,
-        re.VERBOSE,
-    )
-
-    # Replace matched phone numbers with an empty string
-    text = date_pattern.sub("", text)
-    return text
+    # Replace matched dates with an empty string
+    return DATE_PATTERN.sub("", text)
 
 
 def remove_times(text: str) -> str:
-    # This pattern matches various time formats
-    time_pattern = re.compile(
-        r"""
-        \b                                  # Word boundary
-        (?:
-            (?:1[0-2]|0?[1-9])              # Hours: 1-12 with optional leading zero
-            :                               # Colon separator
-            (?:[0-5][0-9])                  # Minutes: 00-59
-            (?:
-                :(?:[0-5][0-9])             # Optional seconds: 00-59
-                (?:\.[0-9]{1,3})?           # Optional milliseconds
-            )?
-            \s*(?:AM|PM|am|pm|A\.M\.|P\.M\.)? # Optional AM/PM indicator
-        )
-        |
-            (?:(?:2[0-3]|[01]?[0-9])        # Hours: 00-23
-            :                               # Colon separator
-            (?:[0-5][0-9])                  # Minutes: 00-59
-            (?::(?:[0-5][0-9])              # Optional seconds: 00-59
-                (?:\.[0-9]{1,3})?           # Optional milliseconds
-            )?
-        )
-        \b                                  # Word boundary
-    """,
-        re.VERBOSE | re.IGNORECASE,
-    )
-
     # Replace matched times with an empty string
-    text = time_pattern.sub("", text)
-    return text
+    return TIME_PATTERN.sub("", text)
 
 
 def remove_url(text: str) -> str:
-    url_clean = re.compile(r"https://\S+|www\.\S+")
-    text = url_clean.sub(r"", text)
-    return text
+    return URL_PATTERN.sub(r"", text)
 
 
 # Removes Emojis
 def remove_emoji(text: str) -> str:
-    emoji_clean = re.compile(
-        "["
-        "\U0001F600-\U0001F64F"  # emoticons
-        "\U0001F300-\U0001F5FF"  # symbols & pictographs
-        "\U0001F680-\U0001F6FF"  # transport & map symbols
-        "\U0001F1E0-\U0001F1FF"  # flags (iOS)
-        "\U00002702-\U000027B0"
-        "\U000024C2-\U0001F251"
-        "]+",
-        flags=re.UNICODE,
-    )
-    text = emoji_clean.sub(r"", text)
-    url_clean = re.compile(r"https://\S+|www\.\S+")
-    text = url_clean.sub(r"", text)
+    text = EMOJI_PATTERN.sub(r"", text)
+    text = URL_PATTERN.sub(r"", text)
     return text
 
 
@@ -153,202 +197,646 @@ def remove_unicode(text: str) -> str:
 
 
 def remove_special_characters(text: str) -> str:
-    special_characters = re.compile(r"[^\w\s]")
-    text = special_characters.sub(r" ", text)
-    return text
+    return SPECIAL_CHARACTER_PATTERN.sub(r" ", text)
 
 
 def remove_single_character_tokens(text: str) -> str:
-    single_characters = re.compile(r"\b\w\b")
-    text = single_characters.sub(r"", text)
-    return text
+    return SINGLE_CHARACTER_PATTERN.sub(r"", text)
 
 
 def lower(tokens: list[str]) -> list[str]:
     return [word.lower() for word in tokens]
 
 
+# The preprocessing steps stay separate passes: combining the patterns into one alternation changes the output where
+# removing one match joins the text around it into a match of a later pattern (e.g. an email around an HTML tag).
+# The text is ASCII after unidecode, so the emoji and degree patterns (°) never match and are left out.
+
+# Replaces the special characters ([^\w\s]) of ASCII text by spaces without a regular expression
+SPECIAL_CHARACTERS = str.maketrans(
+    {
+        character: " "
+        for character in map(chr, range(128))
+        if SPECIAL_CHARACTER_PATTERN.match(character)
+    }
+)
+
+
 def preprocess_text(text: str) -> str:
-    """Apply all preprocessing steps using regular expressions."""
-    text = remove_unicode(text)
-    text = remove_url(text)
-    text = remove_html(text)
-    text = remove_emails(text)
-    text = remove_degrees(text)
-    text = remove_times(text)
-    text = remove_phone_number(text)
-    text = remove_dates(text)
-    text = remove_emoji(text)
-    text = remove_prices(text)
-    text = remove_percentages(text)
-    text = remove_special_characters(text)
-    text = remove_single_character_tokens(text)
+    """
+    Apply all preprocessing steps. The output is the same as applying the remove_* steps one after the other, but
+    steps that cannot match ASCII text are left out, and steps are skipped if a character they require does not
+    occur in the text.
+    """
+    text = unidecode(text, replace_str="")
+    text = URL_PATTERN.sub("", text)
+    if "<" in text:
+        text = HTML_PATTERN.sub("", text)
+    if "@" in text:
+        text = EMAIL_PATTERN.sub("", text)
+    if ":" in text:
+        text = TIME_PATTERN.sub("", text)
+    text = PHONE_PATTERN.sub("", text)
+
+    # The date pattern only matches the whole text
+    date = DATE_PATTERN.match(text)
+    if date:
+        text = text[date.end():]
+
+    # Removing the patterns above can join a new URL
+    if "https://" in text or "www." in text:
+        text = URL_PATTERN.sub("", text)
+
+    text = PRICE_PATTERN.sub("", text)
+    if "%" in text:
+        text = PERCENTAGE_PATTERN.sub("", text)
+    text = text.translate(SPECIAL_CHARACTERS)
+    text = SINGLE_CHARACTER_PATTERN.sub("", text)
     return text
 
 
-def process_text(text: str) -> list[str] | list[tuple]:
-    """Process text using spaCy and custom logic."""
+def preprocess_texts(texts: list[str]) -> list[str]:
+    """Apply all preprocessing steps to a batch of texts."""
+    return [preprocess_text(text) for text in texts]
+
+
+def get_nlp() -> spacy.language.Language:
+    """
+    Get or load the spaCy model. It is loaded once per process, on first use.
+    """
+    global nlp
+    if nlp is None:
+        with nlp_lock:
+            if nlp is None:
+                print("Loading spaCy model...")
+                nlp = spacy.load(SPACY_MODEL, disable=SPACY_DISABLE)
+    return nlp
+
+
+def token_output(token) -> str | None:
+    """
+    The index term of a spaCy token: the lemma for nouns and proper nouns, else the text. None for stopwords,
+    punctuation and whitespace.
+    """
+    if token.is_stop or token.is_punct or token.is_space:
+        return None
+    # Use the lemma for nouns and proper nouns
+    return token.lemma_ if token.pos_ in ["NOUN", "PROPN"] else token.text
+
+
+def process_text(text: str, lexicon=None) -> list[str] | list[tuple]:
+    """
+    Process text using spaCy and custom logic.
+    Args:
+        text: Text to tokenize
+        lexicon: Lexicon to look the words up in instead of running spaCy on the whole text
+
+    Returns: Lowercase index terms
+    """
 
     # Preprocess the text
     text = preprocess_text(text)
 
+    if lexicon is not None:
+        return lexicon.tokenize(text)
+
     # Process with spaCy
-    doc = nlp(text)
-    tokens = []
-    for token in doc:
-        if token.is_stop or token.is_punct or token.is_space:
-            continue
-        # Use the lemma for nouns and proper nouns
+    return doc_tokens(get_nlp()(text))
+
 
-        token = token.lemma_ if token.pos_ in ["NOUN", "PROPN"] else token.text
-        tokens.append(token)
+def process_texts(
+    texts: Iterable[str],
+    lexicon=None,
+    batch_size: int = PIPE_BATCH_SIZE,
+    n_process: int = 1,
+) -> Iterator[list[str]]:
+    """
+    Process a stream of texts like process_text, but with spaCy working on batches of texts, which is much faster
+    than calling process_text on each text.
+    Args:
+        texts: Texts to tokenize
+        lexicon: Lexicon to look the words up in instead of running spaCy
+        batch_size: Number of texts spaCy processes at once
+        n_process: Number of processes spaCy tokenizes with
+
+    Returns: Lowercase index terms of each text, in the order of the texts
+    """
+    texts = map(preprocess_text, texts)
+    if lexicon is not None:
+        return map(lexicon.tokenize, texts)
+    return map(
+        doc_tokens,
+        get_nlp().pipe(texts, batch_size=batch_size, n_process=n_process),
+    )
+
+
+def doc_tokens(doc) -> list[str]:
+    """
+    Returns: Lowercase index terms of a spaCy document
+    """
+    tokens = [output for output in map(token_output, doc) if output is not None]
 
     # Lowercase the tokens
-    tokens = lower(tokens)
+    return lower(tokens)
+
+
+def word_outputs(doc) -> list[tuple[str, tuple[str, ...]]]:
+    """
+    Groups the tokens of a spaCy document by whitespace-separated word, e.g. "cannot" is tokenized as "can" and
+    "not". Returns: Each word with its lowercase index terms
+    """
+    words = []
+    text, outputs = "", []
+    for token in doc:
+        if not token.is_space:
+            text += token.text
+            output = token_output(token)
+            if output is not None:
+                outputs.append(output.lower())
+        if (token.whitespace_ or token.i == len(doc) - 1) and text:
+            words.append((text, tuple(outputs)))
+            text, outputs = "", []
+    return words
+
+
+class Lexicon:
+    """
+    Fast tokenization without running spaCy on every document: a lookup table from each word to its index terms,
+    distilled from spaCy over the corpus. Words that are not in the table are analyzed by spaCy on their own, and
+    the results are kept in a bounded LRU cache. The table takes the most common analysis of a word, so it misses
+    context-dependent lemmas (a word that is sometimes a noun); see agreement.
+    """
+
+    def __init__(self, table: dict[str, tuple], cache_size: int = LEXICON_CACHE_SIZE):
+        self.table = table
+        self.analyze = functools.lru_cache(maxsize=cache_size)(self._analyze)
+
+    @staticmethod
+    def _analyze(word: str) -> tuple[str, ...]:
+        return tuple(term for _, terms in word_outputs(get_nlp()(word)) for term in terms)
+
+    @classmethod
+    def build(cls, texts: list[str], batch_size: int = PIPE_BATCH_SIZE):
+        """
+        Distills the lexicon from spaCy.
+        Args:
+            texts: Texts of the corpus
+            batch_size: Number of texts spaCy processes at once
+
+        Returns: The lexicon
+        """
+        return cls.from_analyses(cls.count_analyses(texts, batch_size=batch_size))
+
+    @staticmethod
+    def count_analyses(
+        texts: list[str], batch_size: int = PIPE_BATCH_SIZE, analyses: dict[str, Counter] = None
+    ) -> dict[str, Counter]:
+        """
+        Counts how often spaCy analyzes each word of the texts into which index terms.
+        Args:
+            texts: Texts of the corpus
+            batch_size: Number of texts spaCy processes at once
+            analyses: Counts of other texts to add to, e.g. to build a lexicon of more texts without analyzing the
+                first ones again
+
+        Returns: Count of each analysis of each word
+        """
+        analyses = {} if analyses is None else analyses
+        for doc in get_nlp().pipe(preprocess_texts(texts), batch_size=batch_size):
+            for word, terms in word_outputs(doc):
+                analyses.setdefault(word, Counter())[terms] += 1
+        return analyses
+
+    @classmethod
+    def from_analyses(cls, analyses: dict[str, Counter]):
+        """
+        Returns: The lexicon of the most common analysis of each word, see count_analyses
+        """
+        return cls({word: counts.most_common(1)[0][0] for word, counts in analyses.items()})
+
+    @classmethod
+    def load(cls, path: str = LEXICON_FILE):
+        with open(path, "r") as file:
+            return cls({word: tuple(terms) for word, terms in json.load(file).items()})
+
+    def save(self, path: str = LEXICON_FILE):
+        with open(path, "w") as file:
+            json.dump(self.table, file)
+
+    def tokenize(self, text: str) -> list[str]:
+        """
+        Tokenizes preprocessed text.
+        Returns: Lowercase index terms
+        """
+        tokens = []
+        for word in text.split():
+            terms = self.table.get(word)
+            if terms is None:
+                terms = self.analyze(word)
+            tokens += terms
+        return tokens
+
+    def agreement(self, texts: list[str]) -> dict:
+        """
+        Compares the lexicon with spaCy on the same texts.
+        Args:
+            texts: Texts to tokenize
 
-    return tokens
+        Returns: Share of identically tokenized texts and of matching terms
+        """
+        identical = matching = spacy_terms = lexicon_terms = 0
+        for text in texts:
+            expected = process_text(text)
+            actual = process_text(text, lexicon=self)
+            identical += expected == actual
+            matching += sum((Counter(expected) & Counter(actual)).values())
+            spacy_terms += len(expected)
+            lexicon_terms += len(actual)
+        return {
+            "texts": len(texts),
+            "identical": identical / max(len(texts), 1),
+            "precision": matching / max(lexicon_terms, 1),
+            "recall": matching / max(spacy_terms, 1),
+            "cache": self.analyze.cache_info()._asdict(),
+        }
 
 
 class Tokenizer(PipelineElement):
-    def __init__(self, dbcon: duckdb.DuckDBPyConnection):
+    def __init__(
+        self,
+        dbcon: duckdb.DuckDBPyConnection,
+        positions: bool = True,
+        segments=None,
+        segment_size: int = 100,
+        lexicon: Lexicon = None,
+        batch_size: int = 1,
+        n_process: int = 1,
+    ):
         super().__init__("Tokenizer")
         self.cursor = dbcon.cursor()
 
+        # Fast tokenization with a lookup table instead of running spaCy on every document
+        self.lexicon = lexicon
+        self.version = tokenizer_version(lexicon)
+
+        # Documents are tokenized together every batch_size documents, by n_process spaCy processes. With several
+        # processes, one spaCy pipe runs over the chunks of all documents, see tokenize_stream
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.batch = []
+        self.stream = None
+        self.stream_thread = None
+
+        # Store the (delta-encoded) token positions for phrase and proximity queries
+        self.positions = positions
+
+        # Term dictionary from each word to its id, and the reserved ids for new words
+        self.words: dict[str, int] = dict(
+            self.cursor.execute("SELECT word, id FROM words").fetchall()
+        )
+        self.free_word_ids = deque()
+
+        # Tokenized documents are flushed into a new index segment every segment_size documents
+        self.segments = segments
+        self.segment_size = segment_size
+        self.pending = []
+        self.pending_lock = threading.Lock()
+
     def __del__(self):
         self.cursor.close()
 
-    async def process(self, data, doc_id, link):
+    def flush(self):
         """
-        Tokenizes the input data.
+        Writes the pending documents into a new index segment, so they can be found without rebuilding the index.
         """
-        print(f"Tokenizing {link}...")
-        if data is None:
-            print(f"Failed to tokenize {link} because the data was empty.")
-            return
+        with self.pending_lock:
+            documents, self.pending = self.pending, []
+        if documents:
+            self.segments.add_documents(documents, positions=self.positions)
+
+    def save_state(self):
+        self.tokenize_batch()
+        self.close_stream()
+        if self.segments is not None:
+            self.flush()
+
+    def stream_document(self, doc_id: int, link: str, field_texts: list[str]):
+        """
+        Puts the chunks of a document into the stream of the spaCy pipe, followed by an empty text that marks the end
+        of the document. Waits while the pipe is STREAM_QUEUE_SIZE chunks per process behind.
+        """
+        if self.stream_thread is None:
+            self.stream = queue.Queue(maxsize=STREAM_QUEUE_SIZE * self.n_process)
+            self.stream_thread = threading.Thread(target=self.tokenize_stream, args=(self.stream,), daemon=True)
+            self.stream_thread.start()
 
-        soup = data
+        for field, text in enumerate(field_texts):
+            for chunk in chunk_text(text):
+                self.stream.put((chunk, (doc_id, field, None)))
+        self.stream.put(("", (doc_id, None, (link, content_hash(field_texts)))))
 
-        # Get the text from the main content
-        main_content = (
-                soup.find("main")
-                or soup.find("article")
-                or soup.find("section")
-                or soup.find("body")
-        )
+    def close_stream(self):
+        """
+        Ends the stream of the spaCy pipe and waits until its documents are stored.
+        """
+        if self.stream_thread is not None:
+            self.stream.put(None)
+            self.stream_thread.join()
+            self.stream_thread = None
+
+    def tokenize_stream(self, stream: queue.Queue):
+        """
+        Tokenizes the chunks put into the stream with one long-lived spaCy pipe, until the stream is closed. spaCy
+        starts its processes once per pipe, so a pipe per batch would start them again for every batch. The completed
+        documents are stored every batch_size documents.
+        """
 
-        if main_content is None:
-            print(f"Warning: No main content found for {link}. Using entire body.")
-            main_content = soup
-
-        # List of tags you want to extract text from
-        tags_to_extract = [
-            "title",
-            "h1",
-            "h2",
-            "h3",
-            "h4",
-            "h5",
-            "h6",
-            "p",
-            "span",
-            "div",
-            "li",
-            "td",
-            "th",
-            "a",
-            "b",
-            "strong",
-            "i",
-            "em",
-            "mark",
-            "small",
-            "del",
-            "ins",
-            "sub",
-            "sup",
-            "q",
-            "blockquote",
-            "code",
-            "pre",
-        ]
-
-        extracted_text = []
+        # Documents whose chunks went into the pipe and that are not stored yet
+        streamed = set()
 
+        def texts():
+            while (item := stream.get()) is not None:
+                chunk, context = item
+                streamed.add(context[0])
+                yield preprocess_text(chunk), context
+
+        counts = {}
+        completed = []
         try:
-            for tag in main_content.find_all(tags_to_extract):
-                cleaned_text = clean_text(tag.get_text(strip=True))
-                if cleaned_text:
-                    extracted_text.append(cleaned_text)
-        except AttributeError:
-            print(f"Error: Unable to parse content for {link}")
+            for doc, (doc_id, field, document) in get_nlp().pipe(
+                texts(), as_tuples=True, batch_size=PIPE_BATCH_SIZE, n_process=self.n_process
+            ):
+                document_counts = counts.setdefault(doc_id, TermCounts())
+                if document is None:
+                    document_counts.add(field, doc_tokens(doc))
+                    continue
+                del counts[doc_id]
+                streamed.discard(doc_id)
+                link, document_hash = document
+                completed.append((doc_id, link, document_counts, document_hash))
+                if len(completed) >= self.batch_size:
+                    self.store(completed)
+                    completed = []
+        except Exception as e:
+            print(f"Error tokenizing the stream: {str(e)}")
+            # Keep taking the chunks, so the pipeline doesn't wait for the stream, and drop their documents
+            for _ in texts():
+                pass
+            self.discard([(doc_id, f"document {doc_id}", None, None) for doc_id in sorted(streamed)])
+        if completed:
+            self.store(completed)
+
+    def tokenize_batch(self):
+        """
+        Tokenizes the batched documents with one spaCy pipe over the chunks of all their fields, and stores them
+        together.
+        The tokens of each chunk are counted right away, so the tokens of a long document are never all in memory.
+        """
+        batch, self.batch = self.batch, []
+        if not batch:
             return
 
-        # Process meta-description and title
-        description = soup.find("meta", attrs={"name": "description"})
-        description_content = clean_text(
-            description.get("content") if description else ""
-        )
-        title = soup.find("title")
-        title_content = clean_text(title.string if title else "")
-
-        # Process image alt texts
-        img_tags = soup.find_all("img")
-        alt_texts = [
-            clean_text(img.get("alt", "")) for img in img_tags if img.get("alt")
-        ]
-
-        # Combine all text
-        all_text: list[str] = (
-                extracted_text + [description_content, title_content] + alt_texts
+        # Document and field of each chunk, in the order the chunks are tokenized
+        labels = deque()
+
+        def chunks():
+            for index, (_, _, field_texts) in enumerate(batch):
+                for field, text in enumerate(field_texts):
+                    for chunk in chunk_text(text):
+                        labels.append((index, field))
+                        yield chunk
+
+        counts = [TermCounts() for _ in batch]
+        for tokens in process_texts(
+            chunks(), lexicon=self.lexicon, n_process=self.n_process
+        ):
+            index, field = labels.popleft()
+            counts[index].add(field, tokens)
+
+        self.store(
+            [
+                (doc_id, link, document_counts, content_hash(field_texts))
+                for (doc_id, link, field_texts), document_counts in zip(batch, counts)
+            ]
         )
-        text = " ".join(all_text).strip()
-        if len(text) > 200_000:
-            print(f"Text for {link} is too long ({len(text)} characters). Skipping.")
+
+    async def process(self, data, doc_id, link):
+        """
+        Tokenizes the input data.
+        """
+        print(f"Tokenizing {link}...")
+        if data is None:
+            print(f"Failed to tokenize {link} because the data was empty.")
             return
 
-        # Tokenize the text
-        tokenized_text: list[str] = process_text(text=text)
-        if len(tokenized_text) > 6_000:
-            print(f"Too many tokens ({len(tokenized_text)}) for {link}. Skipping.")
+        field_texts = extract_fields(data)
+        if self.n_process > 1 and self.lexicon is None:
+            self.stream_document(doc_id, link, field_texts)
             return
+        self.batch.append((doc_id, link, field_texts))
+        if len(self.batch) >= self.batch_size:
+            self.tokenize_batch()
 
-        print(f"Tokenized {link}, {len(tokenized_text)} tokens found ({self.task_queue.qsize()} tasks left)")
+    def word_id(self) -> int:
+        """
+        Hands out the id of a new word. The ids are reserved from the word_ids sequence in blocks, so a new word
+        costs no query.
+        """
+        if not self.free_word_ids:
+            self.free_word_ids.extend(
+                word_id
+                for word_id, in self.cursor.execute(
+                    "SELECT nextval('word_ids') FROM range(?)", [WORD_ID_BLOCK_SIZE]
+                ).fetchall()
+            )
+        return self.free_word_ids.popleft()
+
+    def store(self, documents: list[tuple[int, str, "TermCounts", str]]):
+        """
+        Inserts the terms of tokenized documents into the database in one transaction, and adds the documents to the
+        pending index segment. If the transaction fails, the documents are stored one by one, and the documents that
+        still fail are tombstoned, so they are not searchable without postings.
+        Args:
+            documents: Id, link, terms and content hash of each document
+
+        Returns: None
+        """
+        for _, link, counts, _ in documents:
+            print(f"Tokenized {link}, {len(counts)} tokens found ({self.task_queue.qsize()} tasks left)")
 
         try:
-            tokens = pd.DataFrame({"token": tokenized_text, "doc_id": doc_id})
+            self.insert(documents)
+        except Exception as e:
+            print(f"Error storing {len(documents)} documents: {str(e)}")
+            if len(documents) == 1:
+                self.discard(documents)
+                return
+            # One failing document rolls back the whole batch
+            stored = []
+            for document in documents:
+                try:
+                    self.insert([document])
+                    stored.append(document)
+                except Exception as e:
+                    print(f"Error storing {document[1]}: {str(e)}")
+                    self.discard([document])
+            documents = stored
+
+        for _, link, _, _ in documents:
+            print(f"Finished processing {link}")
+
+        if self.segments is not None:
+            with self.pending_lock:
+                self.pending.extend(
+                    (doc_id, counts.terms, counts.field_lengths)
+                    for doc_id, _, counts, _ in documents
+                )
+                full = len(self.pending) >= self.segment_size
+            if full:
+                self.flush()
+
+    def insert(self, documents: list[tuple[int, str, "TermCounts", str]]):
+        """
+        Inserts the terms of tokenized documents into the database in one transaction, rolled back if it fails. The
+        terms are resolved to word ids with the term dictionary, so only the new words and the postings are written,
+        without looking up the words table.
+        Args:
+            documents: Id, link, terms and content hash of each document
 
-            # Start a transaction
-            self.cursor.execute("BEGIN TRANSACTION")
+        Returns: None
+        """
+        new_words = {}
+        postings = {"word": [], "doc": [], "field_tfs": [], "positions": []}
+        lengths = {"doc": [], "length": [], "field_lengths": [], "content_hash": []}
+        for doc_id, _, counts, document_hash in documents:
+            for token, (field_tfs, positions) in counts.terms.items():
+                word_id = self.words.get(token) or new_words.get(token)
+                if word_id is None:
+                    word_id = new_words[token] = self.word_id()
+                postings["word"].append(word_id)
+                postings["doc"].append(doc_id)
+                postings["field_tfs"].append(field_tfs)
+                postings["positions"].append(
+                    delta_encode(list(positions)) if self.positions else None
+                )
+            lengths["doc"].append(doc_id)
+            lengths["length"].append(len(counts))
+            lengths["field_lengths"].append(counts.field_lengths)
+            lengths["content_hash"].append(document_hash)
+
+        # DataFrames to directly query in DuckDB
+        df_words = pd.DataFrame(
+            {"word": list(new_words), "id": list(new_words.values())}
+        )
+        df_postings = pd.DataFrame(postings)
+        df_lengths = pd.DataFrame(lengths)
 
-            print(f"Inserting {len(tokenized_text)} tokens into the database")
+        # Start a transaction
+        self.cursor.execute("BEGIN TRANSACTION")
+        try:
+            print(f"Inserting {len(df_postings)} postings and {len(df_words)} new words into the database")
 
             # Insert new words
+            self.cursor.execute("INSERT INTO words(word, id) SELECT word, id FROM df_words")
+
+            # Insert term frequencies (in total and per field) and the delta-encoded positions of each term
             self.cursor.execute("""
-                INSERT INTO words(word)
-                SELECT DISTINCT token
-                FROM tokens
-                WHERE token NOT IN (SELECT word FROM words)
+                INSERT INTO TFs(word, doc, tf, field_tfs, positions)
+                SELECT word, doc, list_sum(field_tfs), field_tfs, positions
+                FROM   df_postings
             """)
 
-            print(f"Computing TFs for {link} ...")
+            # Count the documents in the document frequencies of their words
+            self.cursor.execute("""
+                INSERT INTO IDFs(word, df)
+                SELECT word, COUNT(*) FROM df_postings GROUP BY word
+                ON CONFLICT (word) DO UPDATE SET df = df + EXCLUDED.df
+            """)
 
-            # Insert term frequencies
+            # Insert the document lengths per field
             self.cursor.execute("""
-                INSERT INTO TFs(word, doc, tf)
-                SELECT w.id, t.doc_id, COUNT(*)
-                FROM   tokens AS t, words AS w
-                WHERE  t.token = w.word
-                GROUP BY w.id, t.doc_id, t.token
+                INSERT INTO doc_lengths(doc, length, field_lengths)
+                SELECT doc, length, field_lengths FROM df_lengths
             """)
 
+            # Record what the postings were produced from, so unchanged documents are skipped when reindexing
+            self.cursor.execute(
+                """
+                INSERT INTO document_versions(doc, content_hash, tokenizer_version)
+                SELECT doc, content_hash, ? FROM df_lengths
+            """,
+                [self.version],
+            )
+
             # Commit the transaction
             self.cursor.execute("COMMIT")
-
-            print(f"Finished processing {link}")
-        except Exception as e:
+        except Exception:
             # Rollback in case of error
             self.cursor.execute("ROLLBACK")
-            print(f"Error processing {link}: {str(e)}")
+            raise
+
+        # The new words are only known once they are committed
+        self.words.update(new_words)
+
+    def discard(self, documents: list[tuple[int, str, "TermCounts", str]]):
+        """
+        Tombstones documents that could not be stored. Their rows in the documents table have no postings, so they
+        would be counted by the ranking without ever matching a query. They are removed by a later compaction.
+        """
+        # Imported here, index imports the tokenizer
+        from index import delete_documents
+
+        try:
+            delete_documents(self.cursor, [doc_id for doc_id, _, _, _ in documents])
+            for _, link, _, _ in documents:
+                print(f"Tombstoned {link}, it could not be stored")
+        except Exception as e:
+            print(f"Error tombstoning {len(documents)} documents: {str(e)}")
+
+
+class TermCounts:
+    """
+    Frequency per field and positions of each term of a document, counted chunk by chunk as the document is
+    tokenized. The tokens are numbered across all fields, leaving a gap of FIELD_POSITION_GAP between two fields.
+    """
+
+    def __init__(self):
+        self.terms: dict[str, tuple[list[int], array]] = {}
+        self.field_lengths = [0] * len(FIELDS)
+
+    def __len__(self):
+        return sum(self.field_lengths)
+
+    def add(self, field: int, tokens: list[str]):
+        """
+        Counts the next tokens of a field. The fields have to be added in the order of FIELDS.
+        """
+        offset = len(self) + field * FIELD_POSITION_GAP
+        for position, token in enumerate(tokens, start=offset):
+            term = self.terms.get(token)
+            if term is None:
+                term = self.terms[token] = ([0] * len(FIELDS), array("l"))
+            term[0][field] += 1
+            term[1].append(position)
+        self.field_lengths[field] += len(tokens)
+
+
+def chunk_text(text: str, size: int = CHUNK_SIZE) -> Iterator[str]:
+    """
+    Splits a text into chunks of at most size characters for the tokenization, after the end of a sentence if
+    possible, else between two words.
+    """
+    start = 0
+    while len(text) - start > size:
+        end = text.rfind(". ", start, start + size)
+        if end == -1:
+            end = text.rfind(" ", start, start + size)
+        # A single word longer than the chunk size is split
+        end = start + size if end == -1 else end + 1
+        yield text[start:end]
+        start = end
+    if start < len(text):
+        yield text[start:]
 
 
 def clean_text(text):
@@ -360,6 +848,108 @@ def clean_text(text):
     return text
 
 
+def extract_fields(soup: BeautifulSoup) -> list[str]:
+    """
+    Extracts the text of each field of a page.
+    Args:
+        soup: Page
+
+    Returns: Text of each field, in the order of FIELDS
+    """
+    # Get the text from the main content
+    main_content = (
+            soup.find("main")
+            or soup.find("article")
+            or soup.find("section")
+            or soup.find("body")
+    )
+
+    if main_content is None:
+        print("Warning: No main content found. Using entire body.")
+        main_content = soup
+
+    # Text of each field
+    fields = extract_text(main_content)
+
+    # Process meta-description and title
+    description = soup.find("meta", attrs={"name": "description"})
+    description_content = clean_text(
+        description.get("content") if description else ""
+    )
+    title = soup.find("title")
+    title_content = clean_text(title.string if title else "")
+
+    # Process image alt texts
+    img_tags = soup.find_all("img")
+    alt_texts = [
+        clean_text(img.get("alt", "")) for img in img_tags if img.get("alt")
+    ]
+
+    # Combine the text of each field
+    fields["description"].append(description_content)
+    fields["title"].append(title_content)
+    fields["alt"].extend(alt_texts)
+    return [" ".join(fields[field]).strip() for field in FIELDS]
+
+
+def content_hash(field_texts: list[str]) -> str:
+    """
+    Returns: Hash of the text of each field of a page, which changes whenever the postings of the page would
+    """
+    return hashlib.sha256("\0".join(field_texts).encode()).hexdigest()
+
+
+def tokenizer_version(lexicon=None) -> str:
+    """
+    Returns: Version of the postings produced by the tokenization, with or without the lexicon. It includes the
+    versions of spaCy and of its model, which can tag and lemmatize the same text differently.
+    """
+    version = f"{TOKENIZER_VERSION}-spacy-{spacy.__version__}-{SPACY_MODEL}-{get_nlp().meta['version']}"
+    return f"{version}-lexicon" if lexicon is not None else version
+
+
+def extract_text(element: Tag) -> dict[str, list[str]]:
+    """
+    Extracts the text of an HTML element in a single pass over its subtree, so every text node is extracted once,
+    however deeply its tags are nested. Boilerplate (SKIPPED_TAGS) is skipped.
+    Args:
+        element: Element to extract the text from, e.g. the main content of a page
+
+    Returns: Cleaned text of each block (paragraph, heading, list item, ...) by field
+    """
+    fields = {field: [] for field in FIELDS}
+    parts = {field: [] for field in FIELDS}
+
+    def end_block():
+        for field, field_parts in parts.items():
+            if field_parts:
+                text = clean_text("".join(field_parts))
+                if text:
+                    fields[field].append(text)
+                field_parts.clear()
+
+    # Depth-first walk with an explicit stack, deeply nested pages would exceed the recursion limit. None marks the
+    # end of a block.
+    stack = [(element, "body")]
+    while stack:
+        node, field = stack.pop()
+        if node is None:
+            end_block()
+        elif isinstance(node, Tag):
+            if node.name in SKIPPED_TAGS:
+                continue
+            field = TAG_FIELDS.get(node.name, field)
+            if node.name not in INLINE_TAGS:
+                end_block()
+                stack.append((None, field))
+            stack.extend((child, field) for child in reversed(node.contents))
+        elif isinstance(node, NavigableString) and not isinstance(node, PreformattedString):
+            # Comments, doctypes and CDATA are preformatted strings
+            parts[field].append(node)
+    end_block()
+    return fields
+
+
 # Test tokenization
 
 test_sentences = [
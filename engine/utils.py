@@ -1,5 +1,6 @@
 import ipaddress
 import urllib
+from itertools import accumulate
 from urllib.parse import urlparse, urljoin  # Parsing URLs
 
 # Robots.txt
@@ -116,3 +117,30 @@ def is_valid_ip(address: str) -> bool:
         return True
     except ValueError:
         return False
+
+
+def delta_encode(positions: list[int]) -> list[int]:
+    """
+    Delta-encodes a sorted list of positions, i.e. stores the first position and then the gaps between neighbours.
+    Small gaps compress a lot better than absolute positions.
+
+    Args:
+        positions: Sorted list of positions.
+
+    Returns:
+        The delta-encoded positions.
+    """
+    return [current - previous for previous, current in zip([0] + positions, positions)]
+
+
+def delta_decode(deltas: list[int] | None) -> list[int]:
+    """
+    Reverses `delta_encode`.
+
+    Args:
+        deltas: Delta-encoded positions (or None if no positions were stored).
+
+    Returns:
+        The absolute positions.
+    """
+    return list(accumulate(deltas)) if deltas else []